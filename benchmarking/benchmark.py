@@ -1,83 +1,211 @@
+'''Benchmark suite for fernet_files
+
+Runs every benchmark for each combination of chunksize and data size, and writes the results as JSON:
+
+    python benchmarking/benchmark.py run --output results.json
+    python benchmarking/benchmark.py run --quick --output results.json
+    python benchmarking/benchmark.py compare baseline.json results.json
+
+Benchmarks, for each chunksize and data size:
+
+- seq_write_mbps - Writing all of the data to a new file, 1MiB at a time, in MB/s.
+- seq_read_mbps - Reading all of the data back, 1MiB at a time, in MB/s.
+- random_read_p50_us and random_read_p99_us - Latency of a seek followed by a 4KiB read at a random position, in microseconds.
+- append_ops_per_s - 100 byte writes to a file opened with append=True, per second, including closing the file.
+- disk_overhead - The size of the file on disk divided by the size of the data. Small chunks have a large overhead.
+- write_peak_bytes and read_peak_bytes - Peak memory allocated by Python while writing and reading all of the data, measured with tracemalloc.
+
+Times are the median of `--repeats` runs. Files are written to a temporary directory, which is deleted afterwards.
+`compare` exits with status 1 if any result is worse than the baseline by more than `--threshold`.'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
 import tracemalloc
-from os import urandom, remove
-from os.path import getsize
-from time import perf_counter
-from cryptography.fernet import Fernet
+from importlib.metadata import version, PackageNotFoundError
 from fernet_files import FernetFile
-from fernet_files.custom_fernet import FernetNoBase64
-
-def fernet_encrypt():
-    with open("test", "wb") as f:
-        f.write(fernet.encrypt(data))
-
-def fernet_decrypt():
-    with open("test", "rb") as f:
-        fernet.decrypt(f.read())[0]
-
-def test_fernet():
-    timer = perf_counter()
-    fernet_encrypt()
-    encryption_time = perf_counter() - timer
-
-    timer = perf_counter()
-    fernet_decrypt()
-    decryption_time = perf_counter() - timer
-
-    remove("test")
-
-    tracemalloc.start()
-    fernet_encrypt()
-    _, encryption_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
 
+BLOCK_SIZE = 1_048_576 # sequential reads and writes are done in blocks of this size
+RANDOM_READ_SIZE = 4096
+APPEND_SIZE = 100
+
+CHUNKSIZES = (256, 4096, 65536, 1_048_576)
+DATA_SIZES = (65536, 1_048_576, 16_777_216, 134_217_728)
+QUICK_CHUNKSIZES = (256, 4096, 65536)
+QUICK_DATA_SIZES = (65536, 1_048_576)
+
+HIGHER_IS_BETTER = {"seq_write_mbps": True, "seq_read_mbps": True, "random_read_p50_us": False, "random_read_p99_us": False, "append_ops_per_s": True, "disk_overhead": False, "write_peak_bytes": False, "read_peak_bytes": False}
+'''Every result, and whether a larger value is an improvement.'''
+
+def percentile(values: list[float], p: float) -> float:
+    '''Returns the `p`th percentile of `values` using the nearest rank.'''
+    values = sorted(values)
+    return values[min(len(values)-1, max(0, round(p/100*len(values))-1))]
+
+def write_file(key: bytes, path: str, chunksize: int, data: bytes) -> None:
+    '''Writes `data` to a new encrypted file one block at a time.'''
+    with FernetFile(key, path, chunksize) as f:
+        for position in range(0, len(data), BLOCK_SIZE):
+            f.write(data[position:position+BLOCK_SIZE])
+
+def read_file(key: bytes, path: str, chunksize: int) -> None:
+    '''Reads all of the data in an encrypted file one block at a time.'''
+    buffer = bytearray(BLOCK_SIZE)
+    with FernetFile(key, path, chunksize) as f:
+        while f.readinto(buffer):
+            pass
+
+def bench_case(key: bytes, directory: str, chunksize: int, size: int, repeats: int, random_reads: int, appends: int) -> dict:
+    '''Runs every benchmark for one chunksize and data size and returns a dictionary of the results.'''
+    data = os.urandom(size)
+    path = os.path.join(directory, "bench")
+    result = {"chunksize": chunksize, "size": size}
+
+    times = []
+    for _ in range(repeats):
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        write_file(key, path, chunksize, data)
+        times.append(time.perf_counter()-start)
+    result["seq_write_mbps"] = size/1_000_000/statistics.median(times)
+    result["disk_overhead"] = os.path.getsize(path)/size
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        read_file(key, path, chunksize)
+        times.append(time.perf_counter()-start)
+    result["seq_read_mbps"] = size/1_000_000/statistics.median(times)
+
+    latencies = []
+    with FernetFile(key, path, chunksize) as f:
+        rng = random.Random(0) # the same positions every run
+        for _ in range(random_reads):
+            position = rng.randrange(max(size-RANDOM_READ_SIZE, 1))
+            start = time.perf_counter()
+            f.seek(position)
+            f.read(RANDOM_READ_SIZE)
+            latencies.append((time.perf_counter()-start)*1_000_000)
+    result["random_read_p50_us"] = percentile(latencies, 50)
+    result["random_read_p99_us"] = percentile(latencies, 99)
+
+    times = []
+    record = os.urandom(APPEND_SIZE)
+    for _ in range(repeats):
+        os.remove(path) # write_file would keep the records appended by the previous repeat
+        write_file(key, path, chunksize, data)
+        start = time.perf_counter()
+        with FernetFile(key, path, chunksize, append=True) as f:
+            for _ in range(appends):
+                f.write(record)
+        times.append(time.perf_counter()-start)
+    result["append_ops_per_s"] = appends/statistics.median(times)
+
+    os.remove(path)
     tracemalloc.start()
-    fernet_decrypt()
-    _, decryption_memory = tracemalloc.get_traced_memory()
+    write_file(key, path, chunksize, data)
+    result["write_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    read_file(key, path, chunksize)
+    result["read_peak_bytes"] = tracemalloc.get_traced_memory()[1]
     tracemalloc.stop()
-
-    print(f"{'FernetNoBase64' if isinstance(fernet, FernetNoBase64) else 'Fernet'} {datasize} bytes:\n{encryption_time} seconds to encrypt\n{decryption_time} seconds to read first byte\n{encryption_memory} bytes peak memory to encrypt\n{decryption_memory} bytes peak memory to decrypt\nOutput filesize {getsize('test')} bytes")
-    remove("test")
-
-def ff_encrypt():
-    with FernetFile(ff_key, "test", chunksize=chunksize) as f:
-        f.write(data)
-
-def ff_decrypt():
-    with FernetFile(ff_key, "test", chunksize=chunksize) as f:
-        f.read(1)
-
-def test_ff():
-    timer = perf_counter()
-    ff_encrypt()
-    encryption_time = perf_counter() - timer
-
-    timer = perf_counter()
-    ff_decrypt()
-    decryption_time = perf_counter() - timer
-
-    remove("test")
-
-    tracemalloc.start()
-    ff_encrypt()
-    _, encryption_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    tracemalloc.start()
-    ff_decrypt()
-    _, decryption_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    print(f"FernetFile chunksize {chunksize} bytes, datasize {datasize} bytes:\n{encryption_time} seconds to encrypt\n{decryption_time} seconds to read first byte\n{encryption_memory} bytes peak memory to encrypt\n{decryption_memory} bytes peak memory to decrypt\nOutput filesize {getsize('test')} bytes")
-    remove("test")
-
-ff_key = FernetFile.generate_key()
-
-for datasize in (2**a for a in range(0, 36, 4)):
-    data = urandom(datasize)
-    fernet = Fernet(Fernet.generate_key())
-    test_fernet()
-    fernet = FernetNoBase64(FernetNoBase64.generate_key())
-    test_fernet()
-    for chunksize in (2**b for b in range(4, 28, 4)):
-        if not ((chunksize == 2**4 or chunksize == 2**8) and (datasize == 2**28 or datasize == 2**32)):
-            test_ff()
\ No newline at end of file
+    os.remove(path)
+    return result
+
+def run(args: argparse.Namespace) -> int:
+    '''The run subcommand. Benchmarks every combination of chunksize and data size and outputs the results as JSON.'''
+    chunksizes = args.chunksizes or (QUICK_CHUNKSIZES if args.quick else CHUNKSIZES)
+    sizes = args.sizes or (QUICK_DATA_SIZES if args.quick else DATA_SIZES)
+    try:
+        package_version = version("fernet_files")
+    except PackageNotFoundError:
+        package_version = None
+    results = {
+        "meta": {
+            "fernet_files": package_version,
+            "cryptography": version("cryptography"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "repeats": args.repeats,
+        },
+        "results": [],
+    }
+    key = FernetFile.generate_key()
+    with tempfile.TemporaryDirectory() as directory:
+        for chunksize in chunksizes:
+            for size in sizes:
+                if size//chunksize > args.max_chunks: # tiny chunks with lots of data take far too long
+                    continue
+                result = bench_case(key, directory, chunksize, size, args.repeats, args.random_reads, args.appends)
+                results["results"].append(result)
+                print(f"chunksize {chunksize:>9} size {size:>11}: write {result['seq_write_mbps']:8.1f} MB/s, read {result['seq_read_mbps']:8.1f} MB/s, "
+                      f"random read p50 {result['random_read_p50_us']:8.1f}us p99 {result['random_read_p99_us']:8.1f}us, append {result['append_ops_per_s']:9.0f}/s", file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output+"\n")
+    else:
+        print(output)
+    return 0
+
+def compare(args: argparse.Namespace) -> int:
+    '''The compare subcommand. Prints every result that changed by more than the threshold, and returns 1 if any got worse.'''
+    with open(args.baseline) as f:
+        baseline = {(x["chunksize"], x["size"]): x for x in json.load(f)["results"]}
+    with open(args.current) as f:
+        current = {(x["chunksize"], x["size"]): x for x in json.load(f)["results"]}
+    regressions = 0
+    for case in sorted(baseline.keys() & current.keys()):
+        for name, higher_is_better in HIGHER_IS_BETTER.items():
+            old, new = baseline[case].get(name), current[case].get(name)
+            if not old or new is None:
+                continue
+            change = (new-old)/old
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > args.threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif -worse > args.threshold:
+                flag = "improvement"
+            if flag or args.verbose:
+                print(f"chunksize {case[0]:>9} size {case[1]:>11} {name:<20} {old:14.2f} -> {new:14.2f} ({change:+.1%}) {flag}")
+    for case in sorted(baseline.keys() - current.keys()):
+        print(f"chunksize {case[0]:>9} size {case[1]:>11} missing from {args.current}")
+    print(f"{regressions} regressions with a threshold of {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark suite for fernet_files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    command = subparsers.add_parser("run", help="run the benchmarks and output JSON")
+    command.add_argument("-o", "--output", help="file to write the JSON results to, defaults to stdout")
+    command.add_argument("--quick", action="store_true", help="use a smaller matrix of chunksizes and data sizes")
+    command.add_argument("--chunksizes", type=int, nargs="+", help="chunksizes to benchmark")
+    command.add_argument("--sizes", type=int, nargs="+", help="data sizes to benchmark")
+    command.add_argument("--repeats", type=int, default=3, help="times each sequential and append benchmark is run, the median is used")
+    command.add_argument("--random-reads", type=int, default=1000, help="number of random reads used for the latency percentiles")
+    command.add_argument("--appends", type=int, default=1000, help="number of appends in the append benchmark")
+    command.add_argument("--max-chunks", type=int, default=1_000_000, help="skip combinations with more chunks than this")
+    command.set_defaults(function=run)
+    command = subparsers.add_parser("compare", help="compare results against a baseline, exits with 1 if anything regressed")
+    command.add_argument("baseline")
+    command.add_argument("current")
+    command.add_argument("--threshold", type=float, default=0.1, help="fraction a result can be worse by before it's a regression, defaults to 0.1")
+    command.add_argument("-v", "--verbose", action="store_true", help="show every result, not only changes over the threshold")
+    command.set_defaults(function=compare)
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,9 +8,22 @@ You may treat the class similar to a file: it has `read`, `write`, `seek` and `c
 It can also be context managed, so you can close it using a `with` statement.'''
 
 from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.ciphers import CIPHERS, FernetCipher, AEADCipher
+from fernet_files import instrumentation
+from fernet_files.instrumentation import Stats, global_stats, reset_global_stats
+from fernet_files.compression import COMPRESSIONS, INDEX_CHUNK, TRAILER_SIZE, CompressedCipher, get_compression, compression_flags, pack_index, pack_trailer, read_index
+import errno
 import os
 import os.path
+import stat
+import mmap
+import threading
 from io import BytesIO, RawIOBase, BufferedIOBase, StringIO, TextIOBase, UnsupportedOperation
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import InvalidToken
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from typing import Callable, Iterator
 
 # Don't modify without reading documentation
 META_SIZE = 8
@@ -20,6 +33,148 @@ See documentation for more information.'''
 DEFAULT_CHUNKSIZE = 65536
 '''The default size of chunks in bytes.'''
 
+MMAP_GROWTH = 16_777_216
+'''When a memory-mapped file needs to grow, its size is rounded up to a multiple of this many bytes.'''
+
+UNKNOWN_SIZE = 2**(META_SIZE*8)-1
+'''Written as the number of the last chunk by `fernet_files.encrypt_stream` when the size of the data isn't known up front.
+The real metadata is then in a trailer at the end of the file.'''
+
+READ_BATCH_SIZE = 4_194_304
+'''A read that spans several chunks reads up to this many bytes of their tokens at once and decrypts them together with the cipher's `decrypt_many`.'''
+
+ACCESS_PATTERNS = ("sequential", "random", "noreuse")
+'''The values accepted by `FernetFile`'s `access` argument. Each one is passed to the kernel as a hint with `os.posix_fadvise` where it's available.'''
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "evictions", "currsize", "maxsize"))
+'''Returned by `FernetFile.cache_info()`. Sizes are in bytes.'''
+
+MAGIC = b"\x89FNF\r\n\x1a\n"
+'''The first bytes of a file with a version 2 header. As the number of the last chunk of a version 1 file, this would be far larger than any real file.'''
+
+FORMAT_VERSION = 2
+'''The newest version of the file format. Version 1 files only have the last chunk number and the last chunk's padding in their header.'''
+
+STATS_ENABLED = False
+'''If True, every new `FernetFile` collects statistics unless it's opened with `stats=False`. See `FernetFile.stats`.'''
+
+STATS_HOOK = None
+'''A function used as the `stats_hook` of every new `FernetFile` that collects statistics and isn't given its own hook.'''
+
+FileHeader = namedtuple("FileHeader", ("version", "cipher", "flags", "chunksize", "file_id", "last_chunk", "last_chunk_padding"))
+'''The contents of a file's header. Version 1 headers don't record the chunksize or file ID, so these are `None`, and the cipher is always "fernet".'''
+
+def _header_size(version: int) -> int:
+    '''Returns the size of a header in bytes. The last META_SIZE*2 bytes of the header are always the last chunk number and the last chunk's padding.'''
+    if version == 1:
+        return META_SIZE*2
+    return len(MAGIC)+8+META_SIZE+16+META_SIZE*2 # magic, version, cipher, flags, reserved, chunksize, file ID, metadata
+
+def _read_header(read: Callable[[int], bytes]) -> FileHeader | None:
+    '''Reads a header using `read`, which works like `file.read`. Returns `None` if there is nothing to read.\nRaises ValueError if the header is incomplete or its version or cipher is unknown.'''
+    data = read(META_SIZE*2)
+    if not data:
+        return None
+    if not data.startswith(MAGIC):
+        if len(data) < META_SIZE*2:
+            raise ValueError("Invalid header, file is too short")
+        return FileHeader(1, "fernet", 0, None, None, int.from_bytes(data[:META_SIZE], "little"), int.from_bytes(data[META_SIZE:], "little"))
+    data += read(_header_size(FORMAT_VERSION)-len(data))
+    if len(data) < _header_size(FORMAT_VERSION):
+        raise ValueError("Invalid header, file is too short")
+    position = len(MAGIC)
+    version, cipher = data[position], data[position+1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported format version {version}")
+    if cipher >= len(CIPHERS):
+        raise ValueError(f"Unknown cipher {cipher}")
+    flags = int.from_bytes(data[position+2:position+4], "little")
+    position += 8 # 4 reserved bytes
+    chunksize = int.from_bytes(data[position:position+META_SIZE], "little")
+    file_id = data[position+META_SIZE:position+META_SIZE+16]
+    position += META_SIZE+16
+    return FileHeader(version, CIPHERS[cipher], flags, chunksize, file_id, int.from_bytes(data[position:position+META_SIZE], "little"), int.from_bytes(data[position+META_SIZE:], "little"))
+
+def _read_metadata(read_at: Callable[[int, int], bytes], disk_size: int) -> tuple[FileHeader | None, int, int, int]:
+    '''Reads the header of a file using `read_at(offset, size)`, and the metadata from the trailer if the file was written by `encrypt_stream` without knowing its size. `disk_size` is the size of the file, used to find the trailer.\nReturns the header as it is on disk, the size of the header, the number of the last chunk and the last chunk's padding. If the metadata is in a trailer, the last chunk number in the header is `UNKNOWN_SIZE`. Returns `(None, 0, 0, 0)` if there is nothing to read.\nRaises ValueError in the same cases as `_read_header`.'''
+    position = 0
+    def read(size: int) -> bytes:
+        nonlocal position
+        data = read_at(position, size)
+        position += len(data)
+        return data
+    header = _read_header(read)
+    if header is None:
+        return None, 0, 0, 0
+    last_chunk, last_chunk_padding = header.last_chunk, header.last_chunk_padding
+    if last_chunk == UNKNOWN_SIZE: # written by encrypt_stream, the metadata is in a trailer
+        metadata = read_at(disk_size-META_SIZE*2, META_SIZE*2)
+        last_chunk, last_chunk_padding = int.from_bytes(metadata[:META_SIZE], "little"), int.from_bytes(metadata[META_SIZE:], "little")
+    return header, _header_size(header.version), last_chunk, last_chunk_padding
+
+def _file_read_at(file) -> Callable[[int, int], bytes]:
+    '''Returns a `read_at(offset, size)` function for `_read_metadata` that seeks `file` and reads from it.'''
+    def read_at(offset: int, size: int) -> bytes:
+        file.seek(offset)
+        return file.read(size)
+    return read_at
+
+def _chunksize(header: FileHeader, chunksize: int | str | None, name: str = "chunksize") -> int:
+    '''Returns the chunksize of a file with this header. Version 1 files don't record their chunksize, so `chunksize` is used if it's an integer, otherwise `DEFAULT_CHUNKSIZE`.\nRaises ValueError if `chunksize` is an integer that doesn't match the header. `name` is the name of the argument in the error.'''
+    if header.chunksize is None:
+        return chunksize if isinstance(chunksize, int) else DEFAULT_CHUNKSIZE
+    if chunksize is not None and chunksize != "auto" and header.chunksize != chunksize:
+        raise ValueError(f"Invalid {name}, file was written with a chunksize of {header.chunksize}")
+    return header.chunksize
+
+def _pack_header(header: FileHeader) -> bytes:
+    '''Returns the bytes of a header, the opposite of `_read_header`.'''
+    metadata = header.last_chunk.to_bytes(META_SIZE, "little")+header.last_chunk_padding.to_bytes(META_SIZE, "little")
+    if header.version == 1:
+        return metadata
+    return MAGIC+bytes((header.version, CIPHERS.index(header.cipher)))+header.flags.to_bytes(2, "little")+bytes(4)+header.chunksize.to_bytes(META_SIZE, "little")+header.file_id+metadata
+
+def _get_cipher(fernet: FernetNoBase64, header: FileHeader) -> FernetCipher | AEADCipher:
+    '''Returns the cipher used to encrypt the chunks of a file with this header.'''
+    if header.cipher == "fernet":
+        return FernetCipher(fernet)
+    return AEADCipher(fernet, header.cipher, header.file_id)
+
+def _thread_pool(workers: int, threads: set[int]) -> ThreadPoolExecutor:
+    '''Returns a `ThreadPoolExecutor` with `workers` threads, which adds the identifier of each of its threads to `threads`.'''
+    return ThreadPoolExecutor(max_workers=workers, initializer=lambda: threads.add(threading.get_ident()))
+
+_FADVICE = {"sequential": "POSIX_FADV_SEQUENTIAL", "random": "POSIX_FADV_RANDOM", "noreuse": "POSIX_FADV_NOREUSE"} # names, because not every OS has them
+
+def _regular_fileno(file: RawIOBase | BufferedIOBase) -> int | None:
+    '''Returns the file descriptor of a regular file on disk, or `None` for anything else, such as `BytesIO`, pipes and sockets, which the kernel can't be given hints about.'''
+    try:
+        fileno = file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return fileno if stat.S_ISREG(os.fstat(fileno).st_mode) else None
+
+def _fadvise(fileno: int | None, offset: int, size: int, advice: str) -> None:
+    '''Tells the kernel how `size` bytes of a file at `offset` will be used with `os.posix_fadvise`, where `advice` is the name of one of the `os.POSIX_FADV_` constants. A size of 0 means to the end of the file.\nHints don't change what is read or written, so nothing happens if the file or the OS doesn't support them.'''
+    if fileno is None or not hasattr(os, "posix_fadvise") or not hasattr(os, advice):
+        return
+    try:
+        os.posix_fadvise(fileno, offset, size, getattr(os, advice))
+    except OSError:
+        pass
+
+def _preallocate(fileno: int | None, offset: int, size: int) -> bool:
+    '''Allocates disk space for `size` bytes of a file at `offset` with `os.posix_fallocate`, so data written there later isn't fragmented. The file is extended if the space goes past its end.\nReturns False without doing anything if the file, the OS or the filesystem doesn't support it. Raises OSError if there isn't enough space.'''
+    if fileno is None or size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fileno, offset, size)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENODEV, errno.ESPIPE):
+            return False
+        raise
+    return True
+
 class FernetFile:
     '''Parameters:
 
@@ -30,12 +185,56 @@ class FernetFile:
 - chunksize - The size of chunks in bytes. 
 - - Bigger chunks use more memory and take longer to read or write, but smaller chunks can be very slow when trying to read/write in large quantities.
 - - Bigger chunks apply padding so a very large chunksize will create a large file. Every chunk has its own metadata so a very small chunk size will create a large file.
-- - Defaults to 64KiB (65536 bytes).'''
+- - Version 2 files record their chunksize, so it doesn't need to be given when opening an existing file. Raises ValueError if it's given and doesn't match.
+- - "auto" picks a chunksize for a new file using `expected_size` and `access`, see `FernetFile.auto_chunksize`.
+- - Defaults to `None`, which uses the chunksize recorded in the file, or 64KiB (65536 bytes) for new files and version 1 files.
+- workers - The number of threads used to encrypt chunks in parallel.
+- - If a single write covers several whole chunks, they are encrypted at the same time and written in order.
+- - Defaults to `None`, which encrypts every chunk on the calling thread.
+- read_ahead - The number of chunks to decrypt in the background when reading sequentially.
+- - When the file is being read one chunk after another, the next chunks are decrypted on a worker thread while you process the current one.
+- - Defaults to 0, which disables read-ahead.
+- cache_size - The maximum number of bytes of decrypted chunks to keep in memory.
+- - Chunks that are read again are taken from the cache instead of being decrypted again. The least recently used chunks are discarded first.
+- - Defaults to 0, which disables the cache.
+- write_buffer - The maximum number of bytes of modified chunks to keep in memory before they are encrypted and written.
+- - Modified chunks are written in chunk order, along with a single update to the metadata, when the limit is reached or when `flush` or `close` is called.
+- - Defaults to 0, which writes a chunk as soon as you move away from it.
+- use_mmap - If True, the file is memory-mapped and chunks are read from and written to the mapping instead of using file operations.
+- - Only regular files on disk can be memory-mapped. The file grows in steps of `fernet_files.MMAP_GROWTH` bytes and is truncated to its real size when closed.
+- - Defaults to False.
+- cipher - The cipher used to encrypt chunks when creating a new file, one of `fernet_files.ciphers.CIPHERS`.
+- - "aes-gcm" and "chacha20-poly1305" add 28 bytes to each chunk instead of 73, and authenticate the chunk number with each chunk.
+- - Existing files always use the cipher they were created with. Raises ValueError if a different cipher is given.
+- - Defaults to `None`, which uses the file's cipher, or "fernet" for new files.
+- expected_size - The number of bytes you expect to write to a new file. Used by `chunksize="auto"`, and to preallocate the space the file will take up on disk, see `FernetFile.preallocate`. Defaults to `None`.
+- access - How you expect to use the file, one of `fernet_files.ACCESS_PATTERNS` or `None`. Used by `chunksize="auto"`, and passed to the kernel as a hint with `os.posix_fadvise`.
+- - "sequential" - The file will be read from start to end, so the kernel reads further ahead.
+- - "random" - The file will be read in no particular order, so the kernel doesn't read ahead.
+- - "noreuse" - The file will be read or written once, like "sequential". Chunks are also dropped from the page cache after they've been read or written, so a large file doesn't push more useful data out of the cache.
+- - Defaults to `None`, which gives no hints.
+- append - If True, the file is opened at the end, and every write goes to the end of the file, wherever you have seeked to.
+- - Only the last chunk is decrypted, once, if it isn't full. Appended data is kept in memory until the chunk is full or `flush` or `close` is called.
+- - Defaults to False.
+- stats - If True, statistics about encryption, decryption, file operations and the cache are collected, see `FernetFile.stats`.
+- - Defaults to `None`, which collects statistics if `fernet_files.STATS_ENABLED` is True or `stats_hook` is given.
+- stats_hook - A function called as `stats_hook(event, size, seconds)` after every "decrypt", "encrypt", "read", "write" and "header_write", for example to send them to a tracing system. It can be called from worker threads.
+- - Defaults to `None`, which uses `fernet_files.STATS_HOOK`.
+- compression - The codec used to compress each chunk before it's encrypted when creating a new file, one of `fernet_files.compression.COMPRESSIONS`.
+- - Compressible data takes up less space on disk and less time to encrypt. The file ends with an index of where each chunk is, which is written by `flush` and `close`.
+- - Existing files always use the codec they were created with. Raises ValueError if a different codec is given.
+- - Defaults to `None`, which uses the file's codec, or no compression for new files.'''
 
-    def __init__(self, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, chunksize: int = DEFAULT_CHUNKSIZE) -> None:
+    def __init__(self, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, chunksize: int | str | None = None, workers: int | None = None, read_ahead: int = 0, cache_size: int = 0, write_buffer: int = 0, use_mmap: bool = False, cipher: str | None = None, expected_size: int | None = None, access: str | None = None, append: bool = False, stats: bool | None = None, stats_hook: Callable[[str, int, float], None] | None = None, compression: str | None = None) -> None:
         self.closed = False
+        self.__executor = None
+        self.__pool_threads = set() # identifiers of the executor's threads
+        self.__map = None
+        self.__stats = None
+        self.__preallocated = False # True if the file has been extended past its last chunk by preallocate
+        self.__drop_behind = False
 
-        self.__fernet = key if isinstance(key, FernetNoBase64) else FernetNoBase64(key) # key validation
+        fernet = key if isinstance(key, FernetNoBase64) else FernetNoBase64(key) # key validation
         # file validation
         if isinstance(file, (StringIO, TextIOBase)):
             raise TypeError("File provided must be binary, not string")
@@ -50,73 +249,754 @@ class FernetFile:
             raise TypeError("File must be binary file or a filename")
         
         # chunksize validation
-        if not isinstance(chunksize, int):
-            raise TypeError("Invalid chunksize, must be integer greater than 0")
-        if chunksize <= 0:
-            raise ValueError("Invalid chunksize, must be integer greater than 0")
+        if chunksize is not None and chunksize != "auto":
+            if not isinstance(chunksize, int):
+                raise TypeError("Invalid chunksize, must be integer greater than 0, \"auto\" or None")
+            if chunksize <= 0:
+                raise ValueError("Invalid chunksize, must be integer greater than 0, \"auto\" or None")
+
+        # expected_size and access validation
+        if expected_size is not None:
+            if not isinstance(expected_size, int):
+                raise TypeError("Invalid expected_size, must be integer greater than or equal to 0 or None")
+            if expected_size < 0:
+                raise ValueError("Invalid expected_size, must be integer greater than or equal to 0 or None")
+        if access is not None:
+            if not isinstance(access, str):
+                raise TypeError("Invalid access, must be one of "+", ".join(ACCESS_PATTERNS)+" or None")
+            if access not in ACCESS_PATTERNS:
+                raise ValueError("Invalid access, must be one of "+", ".join(ACCESS_PATTERNS)+" or None")
+
+        # workers validation
+        if workers is not None:
+            if not isinstance(workers, int):
+                raise TypeError("Invalid number of workers, must be integer greater than 0 or None")
+            if workers <= 0:
+                raise ValueError("Invalid number of workers, must be integer greater than 0 or None")
+            self.__executor = _thread_pool(workers, self.__pool_threads)
+        self.__workers = workers
+
+        # read_ahead validation
+        if not isinstance(read_ahead, int):
+            raise TypeError("Invalid read_ahead, must be integer greater than or equal to 0")
+        if read_ahead < 0:
+            raise ValueError("Invalid read_ahead, must be integer greater than or equal to 0")
+        if read_ahead and self.__executor is None:
+            self.__executor = _thread_pool(1, self.__pool_threads)
+        self.__read_ahead = read_ahead
+        self.__prefetched = {} # chunk number -> Future of decrypted data
+        self.__batch = {} # chunk number -> data decrypted together with the chunks around it, by a read that spans them
+        self.__previous_chunk = -1
+
+        # cache_size validation
+        if not isinstance(cache_size, int):
+            raise TypeError("Invalid cache_size, must be integer greater than or equal to 0")
+        if cache_size < 0:
+            raise ValueError("Invalid cache_size, must be integer greater than or equal to 0")
+        self.__cache_size = cache_size
+        self.__cache = OrderedDict() # chunk number -> decrypted data, least recently used first
+        self.__cache_bytes = 0
+        self.__cache_hits, self.__cache_misses, self.__cache_evictions = 0, 0, 0
+
+        # write_buffer validation
+        if not isinstance(write_buffer, int):
+            raise TypeError("Invalid write_buffer, must be integer greater than or equal to 0")
+        if write_buffer < 0:
+            raise ValueError("Invalid write_buffer, must be integer greater than or equal to 0")
+        self.__write_buffer = write_buffer
+        self.__dirty = {} # chunk number -> padded data waiting to be encrypted
+        self.__dirty_bytes = 0
+        self.__metadata_modified = False
+
+        # use_mmap validation
+        if not isinstance(use_mmap, bool):
+            raise TypeError("use_mmap must be a boolean")
+
+        # append validation
+        if not isinstance(append, bool):
+            raise TypeError("append must be a boolean")
+        self.__append = append
+
+        # stats validation
+        if stats is not None and not isinstance(stats, bool):
+            raise TypeError("stats must be a boolean or None")
+        if stats_hook is not None and not callable(stats_hook):
+            raise TypeError("stats_hook must be callable or None")
+
+        # cipher validation
+        if cipher is not None:
+            if not isinstance(cipher, str):
+                raise TypeError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+            if cipher not in CIPHERS:
+                raise ValueError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+
+        # compression validation
+        if compression is not None:
+            if not isinstance(compression, str):
+                raise TypeError("Invalid compression, must be one of "+", ".join(COMPRESSIONS)+" or None")
+            if compression not in COMPRESSIONS:
+                raise ValueError("Invalid compression, must be one of "+", ".join(COMPRESSIONS)+" or None")
 
         # get metadata
-        self.__file.seek(0)
-        if x := self.__file.read(META_SIZE): # If metadata exists, read it
-            self.__last_chunk = int.from_bytes(x, "little")
-            self.__last_chunk_padding = int.from_bytes(self.__file.read(META_SIZE), "little")
+        header, _, last_chunk, last_chunk_padding = _read_metadata(self.__read_at, self.__file.seek(0, os.SEEK_END))
+        trailer = False
+        if header is None: # a new file is a single chunk made entirely of padding
+            if chunksize is None:
+                chunksize = DEFAULT_CHUNKSIZE
+            elif chunksize == "auto":
+                chunksize = FernetFile.auto_chunksize(expected_size, access)
+            header = FileHeader(FORMAT_VERSION, cipher or "fernet", compression_flags(compression), chunksize, os.urandom(16), 0, chunksize)
         else:
-            self.__last_chunk, self.__last_chunk_padding = 0, 0
+            chunksize = _chunksize(header, chunksize)
+            if cipher is not None and header.cipher != cipher:
+                raise ValueError(f"Invalid cipher, file is encrypted with {header.cipher}")
+            if compression is not None and get_compression(header.flags) != compression:
+                raise ValueError(f"Invalid compression, file is compressed with {get_compression(header.flags)}")
+            trailer = header.last_chunk == UNKNOWN_SIZE # written by encrypt_stream
+            header = header._replace(last_chunk=last_chunk, last_chunk_padding=last_chunk_padding)
+        self.__header = header
+        self.__header_size = _header_size(header.version)
+        self.__last_chunk, self.__last_chunk_padding = header.last_chunk, header.last_chunk_padding
+        self.__cipher = _get_cipher(fernet, header)
+        self.__index = None # the position and size of each chunk, only compressed files have one
+        if (codec := get_compression(header.flags)) is not None:
+            self.__index_cipher = self.__cipher
+            self.__index, position, size = read_index(self.__read_at, self.__file.seek(0, os.SEEK_END), self.__header_size, self.__cipher)
+            self.__index_on_disk = (position, size) if size else None # the position and size of the last index written, which chunks mustn't overwrite
+            self.__data_end = position+size
+            self.__free = [] # the space of old indexes, reused by close
+            self.__index_modified = False
+            self.__cipher = CompressedCipher(self.__cipher, codec, chunksize)
+        if stats or (stats is None and (STATS_ENABLED or stats_hook is not None)):
+            # the cipher and file operations are wrapped, so files without statistics do no extra work
+            self.__stats = instrumentation.Recorder(stats_hook or STATS_HOOK)
+            self.__cipher = instrumentation.InstrumentedCipher(self.__cipher, self.__stats)
+            self.__read_at = self.__stats.timed_read(self.__read_at)
+            self.__write_at = self.__stats.timed_write(self.__write_at)
+            instrumentation.register(self)
+        self.__trailer = trailer # the trailer is only removed if the file is writeable, see below
         # write metadata + check writeability
         self.__file.seek(0)
         try:
-            self.__file.write(bytes(META_SIZE*2))
+            # write back what was read so that closing without writing leaves the file intact
+            self.__file.write(_pack_header(header))
             self.writeable = True
         except UnsupportedOperation:
             self.writeable = False
 
+        if use_mmap:
+            self.__open_map()
+        self.__zeros_from = self.__map_end if self.__map is not None else self.__file.seek(0, os.SEEK_END) # everything in the underlying file after this is zeros
+
         self.__data_chunksize = chunksize # the size of the data in chunks
-        self.__chunksize = chunksize + 73 - (chunksize % 16) # the size of chunks when written to disk
+        self.__chunksize = self.__cipher.token_size(chunksize) # the size of chunks when written to disk
         
+        self.__chunk = None # chunks are only read when their data is needed
         self.__chunk_modified = False
-        self._pos_pointer = 0 # your position inside a chunk
-        self._chunk_pointer = 0 # what chunk you're currently in
+        self.__pos_pointer = 0 # your position inside a chunk
+        self.__chunk_pointer = 0 # what chunk you're currently in
+
+        if trailer and self.writeable: # the real metadata has been written at the start, so the trailer is removed
+            self.__truncate_file(self.__chunk_offset(self.__last_chunk+1) if self.__get_file_size() else self.__header_size)
+            self.__trailer = False
+        self.__chunks_on_disk = self.__last_chunk+1 if self.__get_file_size() else 0 # every chunk before this has a token or a hole token on disk
+        if self.__index is not None and self.__index_on_disk is None and self.writeable: # chunks are only written after an index, so a new file that isn't closed can still be opened
+            self.__index_modified = True
+            self.__write_index()
+
+        # kernel I/O hints
+        self.__fileno = _regular_fileno(self.__file) # None if the kernel can't be given hints about the file
+        self.__drop_behind = access == "noreuse" and self.__fileno is not None
+        if access is not None:
+            _fadvise(self.__fileno, 0, 0, _FADVICE[access])
+        if expected_size is not None and self.writeable and not self.__get_file_size():
+            self.preallocate(expected_size)
+        if append:
+            self.seek(0, os.SEEK_END)
+
+    def __chunk_offset(self, chunk: int) -> int:
+        '''Returns the location of a chunk in `self.__file`, taking into account the header at the start of the file.\nCalculated as follows: take the number of the chunk, multiply by the size of chunks when they're written to disk. Add the size of the header to the number you had before.'''
+        return chunk*self.__chunksize+self.__header_size
+
+    def __read_token(self, chunk: int) -> bytes | None:
+        '''Reads the token of a chunk from `self.__file`. The token of a compressed chunk is found in the index, and a chunk that isn't in the index is a hole, so nothing is read and `None` is returned. So is a chunk of an uncompressed file past `self.__chunks_on_disk`, a hole whose hole token hasn't been written yet.'''
+        if self.__index is None:
+            if chunk >= self.__chunks_on_disk:
+                return None
+            offset, size = chunk*self.__chunksize+self.__header_size, self.__chunksize
+        else:
+            offset, size = self.__index[chunk] if chunk < len(self.__index) else (0, 0)
+            if not size:
+                return None
+        token = self.__read_at(offset, size)
+        if self.__drop_behind:
+            _fadvise(self.__fileno, offset, size, "POSIX_FADV_DONTNEED")
+        return token
+
+    def __write_token(self, chunk: int, token: bytes) -> None:
+        '''Writes the token of a chunk to `self.__file`. Chunks that are skipped over by writing past the end of the data are written as holes first. A compressed chunk is written in the space of the token it replaces if it fits, otherwise after the last chunk in the file, and the index is updated.'''
+        if self.__index is None:
+            if chunk > self.__chunks_on_disk:
+                self.__write_holes(range(self.__chunks_on_disk, chunk))
+            self.__write_at(chunk*self.__chunksize+self.__header_size, token)
+            self.__chunks_on_disk = max(self.__chunks_on_disk, chunk+1)
+            if self.__drop_behind:
+                self.__drop(chunk*self.__chunksize+self.__header_size, len(token))
+            return
+        if chunk >= len(self.__index):
+            self.__index.extend((0, 0) for _ in range(chunk+1-len(self.__index)))
+        offset, size = self.__index[chunk]
+        if len(token) > size:
+            offset = self.__data_end
+            self.__data_end += len(token)
+            if self.__index_on_disk is not None: # the file keeps ending with the trailer of the index on disk until the new one is written
+                self.__write_at(offset, token+pack_trailer(*self.__index_on_disk))
+            else:
+                self.__write_at(offset, token)
+        else:
+            self.__write_at(offset, token)
+        self.__index[chunk] = (offset, len(token))
+        self.__index_modified = True
+        if self.__drop_behind:
+            self.__drop(offset, len(token))
+
+    def __write_holes(self, chunks: range) -> None:
+        '''Writes the hole token from the cipher's `encrypt_hole` at the start of each of `chunks`, which are past the end of the data. The rest of a hole must be zeros, so it's only written where the underlying file may still hold old data, and most of a hole stays sparse.'''
+        for chunk in chunks:
+            offset, token = self.__chunk_offset(chunk), self.__cipher.encrypt_hole(chunk)
+            if offset+len(token) < self.__zeros_from:
+                token = token.ljust(min(self.__chunksize, self.__zeros_from-offset), b"\0")
+            self.__write_at(offset, token)
+        self.__chunks_on_disk = max(self.__chunks_on_disk, chunks.stop)
 
-    def __goto_current_chunk(self) -> None:
-        '''Moves our position in `self.__file` to the location represented by the chunk pointer, taking into account the metadata at the start of the file.\nCalculated as follows: take the number of the chunk you're currently on, multiply by the size of chunks when they're written to disk. Take the META_SIZE, multiply that by 2 and add it to the number you had before.'''
-        self.__file.seek(self._chunk_pointer*self.__chunksize+META_SIZE*2)
+    def __drop(self, offset: int, size: int) -> None:
+        '''Drops data that has just been written from the page cache, for files opened with `access="noreuse"`. The data is flushed first, because the kernel only drops pages that have been written to disk, and starts writing them when it's told to drop them.'''
+        if self.__map is None:
+            self.__file.flush()
+        _fadvise(self.__fileno, offset, size, "POSIX_FADV_DONTNEED")
+
+    def __write_index(self) -> None:
+        '''Encrypts and writes the index of a compressed file after its last chunk, followed by its trailer, and truncates the file after it. The old index is then no longer needed, so its space is added to the free space. Does nothing if the index hasn't changed since it was last written.'''
+        if self.__index is None or not self.__index_modified:
+            return
+        token = self.__index_cipher.encrypt(INDEX_CHUNK, pack_index(self.__index))
+        position = self.__data_end
+        self.__write_at(position, token+pack_trailer(position, len(token)))
+        self.__truncate_file(position+len(token)+TRAILER_SIZE)
+        if self.__index_on_disk is not None and sum(self.__index_on_disk) <= position:
+            self.__free.append((self.__index_on_disk[0], sum(self.__index_on_disk)))
+        self.__index_on_disk = (position, len(token))
+        self.__data_end = position+len(token)
+        self.__index_modified = False
+
+    def __reclaim_free_space(self) -> None:
+        '''Moves chunks of a compressed file from the end of the file into the space of old indexes, starting with the last one and stopping at the first that doesn't fit, then writes the index again after the last chunk. The old index is left intact until the new one is written, so the file can be opened if it's interrupted. Called by `close`.'''
+        if not self.__free:
+            return
+        free = sorted(self.__free)
+        for chunk, (offset, size) in sorted(((chunk, entry) for chunk, entry in enumerate(self.__index) if entry[1]), key=lambda x: x[1][0], reverse=True):
+            space = next((i for i, (start, end) in enumerate(free) if end <= offset and end-start >= size), None)
+            if space is None:
+                break
+            start, end = free[space]
+            self.__write_at(start, bytes(self.__read_at(offset, size)))
+            self.__index[chunk] = (start, size)
+            free[space] = (start+size, end)
+        data_end = max((offset+size for offset, size in self.__index if size), default=self.__header_size)
+        self.__free.clear()
+        if data_end < self.__index_on_disk[0]: # otherwise the index already follows the last chunk
+            self.__data_end = data_end
+            self.__index_modified = True
+            self.__write_index()
+
+    def __read_at(self, offset: int, size: int) -> bytes | memoryview:
+        '''Reads up to `size` bytes from `self.__file` at `offset`. If there is a memory map, a memoryview of the map is returned instead, so the data isn't copied before it's decrypted.'''
+        if self.__map is not None:
+            return memoryview(self.__map)[offset:offset+size]
+        self.__file.seek(offset)
+        return self.__file.read(size)
+
+    def __write_at(self, offset: int, data: bytes) -> None:
+        '''Writes `data` to `self.__file` at `offset`, to the memory map if there is one. The map is grown if the data goes past its end.'''
+        end = offset+len(data)
+        self.__zeros_from = max(self.__zeros_from, end)
+        if self.__map is None:
+            self.__file.seek(offset)
+            self.__file.write(data)
+            return
+        if end > len(self.__map):
+            self.__unmap()
+            os.ftruncate(self.__file.fileno(), -(-end//MMAP_GROWTH)*MMAP_GROWTH) # round up
+            self.__map = mmap.mmap(self.__file.fileno(), 0)
+        self.__map[offset:end] = data
+        self.__map_end = max(self.__map_end, end)
+
+    def __open_map(self) -> None:
+        '''Memory-maps `self.__file`. Raises ValueError if it isn't a regular file.\nA read-only file is mapped read-only, and an empty read-only file isn't mapped because there is nothing to read.'''
+        try:
+            fileno = self.__file.fileno()
+        except (AttributeError, UnsupportedOperation):
+            raise ValueError("use_mmap requires a regular file")
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            raise ValueError("use_mmap requires a regular file")
+        self.__file.flush()
+        self.__map_end = os.fstat(fileno).st_size # where the real data ends
+        if self.writeable:
+            if self.__map_end < MMAP_GROWTH:
+                os.ftruncate(fileno, MMAP_GROWTH)
+            self.__map = mmap.mmap(fileno, 0)
+        elif self.__map_end:
+            self.__map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    def __unmap(self) -> None:
+        '''Closes the memory map. If a memoryview returned by `__read_at` is still alive, such as in the traceback of an exception raised while decrypting it, the map can't be closed yet and is closed by the garbage collector once the memoryview is freed.'''
+        try:
+            self.__map.close()
+        except BufferError:
+            pass
+
+    def __close_map(self) -> None:
+        '''Closes the memory map and truncates the file to the end of the data written to it.'''
+        if self.__map is not None:
+            self.__map.flush()
+            self.__unmap()
+            self.__map = None
+            if self.writeable:
+                os.ftruncate(self.__file.fileno(), self.__map_end)
+
+    def __truncate_file(self, size: int) -> None:
+        '''Truncates or extends `self.__file` to `size` bytes. Any new space is filled with zeros.\nIf the file is memory-mapped, the file is truncated before it is grown back to the size of the map, so no old data is left in the map past `size`.'''
+        self.__zeros_from = size
+        if self.__map is None:
+            self.__file.truncate(size)
+            if self.__file.seek(0, os.SEEK_END) < size: # BytesIO can't be extended by truncate
+                self.__file.seek(size-1)
+                self.__file.write(b"\0")
+            return
+        fileno = self.__file.fileno()
+        self.__unmap()
+        os.ftruncate(fileno, size)
+        os.ftruncate(fileno, max(-(-size//MMAP_GROWTH)*MMAP_GROWTH, MMAP_GROWTH)) # round up
+        self.__map = mmap.mmap(fileno, 0)
+        self.__map_end = size
 
     def __get_file_size(self) -> int:
         '''Calculate the size of the data contained within the file in bytes using the file's metadata. This is the size of the data, not the size of what is written to disk.\nCalculated as follows: take the number of the last chunk and add 1 to get the total number of chunks (because counting starts at 0). Multiply this by the chunksize. Finally, subtract the size of the padding used on the last chunk.'''
+        if self.__chunk_modified and self._chunk_pointer >= self.__last_chunk: # the metadata hasn't been updated yet
+            return self._chunk_pointer*self.__data_chunksize+len(self.__chunk)
         return (self.__last_chunk+1)*self.__data_chunksize-self.__last_chunk_padding
     
-    def __read_chunk(self) -> BytesIO:
-        '''Reads and decrypts the current chunk, turns it into a BytesIO object, stores that object in `self.__chunk` and returns it.\nIf the chunk has been modified, it is already loaded into memory so no file operations are done. Also responsible for removing padding if the chunk being read is the last chunk.'''
-        if self.__chunk_modified:
+    def __read_chunk(self) -> bytes | bytearray:
+        '''Reads and decrypts the current chunk, stores the data in `self.__chunk` and returns it.\nIf the chunk is already loaded, no file operations are done. Chunks after the last chunk, and the chunk of an empty file, are empty, so they are never read from the file. Also responsible for removing padding if the chunk being read is the last chunk.'''
+        if self.__chunk is not None:
             return self.__chunk
-            # you can't modify a chunk without it already being loaded
-        self.__goto_current_chunk()
-        try:
-            data = self.__fernet.decrypt(self.__file.read(self.__chunksize))
-            if self._chunk_pointer == self.__last_chunk and self.__last_chunk_padding:
-                data = data[:-self.__last_chunk_padding]
-            self.__chunk = BytesIO(data)
-        except:
-            self.__chunk = BytesIO()
+            # a modified chunk is always loaded
+        if (data := self.__dirty.pop(self._chunk_pointer, None)) is not None:
+            # the chunk is waiting in the write buffer, so it becomes the modified chunk again
+            self.__dirty_bytes -= len(data)
+            self.__chunk_modified = True
+        elif self._chunk_pointer > self.__last_chunk or not self.__get_file_size(): # an empty file's only chunk isn't on disk
+            data = b""
+        elif (data := self.__cache_get(self._chunk_pointer)) is None:
+            future = self.__prefetched.pop(self._chunk_pointer, None)
+            try:
+                if future is not None:
+                    data = future.result()
+                    if self.__stats is not None:
+                        self.__stats.record("prefetched_used", 0, 0)
+                elif (data := self.__batch.pop(self._chunk_pointer, None)) is None:
+                    data = self.__decrypt_chunk(self._chunk_pointer, self.__read_token(self._chunk_pointer))
+                self.__cache_put(self._chunk_pointer, data)
+            except InvalidToken: # invalid chunks are read as empty, see verify
+                data = b""
+        if self._chunk_pointer == self.__last_chunk and self.__last_chunk_padding:
+            data = data[:-self.__last_chunk_padding]
+        self.__chunk = data
+        if self.__read_ahead:
+            self.__prefetch()
         return self.__chunk
+
+    def __decrypt_chunk(self, chunk: int, token: bytes) -> bytes:
+        '''Decrypts the token of a chunk read from the file. Holes, chunks that have never been written, are returned as a chunk of zeros without decrypting anything. Raises `cryptography.fernet.InvalidToken` if the token is invalid, including if it's all zeros or missing but isn't a hole.'''
+        if token is None or self.__cipher.is_hole(chunk, token):
+            return bytes(self.__data_chunksize)
+        return self.__cipher.decrypt(chunk, token)
+
+    def __decrypt_batch(self, size: int) -> None:
+        '''Called by `__read_views` before it loads the current chunk, if the read goes past the end of it. Reads the tokens of the chunks the next `size` bytes pass through, up to `READ_BATCH_SIZE` bytes of them, and decrypts them together into `self.__batch`.\nChunks that are already in memory are skipped. If any token is invalid, nothing is stored, so every chunk is read again on its own and treated in the same way as before.'''
+        last = min(self._chunk_pointer+(self._pos_pointer+size-1)//self.__data_chunksize, self.__last_chunk, self._chunk_pointer+max(READ_BATCH_SIZE//self.__chunksize, 2)-1)
+        chunks = [chunk for chunk in range(self._chunk_pointer, last+1) if chunk not in self.__dirty and chunk not in self.__cache and chunk not in self.__prefetched]
+        if len(chunks) < 2:
+            return
+        tokens = {chunk: self.__read_token(chunk) for chunk in chunks}
+        encrypted = [chunk for chunk in chunks if tokens[chunk] is not None and not self.__cipher.is_hole(chunk, tokens[chunk])]
+        try:
+            data = dict(zip(encrypted, self.__decrypt_many(encrypted, [tokens[chunk] for chunk in encrypted])))
+        except Exception:
+            return
+        for chunk in chunks:
+            self.__batch[chunk] = data.get(chunk, bytes(self.__data_chunksize)) # holes are zeros
+
+    def __decrypt_many(self, chunks: list[int], tokens: list[bytes]) -> list[bytes]:
+        '''Decrypts the tokens of a list of chunk numbers with the cipher's `decrypt_many` and returns a list of the data in the same order.\nIf there are workers, the list is split into one batch per worker and the batches are decrypted in parallel.'''
+        if self.__workers is None or len(chunks) < 2:
+            return self.__cipher.decrypt_many(chunks, tokens)
+        batch_size = -(-len(chunks)//self.__workers) # round up
+        batches = range(0, len(chunks), batch_size)
+        return list(chain.from_iterable(self.__executor.map(self.__cipher.decrypt_many, [chunks[i:i+batch_size] for i in batches], [tokens[i:i+batch_size] for i in batches])))
+
+    def __cache_get(self, chunk: int) -> bytes | None:
+        '''Returns the decrypted data of a chunk from the cache and marks it as most recently used, or returns `None` if it isn't cached.'''
+        if not self.__cache_size:
+            return None
+        data = self.__cache.get(chunk)
+        if data is None:
+            self.__cache_misses += 1
+        else:
+            self.__cache_hits += 1
+            self.__cache.move_to_end(chunk)
+        return data
+
+    def __cache_put(self, chunk: int, data: bytes) -> None:
+        '''Stores the decrypted data of a chunk in the cache, discarding the least recently used chunks until the cache fits in `cache_size`.\nData larger than the whole cache is not stored.'''
+        self.__cache_discard(chunk)
+        if len(data) > self.__cache_size:
+            return
+        self.__cache[chunk] = data
+        self.__cache_bytes += len(data)
+        while self.__cache_bytes > self.__cache_size:
+            self.__cache_bytes -= len(self.__cache.popitem(last=False)[1])
+            self.__cache_evictions += 1
+
+    def __cache_discard(self, chunk: int) -> None:
+        '''Removes a chunk from the cache if it is there.'''
+        if (data := self.__cache.pop(chunk, None)) is not None:
+            self.__cache_bytes -= len(data)
+
+    def stats(self) -> Stats | None:
+        '''Returns a `fernet_files.Stats` named tuple of the statistics collected since the file was opened, or `None` if the file isn't collecting statistics. The fields are:
+
+- chunks_decrypted and chunks_encrypted - The number of chunks passed to the cipher. Holes aren't decrypted.
+- plaintext_bytes_decrypted and plaintext_bytes_encrypted - The size of those chunks' data, including padding.
+- bytes_read and bytes_written - The number of bytes read from and written to the underlying file.
+- header_writes - The number of times the metadata in the header was written.
+- wasted_decrypts - Chunks that were decrypted in advance by read-ahead, then thrown away without being read.
+- crypto_time and io_time - Seconds spent encrypting and decrypting, and reading and writing the underlying file. Time spent on several threads at once is added together.
+- cache_hits and cache_misses - The same as `cache_info`. `cache_hit_ratio` is the fraction of lookups that were hits.'''
+        if self.__stats is None:
+            return None
+        with self.__stats.lock:
+            counts = dict(self.__stats.counts)
+        pending = sum(1 for future in list(self.__prefetched.values()) if not future.cancelled()) # not wasted yet
+        return Stats(counts["chunks_decrypted"], counts["chunks_encrypted"], counts["plaintext_bytes_decrypted"], counts["plaintext_bytes_encrypted"],
+                     counts["bytes_read"], counts["bytes_written"], counts["header_writes"], max(counts["prefetched"]-counts["prefetched_used"]-counts["prefetch_cancelled"]-pending, 0),
+                     counts["crypto_time"], counts["io_time"], self.__cache_hits, self.__cache_misses)
+
+    def cache_info(self) -> CacheInfo:
+        '''Returns a `CacheInfo` named tuple of the cache's hits, misses, evictions, current size in bytes and maximum size in bytes.'''
+        return CacheInfo(self.__cache_hits, self.__cache_misses, self.__cache_evictions, self.__cache_bytes, self.__cache_size)
+
+    def __prefetch(self) -> None:
+        '''Called after a chunk is read. If the chunk directly follows the previously read chunk, starts decrypting the next `read_ahead` chunks on `self.__executor`, otherwise discards any chunks that were decrypted in advance.\nThe ciphertext is read on the calling thread, so the file object is never used by two threads at once.'''
+        if self._chunk_pointer != self.__previous_chunk + 1:
+            self.__discard_prefetched(list(self.__prefetched))
+        else:
+            for chunk in range(self._chunk_pointer+1, min(self._chunk_pointer+self.__read_ahead, self.__last_chunk)+1):
+                if chunk not in self.__prefetched and chunk not in self.__batch:
+                    token = self.__read_token(chunk)
+                    if self.writeable and token is not None: # the map can be truncated while the token is decrypted, so it's copied first
+                        token = bytes(token)
+                    self.__prefetched[chunk] = self.__executor.submit(self.__decrypt_chunk, chunk, token)
+                    if self.__stats is not None:
+                        self.__stats.record("prefetched", 0, 0)
+        self.__previous_chunk = self._chunk_pointer
+
+    def __discard_prefetched(self, chunks) -> None:
+        '''Removes chunks from `self.__prefetched`. Decryptions that haven't started yet are cancelled, so they don't hold up the pool for chunks that are being read now.'''
+        for chunk in chunks:
+            future = self.__prefetched.pop(chunk, None)
+            if future is not None and future.cancel() and self.__stats is not None:
+                self.__stats.record("prefetch_cancelled", 0, 0)
     
     def __write_chunk(self) -> None:
-        '''Encrypts and writes the chunk, and sets `self.__chunk_modified` to False.\nAlso responsible for applying padding and modifying the metadata at the start of the file if this is the last chunk.'''
+        '''Encrypts and writes the chunk, and sets `self.__chunk_modified` to False. If there is a write buffer, the chunk is put in the buffer instead, and the buffer is flushed if it is over its limit. In append mode, a chunk that isn't full is always put in the buffer.\nAlso responsible for applying padding and modifying the metadata if this is the last chunk.'''
         if not self.writeable:
             return # Raising an exception is the write method's responsibility
-        self.__goto_current_chunk()
-        data = self.__chunk.getvalue()
-        padding = self.__data_chunksize - len(data)
-        data += bytes(padding)
-        self.__file.write(self.__fernet.encrypt(data))
+        padding = self.__data_chunksize - len(self.__chunk)
+        data = bytes(self.__chunk).ljust(self.__data_chunksize, b"\0")
         if self._chunk_pointer >= self.__last_chunk:
             self.__last_chunk = self._chunk_pointer
             self.__last_chunk_padding = padding
-            self.__file.seek(0)
-            self.__file.write(self.__last_chunk.to_bytes(META_SIZE, "little"))
-            self.__file.write(self.__last_chunk_padding.to_bytes(META_SIZE, "little"))
+            self.__metadata_modified = True
+        keep = self.__append and padding # an unfinished chunk at the end of a file opened for appending stays in memory
+        if self.__write_buffer or keep:
+            self.__dirty_bytes -= len(self.__dirty.get(self._chunk_pointer, b""))
+            self.__dirty[self._chunk_pointer] = data
+            self.__dirty_bytes += len(data)
+            if self.__dirty_bytes > self.__write_buffer and not keep:
+                self.__flush_chunks()
+        else:
+            self.__store_chunk(self._chunk_pointer, data, self.__cipher.encrypt(self._chunk_pointer, data))
+            self.__write_metadata()
         self.__chunk_modified = False
 
+    def __store_chunk(self, chunk: int, data: bytes, token: bytes) -> None:
+        '''Writes an encrypted chunk to disk. `data` is the unencrypted chunk, which replaces any copy of the chunk that was decrypted in advance or cached.'''
+        self.__discard_prefetched((chunk,))
+        self.__write_token(chunk, token)
+        if self.__cache_size:
+            self.__cache_put(chunk, data)
+
+    def __write_metadata(self) -> None:
+        '''Writes the last chunk number and the last chunk's padding to the start of the file, if they have changed since they were last written.'''
+        if self.__metadata_modified:
+            self.__write_at(self.__header_size-META_SIZE*2, self.__last_chunk.to_bytes(META_SIZE, "little")+self.__last_chunk_padding.to_bytes(META_SIZE, "little"))
+            if self.__stats is not None:
+                self.__stats.record("header_write", META_SIZE*2, 0)
+            self.__metadata_modified = False
+
+    def __flush_chunks(self) -> None:
+        '''Encrypts and writes every chunk in the write buffer in chunk order, then writes the metadata once.\nThe chunks are encrypted in batches, or split between the workers if there are any.'''
+        chunks = sorted(self.__dirty)
+        tokens = self.__encrypt_many(chunks, [self.__dirty[chunk] for chunk in chunks])
+        for chunk, token in zip(chunks, tokens):
+            self.__store_chunk(chunk, self.__dirty[chunk], token)
+        self.__dirty.clear()
+        self.__dirty_bytes = 0
+        self.__write_metadata()
+
+    def __encrypt_many(self, chunks: list[int], data: list[bytes]) -> Iterator[bytes]:
+        '''Encrypts the data of a list of chunk numbers with the cipher's `encrypt_many` and returns an iterator of the tokens in the same order.\nIf there are workers, the list is split into one batch per worker and the batches are encrypted in parallel.'''
+        if self.__workers is None or len(chunks) < 2:
+            return iter(self.__cipher.encrypt_many(chunks, data))
+        batch_size = -(-len(chunks)//self.__workers) # round up
+        batches = range(0, len(chunks), batch_size)
+        return chain.from_iterable(self.__executor.map(self.__cipher.encrypt_many, [chunks[i:i+batch_size] for i in batches], [data[i:i+batch_size] for i in batches]))
+
+    def flush(self) -> None:
+        '''Encrypts and writes all modified chunks held in memory, including the current chunk, then flushes the underlying file.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not self.writeable:
+            return
+        if self.__chunk_modified:
+            self.__write_chunk()
+        self.__flush_chunks()
+        self.__write_index()
+        if self.__map is not None:
+            self.__map.flush()
+        self.__file.flush()
+
+    def __write_full_chunks(self, first: int, b: memoryview, count: int) -> None:
+        '''Encrypts `count` whole chunks from `b` on the thread pool, and writes them to disk in order starting at chunk number `first`.\nChunks are handed to the pool in batches of a few per worker so that memory usage stays bounded. Also responsible for modifying the metadata at the start of the file if the last chunk is overwritten or extended.'''
+        self.__discard_prefetched(range(first, first+count))
+        for chunk in range(first, first+count):
+            self.__cache_discard(chunk)
+            self.__dirty_bytes -= len(self.__dirty.pop(chunk, b""))
+        batch_size = self.__workers*4
+        for batch_start in range(0, count, batch_size):
+            chunks = range(batch_start, min(batch_start+batch_size, count))
+            batch = [bytes(b[chunk*self.__data_chunksize:(chunk+1)*self.__data_chunksize]) for chunk in chunks]
+            for chunk, token in enumerate(self.__encrypt_many([first+chunk for chunk in chunks], batch), first+batch_start):
+                self.__write_token(chunk, token)
+        if first+count-1 >= self.__last_chunk:
+            self.__last_chunk = first+count-1
+            self.__last_chunk_padding = 0
+            self.__metadata_modified = True
+            if not self.__write_buffer:
+                self.__write_metadata()
+
+    def truncate(self, size: int | None = None) -> int:
+        '''Resizes the file to `size` bytes and returns the new size. The position in the file doesn't change.
+
+Parameters:
+
+- size - The new size of the file in bytes. Defaults to `None`, which uses the current position.
+
+When the file shrinks, only the new last chunk is re-encrypted, then the metadata is updated and the underlying file is truncated. When the file grows, the new chunks are holes, chunks that are read as zeros, so only a short hole token is written for each of them and no data is encrypted.'''
+        if not self.writeable:
+            raise UnsupportedOperation("truncate")
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None:
+            size = self._pos_pointer + self._chunk_pointer*self.__data_chunksize
+        elif not isinstance(size, int):
+            raise TypeError("Invalid size, must be integer greater than or equal to 0 or None")
+        elif size < 0:
+            raise ValueError("Invalid size, must be integer greater than or equal to 0 or None")
+        # write everything held in memory, so only the file needs to change
+        if self.__chunk_modified:
+            self.__write_chunk()
+        self.__flush_chunks()
+        self.__chunk = None
+        self.__discard_prefetched(list(self.__prefetched))
+        old_size = self.__get_file_size()
+        if size == old_size:
+            return size
+        last_chunk = max(size-1, 0)//self.__data_chunksize
+        keep = size - last_chunk*self.__data_chunksize # bytes of data in the new last chunk
+        kept = last_chunk+1 if size else 0 # chunks that still hold data, an empty file's only chunk is all padding
+        if size < old_size:
+            for chunk in [chunk for chunk in self.__cache if chunk >= kept]:
+                self.__cache_discard(chunk)
+            if 0 < keep < self.__data_chunksize: # the data after the new end must be replaced by zeros
+                data = self.__decrypt_chunk(last_chunk, self.__read_token(last_chunk))
+                data = data[:keep].ljust(self.__data_chunksize, b"\0")
+                self.__store_chunk(last_chunk, data, self.__cipher.encrypt(last_chunk, data))
+        # when the file grows, the padding of the old last chunk is already zeros
+        if size > old_size and self.__index is None:
+            self.__write_holes(range(self.__chunks_on_disk, last_chunk+1))
+        self.__last_chunk, self.__last_chunk_padding = last_chunk, self.__data_chunksize-keep
+        self.__metadata_modified = True
+        self.__write_metadata()
+        if self.__index is None:
+            self.__truncate_file(self.__chunk_offset(last_chunk+1) if size else self.__header_size)
+            self.__chunks_on_disk = min(self.__chunks_on_disk, kept)
+            self.__preallocated = False
+        elif size < old_size: # the index is written after the last chunk that's left
+            del self.__index[kept:]
+            self.__data_end = max((offset+token_size for offset, token_size in self.__index if token_size), default=self.__header_size)
+            self.__free = [(start, min(end, self.__data_end)) for start, end in self.__free if start < self.__data_end]
+            self.__index_modified = True
+            self.__write_index()
+        return size
+
+    def preallocate(self, size: int) -> bool:
+        '''Allocates the disk space a file holding `size` bytes of data will take up, with `os.posix_fallocate`, so that the chunks written later aren't fragmented. Returns True if space was allocated.
+
+Parameters:
+
+- size - The number of bytes of data you expect the file to hold. The space is worked out from the chunksize, the size of each encrypted chunk and the size of the header.
+
+The file is extended past its last chunk until it's closed, when any space that hasn't been used is released. Nothing is allocated if the file already takes up that much space, or for compressed files, whose size can't be worked out in advance, and memory-mapped files, which grow in steps of `fernet_files.MMAP_GROWTH` bytes.\nReturns False if the file isn't a regular file on disk or the OS or filesystem doesn't support it. Raises OSError if there isn't enough space.'''
+        if not self.writeable:
+            raise UnsupportedOperation("preallocate")
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not isinstance(size, int):
+            raise TypeError("Invalid size, must be integer greater than or equal to 0")
+        if size < 0:
+            raise ValueError("Invalid size, must be integer greater than or equal to 0")
+        if self.__index is not None or self.__map is not None or self.__fileno is None:
+            return False
+        end = self.__chunk_offset(-(-size//self.__data_chunksize)) # round up
+        self.__file.flush()
+        disk_size = os.fstat(self.__fileno).st_size
+        if end <= disk_size or not _preallocate(self.__fileno, disk_size, end-disk_size):
+            return False
+        self.__preallocated = True
+        return True
+
+    def __release_preallocation(self) -> None:
+        '''Truncates a file extended by `preallocate` to the end of its last chunk, releasing the space that hasn't been used, so the size of the file matches its header again.'''
+        if self.__preallocated:
+            self.__file.truncate(self.__chunk_offset(self.__last_chunk+1) if self.__get_file_size() else self.__header_size)
+            self.__preallocated = False
+
+    def verify(self, workers: int | None = None, callback: Callable[[int, int], None] | None = None) -> list[int]:
+        '''Checks that every chunk in the file is valid without returning any data, and returns a list of the numbers of the chunks that aren't. Any data held in memory is written first.
+
+Parameters:
+
+- workers - The number of threads used to check chunks in parallel. Defaults to `None`, which uses one thread per CPU.
+- callback - Called as `callback(chunk, size)` on the calling thread after each chunk has been checked, in order, with the number of the chunk and the size of its token on disk, for example to show progress. Defaults to `None`.
+
+Chunks are read on the calling thread a few at a time and checked on a thread pool while the next ones are read, so memory usage doesn't depend on the size of the file. For "fernet" files only the HMAC of each chunk is checked, nothing is decrypted. Holes are valid, but a chunk that has been zeroed or cut off is reported unless it starts with a valid hole token.\nRaises ValueError if the header doesn't match the size of the file, for example if the file has been truncated.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        elif not isinstance(workers, int):
+            raise TypeError("Invalid number of workers, must be integer greater than 0 or None")
+        elif workers <= 0:
+            raise ValueError("Invalid number of workers, must be integer greater than 0 or None")
+        if callback is not None and not callable(callback):
+            raise TypeError("Invalid callback, must be callable or None")
+        # write everything held in memory, so only the file needs to be checked
+        if self.writeable:
+            if self.__chunk_modified:
+                self.__write_chunk()
+            self.__flush_chunks()
+            self.__release_preallocation()
+
+        # the header must describe exactly the chunks in the file
+        trailer_size = META_SIZE*2 if self.__trailer else 0
+        disk_size = self.__map_end if self.__map is not None else self.__file.seek(0, os.SEEK_END)
+        # version 1 files whose data ended on a chunk boundary were written with an extra last chunk that is all padding
+        if self.__last_chunk_padding > self.__data_chunksize or (self.__header.version > 1 and self.__last_chunk and self.__last_chunk_padding == self.__data_chunksize):
+            raise ValueError("Invalid metadata, the last chunk's padding is too large")
+        if self.__index is not None: # compressed chunks can be anywhere before the index
+            if len(self.__index) > self.__last_chunk+1 or any(size and (offset < self.__header_size or offset+size > self.__data_end) for offset, size in self.__index):
+                raise ValueError("Invalid index, it describes chunks outside the file")
+        elif not self.__get_file_size() and disk_size == self.__header_size+trailer_size:
+            return [] # a file with no data doesn't need any chunks
+        elif disk_size != self.__chunk_offset(self.__last_chunk+1)+trailer_size:
+            raise ValueError(f"Invalid metadata, the file is {disk_size} bytes but its header describes {self.__chunk_offset(self.__last_chunk+1)+trailer_size} bytes")
+
+        if callback is None:
+            return [chunk for chunk, valid in self.__map_chunks(self.__verify_chunk, workers) if not valid]
+        bad = []
+        for chunk, valid in self.__map_chunks(self.__verify_chunk, workers):
+            if not valid:
+                bad.append(chunk)
+            if self.__index is None:
+                callback(chunk, self.__chunksize)
+            else: # chunks that aren't in the index are holes with no token
+                callback(chunk, self.__index[chunk][1] if chunk < len(self.__index) else 0)
+        return bad
+
+    def __verify_chunk(self, chunk: int, token: bytes) -> bool:
+        '''Returns True if the token of a chunk read from the file is valid or is a hole. A chunk that's all zeros or missing isn't valid unless it's a hole.'''
+        return token is None or self.__cipher.verify(chunk, token) or self.__cipher.is_hole(chunk, token)
+
+    def __map_chunks(self, function: Callable[[int, bytes], object], workers: int) -> Iterator[tuple[int, object]]:
+        '''Calls `function(chunk, token)` for every chunk in the file on a thread pool of `workers` threads, and yields each chunk number with the result, in order.
+Chunks are read on the calling thread a few at a time, and the next ones are read while the previous ones are being checked, so memory usage doesn't depend on the size of the file.'''
+        chunks, batch_size = self.__last_chunk+1, workers*4
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = None # the previous batch is checked while the next one is read
+            for start in range(0, chunks, batch_size):
+                batch = range(start, min(start+batch_size, chunks))
+                results = executor.map(function, batch, [self.__read_token(chunk) for chunk in batch])
+                if pending is not None:
+                    yield from zip(*pending)
+                pending = batch, results
+            if pending is not None:
+                yield from zip(*pending)
+
+    def changed_since(self, since: int | float, workers: int | None = None) -> list[int]:
+        '''Returns a list of the numbers of the chunks that were written at or after the time `since`, without decrypting anything. Any data held in memory is written first.
+
+Parameters:
+
+- since - A time in seconds since the epoch, such as the result of `time.time()` when a backup was last taken. Chunks record the time to the second, so chunks written in the same second as `since` are included.
+- workers - The number of threads used to check chunks in parallel. Defaults to `None`, which uses one thread per CPU.
+
+The time is read from each chunk's token after checking its HMAC, so it can't have been changed without the key. Holes are included if they were made at or after `since`, because their hole token records when they were made.\nRaises ValueError if the file doesn't use the "fernet" cipher, because AEAD tokens don't record when they were written, and `cryptography.fernet.InvalidToken` if a chunk is invalid.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not isinstance(since, (int, float)):
+            raise TypeError("Invalid since, must be a number of seconds since the epoch")
+        if self.__header.cipher != "fernet":
+            raise ValueError(f"Only files encrypted with fernet record when chunks were written, file is encrypted with {self.__header.cipher}")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        elif not isinstance(workers, int):
+            raise TypeError("Invalid number of workers, must be integer greater than 0 or None")
+        elif workers <= 0:
+            raise ValueError("Invalid number of workers, must be integer greater than 0 or None")
+        if self.writeable:
+            if self.__chunk_modified:
+                self.__write_chunk()
+            self.__flush_chunks()
+        if not self.__get_file_size():
+            return []
+        return [chunk for chunk, timestamp in self.__map_chunks(self.__chunk_timestamp, workers) if timestamp is not None and timestamp >= int(since)]
+
+    def __chunk_timestamp(self, chunk: int, token: bytes) -> int | None:
+        '''Returns the time the token of a chunk read from the file was encrypted, or `None` if the chunk isn't in the index of a compressed file. The time a hole was made is read from its hole token.'''
+        return None if token is None else self.__cipher.timestamp(chunk, token)
+
     def seek(self, *args, whence: int = os.SEEK_SET) -> int:
         '''Can be called as:
 - seek(self, offset, whence)
@@ -140,25 +1020,25 @@ Parameters:
         else:
             offset = args[0]
 
-        original = self._chunk_pointer, self._pos_pointer
-
-        try:
-            if whence == os.SEEK_SET or whence == 0:
-                self._chunk_pointer = 0
-                self._pos_pointer = offset
-            elif whence == os.SEEK_CUR or whence == 1:
-                self._pos_pointer += offset
-            elif whence == os.SEEK_END or whence == 2:
-                size = self.__get_file_size()
-                self._chunk_pointer = 0
-                self._pos_pointer = size + offset
-            else:
-                raise ValueError("Invalid whence")
-        except OSError:
-            self._chunk_pointer, self._pos_pointer = original
+        if whence == os.SEEK_SET or whence == 0:
+            position = offset
+        elif whence == os.SEEK_CUR or whence == 1:
+            position = self._pos_pointer + self._chunk_pointer*self.__data_chunksize + offset
+        elif whence == os.SEEK_END or whence == 2:
+            position = self.__get_file_size() + offset
+        else:
+            raise ValueError("Invalid whence")
+        if position < 0:
+            try:
+                self.__file.seek(position) # raise the same exception as the underlying file would
+            except OSError:
+                pass
             raise OSError("Invalid seek value")
 
-        return self._pos_pointer + self._chunk_pointer*self.__data_chunksize
+        # no chunks are read or decrypted until data is needed
+        chunk, self.__pos_pointer = divmod(position, self.__data_chunksize)
+        self._chunk_pointer = chunk
+        return position
 
     def read(self, size: int = -1) -> bytes:
         '''Reads the number of bytes specified and returns them.
@@ -172,103 +1052,125 @@ Parameters:
         if not isinstance(size, int):
             raise TypeError("Size must be an integer")
         if size < 0:
-            self.__write_chunk() # refreshes values for last chunk
             size = self.__get_file_size() - self._pos_pointer - self._chunk_pointer*self.__data_chunksize
+        return b"".join(self.__read_views(size))
 
-        self.__read_chunk()
-        if size <= self.__data_chunksize-self._pos_pointer: # if all wanted data is in current chunk
-            self.__chunk.seek(self._pos_pointer)
-            data = self.__chunk.read(size)
-            self._pos_pointer += size
-        else: # else: read until start of next chunk
-            # read in the current chunk
-            data = bytearray()
-            read_size = self.__data_chunksize-self._pos_pointer
-            self.__chunk.seek(self._pos_pointer)
-            data += self.__chunk.read(read_size)
-            self._pos_pointer = 0
-            self._chunk_pointer += 1
-            size -= read_size
-            # loop, reading all the data in each chunk
-            while size >= self.__data_chunksize:
-                data += self.__read_chunk().getvalue()
-                size -= self.__data_chunksize
-                self._chunk_pointer += 1
-            # partially read the last chunk
-            if size:
-                data += self.__read_chunk().read(size)
-                self._pos_pointer = size
-
-        # For some reason if you read to the end of a file in python, the pointer should be at the end of the file
-        # Original implementation puts the pointer at the distance specified by the read argument, this fixes that
-        filesize = self.__get_file_size()
-        if self._pos_pointer + self._chunk_pointer*self.__data_chunksize >= filesize:
-            self.__chunk_pointer = 0
-            self._pos_pointer = self.__get_file_size()
-
-        return bytes(data)
-
-    def write(self, b: bytes) -> int:
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        '''Reads data directly into a pre-allocated, writable bytes-like object, and returns the number of bytes read.
+
+Parameters:
+
+- buffer - A writable bytes-like object, such as a `bytearray` or a `memoryview`. Up to `len(buffer)` bytes are read.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        try:
+            buffer = memoryview(buffer).cast("B")
+        except TypeError:
+            raise TypeError("Buffer must be a writable bytes-like object")
+        size = 0
+        for view in self.__read_views(len(buffer)):
+            buffer[size:size+len(view)] = view
+            size += len(view)
+        return size
+
+    def readinto1(self, buffer: bytearray | memoryview) -> int:
+        '''The same as `readinto`, but reads no further than the end of the current chunk, so at most one chunk is decrypted.
+
+Parameters:
+
+- buffer - A writable bytes-like object, such as a `bytearray` or a `memoryview`.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        try:
+            buffer = memoryview(buffer).cast("B")
+        except TypeError:
+            raise TypeError("Buffer must be a writable bytes-like object")
+        return self.readinto(buffer[:self.__data_chunksize-self._pos_pointer])
+
+    def __read_views(self, size: int):
+        '''Generator that moves forward through the file by `size` bytes, or until the end of the file, yielding a memoryview of the decrypted data in each chunk it passes through. Chunks that haven't been loaded are decrypted in batches.\nThe data is not copied, so each memoryview must be used before the generator is resumed.'''
+        position = self._pos_pointer + self._chunk_pointer*self.__data_chunksize
+        size = max(min(size, self.__get_file_size() - position), 0) # stop at the end of the file
+        try:
+            while size:
+                read_size = min(size, self.__data_chunksize-self._pos_pointer)
+                if read_size < size and self.__chunk is None and self._chunk_pointer not in self.__batch:
+                    self.__decrypt_batch(size)
+                yield memoryview(self.__read_chunk())[self._pos_pointer:self._pos_pointer+read_size]
+                size -= read_size
+                self._pos_pointer += read_size # moves to the next chunk at the end of this one
+        finally:
+            self.__batch.clear() # only used by this read, the chunks may be written afterwards
+
+    def write(self, b: bytes | bytearray | memoryview) -> int:
         '''Writes the given bytes. Returns the number of bytes written.
 
 Parameters:
 
-- b - The bytes to be written.'''
+- b - The bytes to be written. Any bytes-like object is accepted, such as `bytes`, `bytearray` or `memoryview`.'''
         if not self.writeable:
             raise UnsupportedOperation("write")
         if self.closed:
             raise ValueError("I/O operation on closed file")
         # data validation
-        if not isinstance(b, bytes):
-            raise TypeError("Data must be bytes")
+        try:
+            b = memoryview(b).cast("B")
+        except TypeError:
+            raise TypeError("Data must be a bytes-like object")
+        if self.__append:
+            self.seek(0, os.SEEK_END)
         size = len(b)
-        return_value = size
-
-        if size < self.__data_chunksize-self._pos_pointer: # if all data fits in current chunk
-            if self.__chunk is not None:
-                self.__chunk.seek(self._pos_pointer)
-                self.__chunk.write(b)
+        written = 0
+        while written < size:
+            # encrypt whole chunks in parallel
+            if self.__workers is not None and self._pos_pointer == 0 and size-written >= self.__data_chunksize*2:
+                count = (size-written)//self.__data_chunksize
+                self.__chunk_modified = False # the current chunk is about to be overwritten
+                self.__write_full_chunks(self._chunk_pointer, b[written:written+count*self.__data_chunksize], count)
+                written += count*self.__data_chunksize
+                self._chunk_pointer += count
+                continue
+            write_size = min(size-written, self.__data_chunksize-self._pos_pointer)
+            if write_size == self.__data_chunksize: # replace the whole chunk
+                self.__chunk = bytes(b[written:written+write_size])
+                self.__chunk_modified = True
             else:
-                self.__chunk = BytesIO(b)
-            self._pos_pointer += size
-            self.__chunk_modified = True
-            return size
-        # else: write until start of next chunk. else omitted for indent readability
-        # write in the current chunk
-        b = BytesIO(b)
-        write_size = self.__data_chunksize-self._pos_pointer
-        if self.__chunk is not None:
-            self.__chunk.seek(self._pos_pointer)
-            self.__chunk.write(b.read(write_size))
-        else:
-            self.__chunk = BytesIO(b.read(write_size))
-        self._pos_pointer = 0
+                self.__write_into_chunk(b[written:written+write_size])
+            written += write_size
+            self._pos_pointer += write_size # moves to the next chunk at the end of this one
+        return size
+
+    def __write_into_chunk(self, b: memoryview) -> None:
+        '''Writes `b` into the current chunk at the position pointer, without moving it. If the position is past the end of the chunk's data, the gap is filled with null bytes.'''
+        if not isinstance(self.__chunk, bytearray):
+            self.__chunk = bytearray(self.__read_chunk())
+        if len(self.__chunk) < self._pos_pointer:
+            self.__chunk.extend(bytes(self._pos_pointer-len(self.__chunk)))
+        self.__chunk[self._pos_pointer:self._pos_pointer+len(b)] = b
         self.__chunk_modified = True
-        size -= write_size
-        # loop, writing full chunks
-        while size >= self.__data_chunksize:
-            self._chunk_pointer += 1
-            self.__chunk = BytesIO(b.read(self.__data_chunksize))
-            self.__chunk_modified = True
-            size -= self.__data_chunksize
-        # partially write the last chunk
-        if size:
-            self._chunk_pointer += 1
-            self.__chunk = self.__read_chunk()
-            self.__chunk.seek(0)
-            self.__chunk.write(b.read(size))
-            self._pos_pointer = size
-            self.__chunk_modified = True
-        return return_value
     
     def close(self) -> BytesIO | None:
         '''Writes all outstanding data closes the file.\nReturns `None` unless the file is a `BytesIO` object, in which case it returns the object without closing it.'''
         # write data stored in memory
-        try: self.__write_chunk()
+        try:
+            if self.__chunk_modified:
+                self.__write_chunk()
+            self.__flush_chunks()
+            self.__write_index()
+            if self.__index is not None:
+                self.__reclaim_free_space()
+            self.__release_preallocation()
         except: pass
         # mark as closed
         self.closed = True
         try:
+            if self.__stats is not None:
+                self.__discard_prefetched(list(self.__prefetched)) # anything decrypted in advance is now wasted
+                instrumentation.unregister(self, self.stats())
+            if self.__executor is not None:
+                # __del__ can run on one of the executor's threads when a task held the last reference, and a thread can't wait for itself to finish
+                self.__executor.shutdown(wait=threading.get_ident() not in self.__pool_threads, cancel_futures=True)
+            self.__close_map()
             # if file is BytesIO, return it, otherwise close the file
             if isinstance(self.__file, BytesIO):
                 return self.__file
@@ -282,6 +1184,33 @@ Parameters:
     generate_key = FernetNoBase64.generate_key
     '''Static method used to generate a key. Acts as a pointer to `custom_fernet.FernetNoBase64.generate_key()`.'''
 
+    @staticmethod
+    def auto_chunksize(expected_size: int | None = None, access: str | None = None) -> int:
+        '''Returns the chunksize used for a new file when `chunksize="auto"`. Chunksizes are powers of 2 between these limits, aiming for roughly this many chunks:
+
+- "random" - 4KiB to 64KiB, around 256 chunks. Small chunks mean reading a few bytes only decrypts a few bytes. 4KiB if `expected_size` is `None`.
+- "sequential" and "noreuse" - 64KiB to 4MiB, around 16 chunks. Big chunks have less overhead per byte. 1MiB if `expected_size` is `None`.
+- `None` - 16KiB to 1MiB, around 64 chunks. 64KiB (the default chunksize) if `expected_size` is `None`.
+
+If `expected_size` is smaller than the chunksize, the file will be a single chunk, so `expected_size` rounded up to a multiple of 16 is returned instead to avoid padding.'''
+        smallest, largest, chunks, default = {
+            "random": (4096, 65536, 256, 4096),
+            "sequential": (65536, 4_194_304, 16, 1_048_576),
+            "noreuse": (65536, 4_194_304, 16, 1_048_576),
+            None: (16384, 1_048_576, 64, DEFAULT_CHUNKSIZE),
+        }[access]
+        if expected_size is None:
+            return default
+        chunksize = min(max(1 << max(expected_size//chunks-1, 0).bit_length(), smallest), largest) # round up to a power of 2
+        if expected_size < chunksize:
+            return max(-(-expected_size//16)*16, 16)
+        return chunksize
+
+    @property
+    def chunksize(self) -> int:
+        '''The size of chunks in bytes. Read only.'''
+        return self.__data_chunksize
+
     def __enter__(self) -> "FernetFile":
         '''Returns self to allow context management.'''
         return self
@@ -316,12 +1245,56 @@ Parameters:
 
     @property
     def _chunk_pointer(self) -> int:
-        '''Stores the Fernet file's current chunk number.\nThe getter returns `self.__chunk_pointer`.\nThe setter modifies this value. Before it switching chunks it checks if the current chunk has been modified and writes it if it has. After switching chunks, we read the new chunk into memory.'''
+        '''Stores the Fernet file's current chunk number.\nThe getter returns `self.__chunk_pointer`.\nThe setter modifies this value. Before it switching chunks it checks if the current chunk has been modified and writes it if it has. The new chunk isn't read until its data is needed. Setting the current chunk number does nothing.'''
         return self.__chunk_pointer
     
     @_chunk_pointer.setter
     def _chunk_pointer(self, value: int) -> None:
         # write a chunk only if it's been modified
+        if value == self.__chunk_pointer:
+            return
         if self.__chunk_modified: self.__write_chunk()
         self.__chunk_pointer = value
-        self.__read_chunk()
\ No newline at end of file
+        self.__chunk = None # read lazily by __read_chunk
+
+def verify(file: str | RawIOBase | BufferedIOBase, key: bytes | FernetNoBase64, chunksize: int | None = None, workers: int | None = None, callback: Callable[[int, int], None] | None = None) -> list[int]:
+    '''Checks that every chunk in an encrypted file is valid without returning any data, and returns a list of the numbers of the chunks that aren't. See `FernetFile.verify`.
+
+Parameters:
+
+- file - A filename as a string, or a file-like object. A filename is opened read-only, so the file isn't modified.
+- key - The same as `FernetFile`.
+- chunksize - The same as `FernetFile`. Only needs to be given for version 1 files that don't use the default chunksize.
+- workers - The number of threads used to check chunks in parallel. Defaults to `None`, which uses one thread per CPU.
+- callback - The same as `FernetFile.verify`.
+
+Raises ValueError if the header doesn't match the size of the file.'''
+    if isinstance(file, str):
+        file = open(file, "rb")
+    with FernetFile(key, file, chunksize) as fernet_file:
+        return fernet_file.verify(workers, callback)
+
+def changed_since(file: str | RawIOBase | BufferedIOBase, key: bytes | FernetNoBase64, since: int | float, chunksize: int | None = None, workers: int | None = None) -> list[int]:
+    '''Returns a list of the numbers of the chunks of an encrypted file that were written at or after the time `since`, without decrypting anything. See `FernetFile.changed_since`.
+
+Parameters:
+
+- file - A filename as a string, or a file-like object. A filename is opened read-only, so the file isn't modified.
+- key - The same as `FernetFile`.
+- since - A time in seconds since the epoch.
+- chunksize - The same as `FernetFile`. Only needs to be given for version 1 files that don't use the default chunksize.
+- workers - The number of threads used to check chunks in parallel. Defaults to `None`, which uses one thread per CPU.
+
+Raises ValueError if the file doesn't use the "fernet" cipher, and `cryptography.fernet.InvalidToken` if a chunk is invalid.'''
+    if isinstance(file, str):
+        file = open(file, "rb")
+    with FernetFile(key, file, chunksize) as fernet_file:
+        return fernet_file.changed_since(since, workers)
+
+from fernet_files.async_file import AsyncFernetFile # imported last because it uses FernetFile
+from fernet_files.streaming import encrypt_stream, decrypt_stream # imported last because it uses the constants above
+from fernet_files.reader import FernetReader # imported last because it uses the constants above
+from fernet_files.rewrap import rewrap # imported last because it uses the constants above
+from fernet_files.archive import FernetArchive, MemberInfo # imported last because it uses FernetFile
+from fernet_files.sync import sync # imported last because it uses the constants above
+from fernet_files.tree import encrypt_tree, decrypt_tree, FileResult, TreeResult # imported last because it uses FernetFile
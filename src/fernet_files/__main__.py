@@ -0,0 +1,6 @@
+'''Runs the command line interface with `python -m fernet_files`. See `fernet_files.cli`.'''
+
+import sys
+from fernet_files.cli import main
+
+sys.exit(main())
@@ -0,0 +1,287 @@
+'''Encrypted archives of many small files
+
+Every `FernetFile` is at least one chunk and a header on disk, and opening one costs a file handle and a header read, so storing lots of small files as separate `FernetFile`s wastes space and time.
+`FernetArchive` packs many named members into a single `FernetFile`, one after another, so small members share chunks.
+The data of the `FernetFile` ends with an index of the name, position and size of every member, followed by the size of the index and `ARCHIVE_MAGIC`.
+The index is encrypted along with everything else, so the names of the members can't be read without the key.
+It's read once when the archive is opened, so opening a member is a single dictionary lookup.'''
+
+import os
+from collections import namedtuple
+from io import BytesIO, RawIOBase, BufferedIOBase
+from fernet_files import FernetFile
+from fernet_files.custom_fernet import FernetNoBase64
+
+ARCHIVE_MAGIC = b"FNFARC\x00\x01"
+'''The last bytes of the data of an archive, after the size of the index.'''
+
+MODES = ("r", "w", "a")
+'''The modes an archive can be opened in: read, write a new archive, and append to an existing archive.'''
+
+MemberInfo = namedtuple("MemberInfo", ("name", "offset", "size"))
+'''Returned by `FernetArchive.members()` and `FernetArchive.info()`. `offset` is the position of the member's data in the archive, and sizes are in bytes.'''
+
+def _pack_index(members: list[MemberInfo]) -> bytes:
+    '''Returns the bytes of an index: for each member, the size of its UTF-8 name in 2 bytes, the name, its offset and its size, little-endian.'''
+    index = bytearray()
+    for member in members:
+        name = member.name.encode()
+        index += len(name).to_bytes(2, "little")+name+member.offset.to_bytes(8, "little")+member.size.to_bytes(8, "little")
+    return bytes(index)
+
+def _unpack_index(index: bytes) -> dict[str, MemberInfo]:
+    '''Returns a dictionary of the members in an index by name, the opposite of `_pack_index`. Raises ValueError if the index is invalid.'''
+    members, position = {}, 0
+    try:
+        while position < len(index):
+            size = int.from_bytes(index[position:position+2], "little")
+            name = index[position+2:position+2+size].decode()
+            position += 2+size
+            if position+16 > len(index):
+                raise ValueError
+            members[name] = MemberInfo(name, int.from_bytes(index[position:position+8], "little"), int.from_bytes(index[position+8:position+16], "little"))
+            position += 16
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid archive, the index is damaged")
+    return members
+
+class ArchiveMember(RawIOBase):
+    '''A read-only, seekable view of one member of a `FernetArchive`, returned by `FernetArchive.open`. Reads go straight to the archive's `FernetFile`, so only the chunks holding the member's data are decrypted.\nAs a `io.RawIOBase`, it can be wrapped in `io.BufferedReader` and `io.TextIOWrapper`, and iterating over it gives lines.'''
+
+    def __init__(self, fernet_file: FernetFile, info: MemberInfo) -> None:
+        super().__init__()
+        self.__fernet_file = fernet_file
+        self.__info = info
+        self.__position = 0
+
+    @property
+    def name(self) -> str:
+        '''The name of the member. Read only.'''
+        return self.__info.name
+
+    @property
+    def size(self) -> int:
+        '''The size of the member in bytes. Read only.'''
+        return self.__info.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        '''Reads and returns up to `size` bytes of the member, or the rest of the member if `size` is negative or not specified.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        remaining = self.__info.size-self.__position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        if size <= 0:
+            return b""
+        self.__fernet_file.seek(self.__info.offset+self.__position)
+        data = self.__fernet_file.read(size)
+        self.__position += len(data)
+        return data
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        '''Reads bytes of the member into a writable bytes-like object and returns the number of bytes read, which is 0 at the end of the member.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(buffer).cast("B")[:max(self.__info.size-self.__position, 0)]
+        if not view:
+            return 0
+        self.__fernet_file.seek(self.__info.offset+self.__position)
+        read = self.__fernet_file.readinto(view)
+        self.__position += read
+        return read
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        '''Moves the position in the member, the same as `FernetFile.seek`, and returns the new position. The position can't go past the end of the member.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.__position+offset
+        elif whence == os.SEEK_END:
+            position = self.__info.size+offset
+        else:
+            raise ValueError("Invalid whence")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self.__position = min(position, self.__info.size)
+        return self.__position
+
+    def tell(self) -> int:
+        '''Returns the position in the member.'''
+        return self.__position
+
+class FernetArchive:
+    '''Parameters:
+
+- key - The same as `fernet_files.FernetFile`.
+- file - Accepts a filename as a string, or a file-like object opened in binary mode.
+- mode - One of `MODES`. "r" reads an existing archive, and a filename is opened read-only. "w" creates a new archive, replacing anything already in the file. "a" adds members to an existing archive, or creates one if the file is empty or doesn't exist. Defaults to "r".
+- Any other keyword arguments are passed to `fernet_files.FernetFile`, for example `chunksize`, `compression` or `read_ahead`.
+
+Members are added to the end of the archive, and the index is written when the archive is closed. An archive that has been added to can't be opened again until it has been closed.
+Like `FernetFile`, an archive and the members opened from it can't be used by two threads at once.'''
+
+    def __init__(self, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, mode: str = "r", **kwargs) -> None:
+        self.__fernet_file = None
+        if not isinstance(mode, str):
+            raise TypeError("Invalid mode, must be one of "+", ".join(MODES))
+        if mode not in MODES:
+            raise ValueError("Invalid mode, must be one of "+", ".join(MODES))
+        self.__mode = mode
+        if isinstance(file, str) and mode != "a": # FernetFile opens filenames for reading and writing
+            file = open(file, "rb" if mode == "r" else "wb+")
+        elif mode == "w" and isinstance(file, (RawIOBase, BufferedIOBase)):
+            file.seek(0)
+            file.truncate()
+        self.__fernet_file = FernetFile(key, file, **kwargs)
+        if mode != "r" and not self.__fernet_file.writeable:
+            raise ValueError(f"Archives opened with mode \"{mode}\" must be writeable")
+        self.__modified = False
+
+        # read the index
+        self.__members = {}
+        self.__end = self.__fernet_file.seek(0, os.SEEK_END) # where the index starts, and where new members are written
+        if self.__end: # an empty file is an empty archive
+            footer_size = 8+len(ARCHIVE_MAGIC)
+            if self.__end < footer_size:
+                raise ValueError("Invalid archive, file is too short")
+            self.__fernet_file.seek(self.__end-footer_size)
+            footer = self.__fernet_file.read(footer_size)
+            if footer[8:] != ARCHIVE_MAGIC:
+                raise ValueError("Invalid archive, the index is missing")
+            index_size = int.from_bytes(footer[:8], "little")
+            if index_size > self.__end-footer_size:
+                raise ValueError("Invalid archive, the index is damaged")
+            self.__end -= footer_size+index_size
+            self.__fernet_file.seek(self.__end)
+            self.__members = _unpack_index(self.__fernet_file.read(index_size))
+
+    def __check(self, writing: bool = False) -> None:
+        '''Raises ValueError if the archive is closed, or if `writing` and the archive was opened with mode "r".'''
+        if self.closed:
+            raise ValueError("I/O operation on closed archive")
+        if writing and self.__mode == "r":
+            raise ValueError("Archive was opened with mode \"r\"")
+
+    @property
+    def closed(self) -> bool:
+        '''True if the archive has been closed. Read only.'''
+        return self.__fernet_file is None or self.__fernet_file.closed
+
+    def members(self) -> list[MemberInfo]:
+        '''Returns a list of `MemberInfo` named tuples of every member, in the order they were added.'''
+        self.__check()
+        return list(self.__members.values())
+
+    def info(self, name: str) -> MemberInfo:
+        '''Returns the `MemberInfo` named tuple of a member. Raises KeyError if there is no member called `name`.'''
+        self.__check()
+        return self.__members[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__members
+
+    def __len__(self) -> int:
+        return len(self.__members)
+
+    def add(self, name: str, data: bytes | bytearray | memoryview | RawIOBase | BufferedIOBase) -> MemberInfo:
+        '''Adds a member to the end of the archive and returns its `MemberInfo`.
+
+Parameters:
+
+- name - The name of the member, a non-empty string. Names are used as paths by `extract`, with "/" between directories.
+- data - A bytes-like object, or a file-like object opened in binary mode, which is read to its end a few chunks at a time.
+
+Raises ValueError if there is already a member called `name`.'''
+        self.__check(writing=True)
+        if not isinstance(name, str):
+            raise TypeError("Member name must be a string")
+        if not name or len(name.encode()) > 65535:
+            raise ValueError("Invalid member name, must be between 1 and 65535 bytes in UTF-8")
+        if name in self.__members:
+            raise ValueError(f"Duplicate member name {name!r}")
+        self.__fernet_file.seek(self.__end)
+        self.__modified = True # the index is overwritten by the new member
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = self.__fernet_file.write(data)
+        elif isinstance(data, (RawIOBase, BufferedIOBase)):
+            size, block = 0, self.__fernet_file.chunksize*4
+            while chunk := data.read(block):
+                size += self.__fernet_file.write(chunk)
+        else:
+            raise TypeError("Data must be a bytes-like object or a binary file")
+        self.__members[name] = info = MemberInfo(name, self.__end, size)
+        self.__end += size
+        return info
+
+    def open(self, name: str) -> ArchiveMember:
+        '''Returns a read-only `ArchiveMember` view of a member. Raises KeyError if there is no member called `name`.'''
+        self.__check()
+        return ArchiveMember(self.__fernet_file, self.__members[name])
+
+    def read(self, name: str) -> bytes:
+        '''Returns all of the data of a member. Raises KeyError if there is no member called `name`.'''
+        with self.open(name) as member:
+            return member.read()
+
+    def extract(self, name: str, path: str = ".") -> str:
+        '''Decrypts a member to a file inside the directory `path`, creating directories as needed, and returns the path of the file.\nRaises ValueError if the member's name would put the file outside `path`, for example if it starts with "/" or contains "..".'''
+        self.__check()
+        return self.__extract(self.__members[name], path, bytearray(self.__fernet_file.chunksize*4))
+
+    def extractall(self, path: str = ".", members: list[str] | None = None) -> list[str]:
+        '''Decrypts every member, or the members named in `members`, to files inside the directory `path`, and returns the paths of the files.\nMembers are extracted in the order their data is stored, so the archive is read from start to end, and read-ahead can decrypt the next chunks in the background.'''
+        self.__check()
+        infos = self.__members.values() if members is None else [self.__members[name] for name in members]
+        buffer = bytearray(self.__fernet_file.chunksize*4)
+        return [self.__extract(info, path, buffer) for info in sorted(infos, key=lambda info: info.offset)]
+
+    def __extract(self, info: MemberInfo, path: str, buffer: bytearray) -> str:
+        '''Decrypts a member to a file inside `path` using `buffer`, and returns the path of the file.'''
+        root = os.path.realpath(path)
+        target = os.path.realpath(os.path.join(root, *info.name.split("/")))
+        try:
+            inside = os.path.commonpath((root, target)) == root and target != root
+        except ValueError: # on different drives
+            inside = False
+        if not inside:
+            raise ValueError(f"Unsafe member name {info.name!r}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        view = memoryview(buffer)
+        with ArchiveMember(self.__fernet_file, info) as member, open(target, "wb") as f:
+            while read := member.readinto(view):
+                f.write(view[:read])
+        return target
+
+    def close(self) -> BytesIO | None:
+        '''Writes the index if any members have been added, then closes the archive's `FernetFile`.\nReturns `None` unless the file is a `BytesIO` object, in which case it returns the object without closing it.'''
+        if self.closed:
+            return None
+        if self.__modified:
+            index = _pack_index(list(self.__members.values()))
+            self.__fernet_file.seek(self.__end)
+            self.__fernet_file.write(index+len(index).to_bytes(8, "little")+ARCHIVE_MAGIC)
+            self.__fernet_file.truncate()
+            self.__modified = False
+        return self.__fernet_file.close()
+
+    def __enter__(self) -> "FernetArchive":
+        '''Returns self to allow context management.'''
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        '''Calls `self.close` and returns `None`.'''
+        self.close()
+
+    def __del__(self) -> None:
+        '''Calls `self.close` and returns `None`.'''
+        try:
+            self.close()
+        except AttributeError: # closed before the file was validated
+            pass
@@ -0,0 +1,110 @@
+'''asyncio interface to `fernet_files.FernetFile`
+
+Every operation on a `FernetFile` encrypts, decrypts, reads or writes whole chunks, which can block for a long time.
+`AsyncFernetFile` runs these operations on an executor so that the event loop is free while they happen.'''
+
+import asyncio
+import os
+from concurrent.futures import Executor
+from functools import partial
+from io import BytesIO, RawIOBase, BufferedIOBase
+from typing import AsyncIterator
+from fernet_files import FernetFile
+from fernet_files.custom_fernet import FernetNoBase64
+
+class AsyncFernetFile:
+    '''Parameters:
+
+- key - The same as `fernet_files.FernetFile`.
+- file - The same as `fernet_files.FernetFile`.
+- chunksize - The same as `fernet_files.FernetFile`.
+- executor - The `concurrent.futures.Executor` that operations are run on. Defaults to `None`, which uses the event loop's default executor.
+- read_ahead - The same as `fernet_files.FernetFile`, but defaults to 4 so that several chunks are decrypted at once while streaming.
+- Any other keyword arguments are passed to `fernet_files.FernetFile`, for example `workers` to encrypt chunks in parallel.
+
+Operations are run one at a time, in the order they were awaited, because a `FernetFile` can't be used by two threads at once.
+Opening a file reads its header, so nothing is opened here. The file is opened on the executor by `async with`, by `await AsyncFernetFile.open(...)`, or otherwise by the first operation.'''
+
+    def __init__(self, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, chunksize: int | str | None = None, executor: Executor | None = None, read_ahead: int = 4, **kwargs) -> None:
+        self.__open_file = partial(FernetFile, key, file, chunksize, read_ahead=read_ahead, **kwargs)
+        self.__fernet_file = None # set once the file has been opened
+        self.__executor = executor
+        self.__lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, chunksize: int | str | None = None, executor: Executor | None = None, read_ahead: int = 4, **kwargs) -> "AsyncFernetFile":
+        '''Creates an `AsyncFernetFile` with the same parameters and returns it once the file has been opened. Use this instead of `async with` when the file is closed by awaiting `close`.'''
+        self = cls(key, file, chunksize, executor, read_ahead, **kwargs)
+        async with self.__lock:
+            await self.__open()
+        return self
+
+    async def __open(self) -> FernetFile:
+        '''Opens the `FernetFile` on the executor if it hasn't been opened yet, and returns it. Must be called while holding `self.__lock`.'''
+        if self.__fernet_file is None:
+            self.__fernet_file = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__open_file)
+        return self.__fernet_file
+
+    async def __run(self, method: str, *args):
+        '''Runs the `FernetFile` method called `method` with `args` on the executor once every earlier operation has finished, and returns its result. The file is opened first if it hasn't been opened yet.'''
+        async with self.__lock:
+            fernet_file = await self.__open()
+            return await asyncio.get_running_loop().run_in_executor(self.__executor, getattr(fernet_file, method), *args)
+
+    @property
+    def closed(self) -> bool:
+        '''The same as `fernet_files.FernetFile.closed`. A file that hasn't been opened yet isn't closed.'''
+        return self.__fernet_file is not None and self.__fernet_file.closed
+
+    @property
+    def writeable(self) -> bool:
+        '''The same as `fernet_files.FernetFile.writeable`. Raises ValueError if the file hasn't been opened yet.'''
+        if self.__fernet_file is None:
+            raise ValueError("File hasn't been opened yet, use async with or await AsyncFernetFile.open")
+        return self.__fernet_file.writeable
+
+    async def read(self, size: int = -1) -> bytes:
+        '''Coroutine version of `fernet_files.FernetFile.read`.'''
+        return await self.__run("read", size)
+
+    async def readinto(self, buffer: bytearray | memoryview) -> int:
+        '''Coroutine version of `fernet_files.FernetFile.readinto`. The buffer must not be used until this has finished.'''
+        return await self.__run("readinto", buffer)
+
+    async def write(self, b: bytes | bytearray | memoryview) -> int:
+        '''Coroutine version of `fernet_files.FernetFile.write`. If `b` is mutable, it must not be modified until this has finished.'''
+        return await self.__run("write", b)
+
+    async def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        '''Coroutine version of `fernet_files.FernetFile.seek`.'''
+        return await self.__run("seek", offset, whence)
+
+    async def flush(self) -> None:
+        '''Coroutine version of `fernet_files.FernetFile.flush`.'''
+        await self.__run("flush")
+
+    async def close(self) -> BytesIO | None:
+        '''Coroutine version of `fernet_files.FernetFile.close`.'''
+        return await self.__run("close")
+
+    async def iter_chunks(self, size: int | None = None) -> AsyncIterator[bytes]:
+        '''Asynchronous generator that reads from the current position to the end of the file, yielding `size` bytes at a time. The last piece may be shorter.\nDefaults to the chunksize, so each piece needs at most one chunk to be decrypted.'''
+        if not size:
+            async with self.__lock:
+                size = (await self.__open()).chunksize
+        while data := await self.read(size):
+            yield data
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        '''Returns `self.iter_chunks()`, so the file can be used in an `async for` loop.'''
+        return self.iter_chunks()
+
+    async def __aenter__(self) -> "AsyncFernetFile":
+        '''Opens the file on the executor and returns self to allow asynchronous context management.'''
+        async with self.__lock:
+            await self.__open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        '''Awaits `self.close` and returns `None`.'''
+        await self.close()
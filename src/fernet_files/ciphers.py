@@ -0,0 +1,155 @@
+'''Ciphers used to encrypt individual chunks
+
+Version 1 files store every chunk as a Fernet token, which adds 73 bytes to each chunk and passes over the data twice (AES-CBC, then HMAC-SHA256).
+Version 2 files can instead use an AEAD cipher, which encrypts and authenticates in a single pass.
+Each chunk is stored as a 12 byte random nonce, the ciphertext and a 16 byte tag, so 28 bytes are added to each chunk and no block padding is needed.
+The number of the chunk is authenticated as associated data, so chunks can't be swapped with each other without it being detected.
+
+Every cipher has the same methods, so `FernetFile` doesn't need to know which one a file uses.
+
+Holes, chunks that have never been written, start with a short token from `encrypt_hole` and are zeros after it, so most of their space can stay sparse.
+Only a valid hole token is read as a chunk of zeros. A chunk that has been zeroed or cut off is invalid, like any other modified chunk.'''
+
+from os import urandom
+from typing import Sequence
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from fernet_files.custom_fernet import FernetNoBase64
+
+CIPHERS = ("fernet", "aes-gcm", "chacha20-poly1305")
+'''The names of the ciphers a chunk can be encrypted with. A cipher's number in a file's header is its index in this tuple.'''
+
+def _zeros_after(token: bytes | memoryview, start: int) -> bool:
+    '''Returns True if `token` has at least one byte after `start` and they are all zeros. Real tokens end with an HMAC or tag, so they are almost always rejected by their last byte.'''
+    return len(token) > start and token[-1] == 0 and not bytes(token[start:]).strip(b"\0")
+
+class FernetCipher:
+    '''Encrypts each chunk as a Fernet token. The chunk number isn't used. This is the only cipher version 1 files can use.'''
+
+    HOLE_SIZE = 73 # a Fernet token of no data
+
+    def __init__(self, fernet: FernetNoBase64) -> None:
+        self.fernet = fernet
+
+    @staticmethod
+    def token_size(chunksize: int) -> int:
+        '''Returns the size of a chunk when it's written to disk.'''
+        return FernetNoBase64.token_size(chunksize)
+
+    def encrypt(self, chunk: int, data: bytes) -> bytes:
+        '''Encrypts the data of chunk number `chunk` and returns the token.'''
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, chunk: int, token: bytes | memoryview) -> bytes:
+        '''Decrypts the token of chunk number `chunk`. Raises `cryptography.fernet.InvalidToken` if it is invalid.'''
+        if isinstance(token, memoryview): # read from a memory map, `decrypt` only accepts bytes
+            return self.fernet.decrypt_many((token,))[0]
+        return self.fernet.decrypt(token)
+
+    def encrypt_many(self, chunks: Sequence[int], data: Sequence[bytes]) -> list[bytes]:
+        '''Encrypts the data of several chunks at once and returns a list of the tokens.'''
+        return self.fernet.encrypt_many(data)
+
+    def decrypt_many(self, chunks: Sequence[int], tokens: Sequence[bytes]) -> list[bytes]:
+        '''Decrypts the tokens of several chunks at once and returns a list of the data. Raises `cryptography.fernet.InvalidToken` if any of them is invalid.'''
+        return self.fernet.decrypt_many(tokens)
+
+    def verify(self, chunk: int, token: bytes) -> bool:
+        '''Returns True if the token of chunk number `chunk` is valid. Only the HMAC is checked, so nothing is decrypted.'''
+        return self.fernet.verify(token)
+
+    def encrypt_hole(self, chunk: int) -> bytes:
+        '''Returns the token written at the start of a hole, which is a Fernet token of no data. The rest of the hole is zeros.'''
+        return self.fernet.encrypt(b"")
+
+    def is_hole(self, chunk: int, token: bytes | memoryview) -> bool:
+        '''Returns True if the token of chunk number `chunk` is a hole: a token from `encrypt_hole`, followed by zeros if the chunk's token is longer.'''
+        if len(token) == self.HOLE_SIZE: # chunks of less than 16 bytes have tokens of the same size, so a hole token is told apart by holding no data
+            try:
+                return self.fernet.decrypt_many((token,)) == [b""]
+            except InvalidToken:
+                return False
+        return _zeros_after(token, self.HOLE_SIZE) and self.fernet.verify(token[:self.HOLE_SIZE]) # larger chunks have longer tokens, so only the HMAC needs to be checked
+
+    def timestamp(self, chunk: int, token: bytes) -> int:
+        '''Returns the time chunk number `chunk` was encrypted, in seconds since the epoch, from its token. The time a hole was made is read from its hole token. The HMAC is checked first, so the time can be trusted. Raises `cryptography.fernet.InvalidToken` if the token is invalid.'''
+        if self.is_hole(chunk, token):
+            token = token[:self.HOLE_SIZE]
+        return self.fernet.extract_timestamp(bytes(token))
+
+class AEADCipher:
+    '''Encrypts each chunk with AES-256-GCM or ChaCha20-Poly1305.
+
+- key - The same 32 byte key used by `FernetNoBase64`, or a `FernetNoBase64` object.
+- cipher - "aes-gcm" or "chacha20-poly1305".
+- file_id - 16 random bytes stored in the file's header.
+
+The key used for the file is derived from the key and `file_id` with HKDF-SHA256, so each file has its own key and the key is never used directly by two different ciphers.'''
+
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    HOLE_SIZE = NONCE_SIZE + TAG_SIZE # a nonce and the tag of no data
+
+    def __init__(self, key: bytes | FernetNoBase64, cipher: str, file_id: bytes) -> None:
+        if isinstance(key, FernetNoBase64):
+            key = key._signing_key + key._encryption_key
+        file_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=file_id, info=b"fernet_files " + cipher.encode()).derive(key)
+        self.aead = AESGCM(file_key) if cipher == "aes-gcm" else ChaCha20Poly1305(file_key)
+
+    @classmethod
+    def token_size(cls, chunksize: int) -> int:
+        '''Returns the size of a chunk when it's written to disk.'''
+        return cls.NONCE_SIZE + chunksize + cls.TAG_SIZE
+
+    def encrypt(self, chunk: int, data: bytes) -> bytes:
+        '''Encrypts the data of chunk number `chunk` and returns the nonce, followed by the ciphertext and tag.'''
+        nonce = urandom(self.NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, data, chunk.to_bytes(8, "little"))
+
+    def decrypt(self, chunk: int, token: bytes | memoryview) -> bytes:
+        '''Decrypts the token of chunk number `chunk`. Raises `cryptography.fernet.InvalidToken` if it is invalid, too short, or if it belongs to a different chunk.'''
+        if len(token) < self.HOLE_SIZE:
+            raise InvalidToken
+        token = bytes(token) # older versions of cryptography only accept bytes, not a memoryview of the map
+        try:
+            return self.aead.decrypt(token[:self.NONCE_SIZE], token[self.NONCE_SIZE:], chunk.to_bytes(8, "little"))
+        except InvalidTag:
+            raise InvalidToken
+
+    def encrypt_many(self, chunks: Sequence[int], data: Sequence[bytes]) -> list[bytes]:
+        '''Encrypts the data of several chunks at once and returns a list of the tokens.'''
+        return [self.encrypt(chunk, x) for chunk, x in zip(chunks, data)]
+
+    def decrypt_many(self, chunks: Sequence[int], tokens: Sequence[bytes]) -> list[bytes]:
+        '''Decrypts the tokens of several chunks and returns a list of the data. Raises `cryptography.fernet.InvalidToken` if any of them is invalid.'''
+        return [self.decrypt(chunk, token) for chunk, token in zip(chunks, tokens)]
+
+    def verify(self, chunk: int, token: bytes) -> bool:
+        '''Returns True if the token of chunk number `chunk` is valid. The tag can only be checked by decrypting the chunk, so the data is decrypted and thrown away.'''
+        try:
+            self.decrypt(chunk, token)
+        except InvalidToken:
+            return False
+        return True
+
+    def encrypt_hole(self, chunk: int) -> bytes:
+        '''Returns the token written at the start of a hole, a nonce and the tag of no data. The associated data is the chunk number followed by b"hole", so a hole token can't be moved to another chunk or mistaken for a chunk's token. The rest of the hole is zeros.'''
+        nonce = urandom(self.NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, b"", chunk.to_bytes(8, "little")+b"hole")
+
+    def is_hole(self, chunk: int, token: bytes | memoryview) -> bool:
+        '''Returns True if the token of chunk number `chunk` is a hole: a token from `encrypt_hole` for the same chunk, followed by zeros.'''
+        if not _zeros_after(token, self.HOLE_SIZE):
+            return False
+        try:
+            self.aead.decrypt(bytes(token[:self.NONCE_SIZE]), bytes(token[self.NONCE_SIZE:self.HOLE_SIZE]), chunk.to_bytes(8, "little")+b"hole")
+        except InvalidTag:
+            return False
+        return True
+
+    def timestamp(self, chunk: int, token: bytes) -> None:
+        '''AEAD tokens don't record when they were encrypted, so this always returns `None`.'''
+        return None
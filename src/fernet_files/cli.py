@@ -0,0 +1,317 @@
+'''Command line interface, run as `fernet-files` or `python -m fernet_files`
+
+Subcommands:
+
+- encrypt - Encrypts a file or stdin.
+- decrypt - Decrypts a file or stdin.
+- cat - Decrypts part of a file to stdout.
+- verify - Checks every chunk of one or more files.
+- info - Shows the header of a file.
+
+Keys are read from a file containing the 32 byte key, given with `--key-file` or the `FERNET_FILES_KEY_FILE` environment variable.
+A filename of "-" means stdin or stdout. Files are used with `FernetFile`, so `--workers` encrypts and decrypts chunks in parallel, and streams are used with `encrypt_stream` and `decrypt_stream`.'''
+
+import argparse
+import os
+import stat
+import sys
+import time
+from cryptography.fernet import InvalidToken
+from fernet_files import FernetFile, FernetReader, DEFAULT_CHUNKSIZE, UNKNOWN_SIZE, META_SIZE, encrypt_stream, decrypt_stream, verify, _read_metadata, _file_read_at
+from fernet_files.ciphers import CIPHERS, FernetCipher, AEADCipher
+from fernet_files.compression import COMPRESSIONS, get_compression
+
+_MAX_BLOCK = 67_108_864 # the most data read or written at once, in bytes
+
+def _block(chunksize: int, chunks: int) -> int:
+    '''Returns the size of `chunks` whole chunks, limited to `_MAX_BLOCK` bytes but always at least one chunk, so memory use doesn't grow with the chunksize or the number of workers.'''
+    return chunksize*max(min(chunks, _MAX_BLOCK//chunksize), 1)
+
+class _Progress:
+    '''Writes a progress line to stderr while a command runs, and a summary with the average speed at the end.\nThe progress line is only written if stderr is a terminal, and at most 10 times a second.'''
+
+    def __init__(self, total: int | None, quiet: bool) -> None:
+        self.total, self.quiet = total, quiet
+        self.done = 0
+        self.start = self.last_update = time.perf_counter()
+        self.live = not quiet and sys.stderr.isatty()
+
+    def update(self, size: int) -> None:
+        '''Adds `size` bytes to the number of bytes processed.'''
+        self.done += size
+        if self.live and (now := time.perf_counter()) - self.last_update >= 0.1:
+            self.last_update = now
+            total = f" / {self.total/1_000_000:.1f}" if self.total is not None else ""
+            sys.stderr.write(f"\r{self.done/1_000_000:.1f}{total} MB, {self.done/1_000_000/(now-self.start):.1f} MB/s ")
+            sys.stderr.flush()
+
+    def finish(self) -> None:
+        '''Writes the summary.'''
+        if self.quiet:
+            return
+        elapsed = time.perf_counter()-self.start
+        if self.live:
+            sys.stderr.write("\r")
+        sys.stderr.write(f"{self.done/1_000_000:.1f} MB in {elapsed:.2f}s, {self.done/1_000_000/max(elapsed, 1e-9):.1f} MB/s\n")
+
+class _ProgressReader:
+    '''Wraps a stream so that `_Progress` is updated by every read. Everything else is passed to the stream, so `encrypt_stream` can still seek it if it's seekable.'''
+
+    def __init__(self, stream, progress: _Progress) -> None:
+        self.stream, self.progress = stream, progress
+
+    def read(self, size: int = -1) -> bytes:
+        '''Reads from the stream and adds the size of the data to the progress.'''
+        data = self.stream.read(size)
+        self.progress.update(len(data))
+        return data
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+class _ProgressWriter(_ProgressReader):
+    '''Wraps a stream so that `_Progress` is updated by every write.'''
+
+    def read(self, size: int = -1) -> bytes:
+        '''Reads from the stream without changing the progress.'''
+        return self.stream.read(size)
+
+    def write(self, b: bytes) -> int:
+        '''Writes to the stream and adds the number of bytes written to the progress.'''
+        size = self.stream.write(b)
+        self.progress.update(len(b) if size is None else size)
+        return size
+
+def _chunksize(value: str) -> int | str:
+    '''Parses `--chunksize`, an integer greater than 0 or "auto".'''
+    if value == "auto":
+        return value
+    try:
+        chunksize = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an integer greater than 0 or \"auto\"")
+    if chunksize <= 0:
+        raise argparse.ArgumentTypeError("must be an integer greater than 0 or \"auto\"")
+    return chunksize
+
+def _workers(value: str) -> int:
+    '''Parses `--workers`, an integer greater than 0.'''
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an integer greater than 0")
+    if workers <= 0:
+        raise argparse.ArgumentTypeError("must be an integer greater than 0")
+    return workers
+
+def _range(value: str) -> tuple[int, int | None]:
+    '''Parses `--range START:END`, where either can be left out, in the same way as a slice.'''
+    start, separator, end = value.partition(":")
+    try:
+        start, end = int(start or 0), int(end) if end else None
+    except ValueError:
+        start = None
+    if not separator or start is None or start < 0 or (end is not None and end < start):
+        raise argparse.ArgumentTypeError("must be START:END, where 0 <= START <= END")
+    return start, end
+
+def _read_key(path: str | None) -> bytes:
+    '''Reads the key from `path`, or from the file named by the `FERNET_FILES_KEY_FILE` environment variable.'''
+    path = path or os.environ.get("FERNET_FILES_KEY_FILE")
+    if not path:
+        raise ValueError("No key given, use --key-file or set FERNET_FILES_KEY_FILE")
+    with open(path, "rb") as f:
+        key = f.read()
+    if len(key) != 32:
+        raise ValueError(f"Key file {path} must contain exactly 32 bytes")
+    return key
+
+def _is_file(name: str) -> bool:
+    '''Returns True if `name` is a regular file, so it can be opened by `FernetFile`.'''
+    try:
+        return name != "-" and stat.S_ISREG(os.stat(name).st_mode)
+    except OSError:
+        return False
+
+def _open_input(name: str):
+    '''Opens a file for reading, or returns stdin if `name` is "-".'''
+    return sys.stdin.buffer if name == "-" else open(name, "rb")
+
+def _open_output(name: str):
+    '''Opens a file for writing, or returns stdout if `name` is "-".'''
+    return sys.stdout.buffer if name == "-" else open(name, "wb")
+
+def _encrypt(args: argparse.Namespace, key: bytes) -> int:
+    '''The encrypt subcommand. A file is written with `FernetFile`, so chunks are encrypted in parallel, and stdout is written with `encrypt_stream`.'''
+    src = _open_input(args.input)
+    try:
+        size = os.fstat(src.fileno()).st_size if _is_file(args.input) else None
+        progress = _Progress(size, args.quiet)
+        if args.output == "-":
+            if args.compression:
+                raise ValueError("--compression can't be used when writing to stdout")
+            encrypt_stream(_ProgressReader(src, progress), sys.stdout.buffer, key, args.chunksize, cipher=args.cipher)
+            sys.stdout.buffer.flush()
+        else:
+            with FernetFile(key, open(args.output, "wb+"), args.chunksize, workers=args.workers, cipher=args.cipher, expected_size=size, access="sequential", compression=args.compression) as fernet_file:
+                block = _block(fernet_file.chunksize, args.workers*4) # whole chunks, so they're encrypted in parallel
+                while data := src.read(block):
+                    fernet_file.write(data)
+                    progress.update(len(data))
+        progress.finish()
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+    return 0
+
+def _decrypt(args: argparse.Namespace, key: bytes) -> int:
+    '''The decrypt subcommand. A file is read with `FernetFile`, which decrypts the next chunks in parallel with read-ahead, and stdin is read with `decrypt_stream`.'''
+    dst = _open_output(args.output)
+    complete = False
+    try:
+        if _is_file(args.input):
+            with FernetFile(key, open(args.input, "rb"), args.chunksize, workers=args.workers, read_ahead=args.workers*2) as fernet_file:
+                size = fernet_file.seek(0, os.SEEK_END)
+                fernet_file.seek(0)
+                progress = _Progress(size, args.quiet)
+                buffer = memoryview(bytearray(_block(fernet_file.chunksize, args.workers)))
+                while read := fernet_file.readinto(buffer):
+                    dst.write(buffer[:read])
+                    progress.update(read)
+            if progress.done != size: # FernetFile reads invalid chunks as empty
+                raise InvalidToken
+        else: # stdin, or a stream such as a named pipe
+            progress = _Progress(None, args.quiet)
+            src = _open_input(args.input)
+            try:
+                decrypt_stream(src, _ProgressWriter(dst, progress), key, args.chunksize)
+            finally:
+                if src is not sys.stdin.buffer:
+                    src.close()
+        dst.flush()
+        progress.finish()
+        complete = True
+    finally:
+        if dst is not sys.stdout.buffer:
+            dst.close()
+            if not complete and _is_file(args.output): # a pipe or device can't be removed
+                os.remove(args.output) # don't leave part of the data behind, it may be corrupt
+    return 0
+
+def _cat(args: argparse.Namespace, key: bytes) -> int:
+    '''The cat subcommand. Only the chunks in the range are read and decrypted.'''
+    start, end = args.range
+    with FernetReader(key, args.file, args.chunksize) as reader:
+        end = reader.size if end is None else min(end, reader.size)
+        progress = _Progress(max(end-start, 0), args.quiet)
+        block = _block(reader.chunksize, 16)
+        for position in range(start, end, block):
+            data = reader.pread(position, min(block, end-position))
+            sys.stdout.buffer.write(data)
+            progress.update(len(data))
+    sys.stdout.buffer.flush()
+    progress.finish()
+    return 0
+
+def _verify(args: argparse.Namespace, key: bytes) -> int:
+    '''The verify subcommand. Progress is the size of the chunks on disk that have been checked. Returns 1 if any file has invalid chunks or an invalid header.'''
+    failed = False
+    for name in args.files:
+        try:
+            progress = _Progress(os.path.getsize(name), args.quiet)
+            bad = verify(name, key, args.chunksize, args.workers, lambda chunk, size: progress.update(size))
+        except OSError as e:
+            print(f"{name}: {e.strerror}")
+            failed = True
+            continue
+        except ValueError as e:
+            print(f"{name}: {e}")
+            failed = True
+            continue
+        progress.finish() # ends the progress line before the result is written
+        if bad:
+            print(f"{name}: {len(bad)} invalid chunks: {' '.join(map(str, bad))}")
+            failed = True
+        else:
+            print(f"{name}: OK")
+    return int(failed)
+
+def _info(args: argparse.Namespace, key: bytes | None) -> int:
+    '''The info subcommand. Only the header and trailer are read, so no key is needed.'''
+    with open(args.file, "rb") as f:
+        disk_size = f.seek(0, os.SEEK_END)
+        header, header_size, last_chunk, last_chunk_padding = _read_metadata(_file_read_at(f), disk_size)
+    if header is None:
+        print("empty file")
+        return 0
+    chunksize = header.chunksize or args.chunksize or DEFAULT_CHUNKSIZE
+    trailer = header.last_chunk == UNKNOWN_SIZE
+    token_size = (FernetCipher if header.cipher == "fernet" else AEADCipher).token_size(chunksize)
+    print(f"version: {header.version}")
+    print(f"cipher: {header.cipher}")
+    print(f"chunksize: {chunksize}" + ("" if header.chunksize else " (not recorded in version 1 files)"))
+    if header.file_id is not None:
+        print(f"file id: {header.file_id.hex()}")
+    print(f"flags: {header.flags}")
+    print(f"compression: {get_compression(header.flags) or 'none'}")
+    print(f"size: {(last_chunk+1)*chunksize-last_chunk_padding}")
+    print(f"chunks: {last_chunk+1}")
+    print(f"metadata: {'trailer' if trailer else 'header'}")
+    print(f"header size: {header_size}")
+    if get_compression(header.flags) is None:
+        print(f"size on disk: {disk_size} (expected {header_size+(last_chunk+1)*token_size+(META_SIZE*2 if trailer else 0)})")
+    else: # compressed chunks are different sizes
+        print(f"size on disk: {disk_size}")
+    return 0
+
+def _parser() -> argparse.ArgumentParser:
+    '''Returns the argument parser for every subcommand.'''
+    parser = argparse.ArgumentParser(prog="fernet-files", description="Encrypt, decrypt and check files in the fernet_files format.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-k", "--key-file", help="file containing the 32 byte key, defaults to $FERNET_FILES_KEY_FILE")
+    common.add_argument("-c", "--chunksize", type=_chunksize, help="chunksize in bytes or \"auto\", only needed when encrypting or for version 1 files")
+    common.add_argument("-w", "--workers", type=_workers, default=os.cpu_count() or 1, help="threads used to encrypt or decrypt chunks, defaults to one per CPU")
+    common.add_argument("-q", "--quiet", action="store_true", help="don't show progress or throughput")
+
+    command = subparsers.add_parser("encrypt", parents=[common], help="encrypt a file or stdin")
+    command.add_argument("input", nargs="?", default="-", help="file to encrypt, defaults to stdin")
+    command.add_argument("output", nargs="?", default="-", help="encrypted file, defaults to stdout")
+    command.add_argument("--cipher", choices=CIPHERS, help="cipher used to encrypt chunks, defaults to fernet")
+    command.add_argument("--compression", choices=COMPRESSIONS, help="codec used to compress chunks before encrypting them, only when writing to a file")
+    command.set_defaults(function=_encrypt)
+
+    command = subparsers.add_parser("decrypt", parents=[common], help="decrypt a file or stdin")
+    command.add_argument("input", nargs="?", default="-", help="file to decrypt, defaults to stdin")
+    command.add_argument("output", nargs="?", default="-", help="decrypted file, defaults to stdout")
+    command.set_defaults(function=_decrypt)
+
+    command = subparsers.add_parser("cat", parents=[common], help="decrypt part of a file to stdout")
+    command.add_argument("file")
+    command.add_argument("-r", "--range", type=_range, default=(0, None), help="START:END, the bytes to decrypt, in the same way as a slice")
+    command.set_defaults(function=_cat)
+
+    command = subparsers.add_parser("verify", parents=[common], help="check every chunk of files, exits with 1 if any are invalid")
+    command.add_argument("files", nargs="+")
+    command.set_defaults(function=_verify)
+
+    command = subparsers.add_parser("info", parents=[common], help="show the header of a file, no key needed")
+    command.add_argument("file")
+    command.set_defaults(function=_info)
+    return parser
+
+def main(argv: list[str] | None = None) -> int:
+    '''Runs the command line interface with the arguments `argv`, or `sys.argv` if it's `None`, and returns the exit code.'''
+    parser = _parser()
+    args = parser.parse_args(argv)
+    try:
+        key = None if args.command == "info" else _read_key(args.key_file)
+        if args.chunksize == "auto" and args.command != "encrypt":
+            args.chunksize = None # the chunksize is read from the file
+        return args.function(args, key)
+    except (OSError, ValueError, InvalidToken) as e:
+        message = "invalid chunk, the file has been modified or the key is wrong" if isinstance(e, InvalidToken) else str(e)
+        print(f"{parser.prog}: error: {message}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
@@ -0,0 +1,114 @@
+'''Compression of chunks before they are encrypted
+
+Every chunk is normally padded to the chunksize and encrypted, so it takes up the same space on disk whatever its data is.
+A version 2 file can instead compress each chunk with a codec from the standard library before encrypting it. The codec is stored in the flags of the header.
+Compressed chunks are different sizes, so they can't be found by multiplying the chunk number by the size of a chunk.
+Instead, the file ends with an index, encrypted like a chunk, that holds the position and size of every chunk, followed by a trailer with the position and size of the index.
+The whole index is read when the file is opened, so finding a chunk is still a single lookup.
+
+Chunks are written wherever they fit: in the space of the chunk they replace if they're no bigger, otherwise after the last chunk in the file.
+The index on disk is never overwritten by chunks. Chunks that go past it are written after it, each followed by a copy of its trailer, so if the program stops before the new index is written, the file can still be opened with the old one.
+The new index is written after them, and when the file is closed, chunks from the end of the file are moved into the space of the old indexes where they fit.
+The space of a chunk that moves isn't reused, so a file that is rewritten a lot can be made smaller by copying it to a new file.
+
+The size of each compressed chunk can be seen without the key, which reveals something about the data. Don't compress data that an attacker can partly control alongside secrets.'''
+
+import bz2
+import lzma
+import zlib
+from typing import Callable, Sequence
+
+COMPRESSIONS = ("zlib", "lzma", "bz2")
+'''The names of the codecs chunks can be compressed with. A codec's number in the flags of a file's header is its index in this tuple plus 1, and 0 means chunks aren't compressed.'''
+
+COMPRESSION_MASK = 0x000F
+'''The bits of a header's flags that hold the codec.'''
+
+INDEX_CHUNK = 2**64-1
+'''The chunk number used to encrypt the index. AEAD ciphers authenticate it, so a chunk can't be passed off as the index.'''
+
+INDEX_ENTRY_SIZE = 16
+'''The size of each chunk's entry in the index, its position and its size, 8 bytes each.'''
+
+TRAILER_SIZE = 16
+'''The size of the trailer at the end of a compressed file, the position and size of the index, 8 bytes each.'''
+
+_CODECS = {
+    "zlib": (zlib.compress, lambda data, chunksize: zlib.decompress(data, bufsize=chunksize)), # the output buffer is allocated at its final size
+    "lzma": (lzma.compress, lambda data, chunksize: lzma.decompress(data)),
+    "bz2": (bz2.compress, lambda data, chunksize: bz2.decompress(data)),
+}
+
+def get_compression(flags: int) -> str | None:
+    '''Returns the name of the codec stored in a header's flags, or `None` if chunks aren't compressed. Raises ValueError if the codec is unknown.'''
+    number = flags & COMPRESSION_MASK
+    if number > len(COMPRESSIONS):
+        raise ValueError(f"Unknown compression {number}")
+    return COMPRESSIONS[number-1] if number else None
+
+def compression_flags(compression: str | None) -> int:
+    '''Returns the flags of a header for a codec, the opposite of `get_compression`.'''
+    return COMPRESSIONS.index(compression)+1 if compression else 0
+
+def pack_index(index: Sequence[tuple[int, int]]) -> bytes:
+    '''Returns the unencrypted bytes of an index, a list of the position and size of each chunk.'''
+    return b"".join(offset.to_bytes(8, "little")+size.to_bytes(8, "little") for offset, size in index)
+
+def pack_trailer(position: int, size: int) -> bytes:
+    '''Returns the trailer written after an index of `size` bytes at `position`.'''
+    return position.to_bytes(8, "little")+size.to_bytes(8, "little")
+
+def unpack_index(data: bytes) -> list[tuple[int, int]]:
+    '''Returns the list of the position and size of each chunk from the decrypted bytes of an index. Raises ValueError if the index isn't a whole number of entries.'''
+    if len(data) % INDEX_ENTRY_SIZE:
+        raise ValueError("Invalid index")
+    return [(int.from_bytes(data[i:i+8], "little"), int.from_bytes(data[i+8:i+16], "little")) for i in range(0, len(data), INDEX_ENTRY_SIZE)]
+
+def read_index(read_at: Callable[[int, int], bytes], disk_size: int, header_size: int, cipher) -> tuple[list[tuple[int, int]], int, int]:
+    '''Reads and decrypts the index of a compressed file from the trailer at its end, using `read_at(offset, size)` to read the file. Returns the index, and the position and size of the index. Anything between the index and the trailer was written after the index and isn't part of the file.\nA file with nothing after the header has an empty index of size 0. Raises ValueError if the index can't be found, and `cryptography.fernet.InvalidToken` if it has been modified.'''
+    if disk_size <= header_size:
+        return [], header_size, 0
+    if disk_size < header_size+TRAILER_SIZE:
+        raise ValueError("Invalid index, file is too short")
+    trailer = read_at(disk_size-TRAILER_SIZE, TRAILER_SIZE)
+    position, size = int.from_bytes(trailer[:8], "little"), int.from_bytes(trailer[8:], "little")
+    if not (header_size <= position and 0 < size and position+size <= disk_size-TRAILER_SIZE):
+        raise ValueError("Invalid index, its position is outside the file")
+    return unpack_index(cipher.decrypt(INDEX_CHUNK, read_at(position, size))), position, size
+
+class CompressedCipher:
+    '''Wraps a cipher from `fernet_files.ciphers`, compressing the data of each chunk before encrypting it and decompressing it after decrypting it.\nThe cryptography library and the codecs release the GIL, so chunks are still compressed in parallel by `FernetFile`'s workers.
+
+- cipher - The cipher that encrypts the compressed data.
+- compression - One of `COMPRESSIONS`.
+- chunksize - The size of the data in each chunk, used to allocate the output of zlib at its final size.'''
+
+    def __init__(self, cipher, compression: str, chunksize: int) -> None:
+        self.cipher, self.chunksize = cipher, chunksize
+        self.compress, self.decompress = _CODECS[compression]
+        self.verify = cipher.verify # tokens are checked without decompressing them
+        self.timestamp = cipher.timestamp
+
+    def token_size(self, chunksize: int) -> int:
+        '''Returns the size of a chunk that isn't compressed when it's written to disk. Compressed chunks are usually much smaller.'''
+        return self.cipher.token_size(chunksize)
+
+    def encrypt(self, chunk: int, data: bytes) -> bytes:
+        '''Compresses and encrypts the data of chunk number `chunk` and returns the token.'''
+        return self.cipher.encrypt(chunk, self.compress(data))
+
+    def decrypt(self, chunk: int, token: bytes) -> bytes:
+        '''Decrypts and decompresses the token of chunk number `chunk`. Raises `cryptography.fernet.InvalidToken` if it is invalid.'''
+        return self.decompress(self.cipher.decrypt(chunk, token), self.chunksize)
+
+    def encrypt_many(self, chunks: Sequence[int], data: Sequence[bytes]) -> list[bytes]:
+        '''Compresses the data of several chunks and encrypts them at once, returning a list of the tokens.'''
+        return self.cipher.encrypt_many(chunks, [self.compress(x) for x in data])
+
+    def decrypt_many(self, chunks: Sequence[int], tokens: Sequence[bytes]) -> list[bytes]:
+        '''Decrypts the tokens of several chunks at once and decompresses them, returning a list of the data. Raises `cryptography.fernet.InvalidToken` if any of them is invalid.'''
+        return [self.decompress(x, self.chunksize) for x in self.cipher.decrypt_many(chunks, tokens)]
+
+    def is_hole(self, chunk: int, token: bytes) -> bool:
+        '''Always returns False. Holes in compressed files are chunks whose size in the index is 0, and the index is authenticated, so they have no token.'''
+        return False
@@ -11,12 +11,14 @@
 # I have removed all comments which I didn't create.
 
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidSignature # Added for the batch methods
 from cryptography import utils
 from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.hmac import HMAC
 from os import urandom # Changes to imports
 from time import time
+from typing import Sequence # Added for the batch methods
 
 class FernetNoBase64(Fernet):
     def __init__(
@@ -102,4 +104,108 @@ class FernetNoBase64(Fernet):
     def extract_timestamp(self, token: bytes) -> int: # Modified type hinting so extract_timestamp can't take str
         timestamp, data = FernetNoBase64._get_unverified_token_data(token) # Modified which class is referenced
         self._verify_signature(data)
-        return timestamp
\ No newline at end of file
+        return timestamp
+
+    # Everything below this point has been added, and is not part of cryptography.fernet.Fernet.
+    # Encrypting or decrypting a token creates a new padder, HMAC object and AES key object every time.
+    # When many small tokens are processed at once, this setup takes longer than the encryption itself.
+    # The batch methods below create the AES key and the keyed HMAC once, copy the HMAC for each token,
+    # generate every IV with a single call to urandom and work in a single reused scratch buffer.
+
+    def encrypt_many(
+        self, chunks: Sequence[bytes | bytearray | memoryview], out: bytearray | memoryview | None = None
+    ) -> list[bytes] | list[memoryview]:
+        '''Encrypts every item of `chunks` and returns a list of tokens, identical in format to `encrypt`. Every token has the same timestamp.
+If `out` is given, the tokens are written one after another into it and memoryviews of `out` are returned instead. `out` must be at least `token_size(len(chunk))` bytes long for every chunk added together.'''
+        current_time = int(time())
+        sizes = [len(chunk) for chunk in chunks]
+        total = sum(self.token_size(size) for size in sizes)
+        if out is None:
+            view = memoryview(bytearray(total))
+        else:
+            view = memoryview(out).cast("B")
+            if len(view) < total:
+                raise ValueError("out is too small for the encrypted chunks")
+        ivs = urandom(16*len(sizes))
+        aes = algorithms.AES(self._encryption_key)
+        signer = HMAC(self._signing_key, hashes.SHA256())
+        header = b"\x80" + current_time.to_bytes(length=8, byteorder="big")
+        tokens, position = [], 0
+        for i, (chunk, size) in enumerate(zip(chunks, sizes)):
+            token_size = self.token_size(size)
+            token = view[position:position+token_size]
+            iv = ivs[16*i:16*i+16]
+            token[:9] = header
+            token[9:25] = iv
+            # PKCS7 padding is applied by hand, only the last block needs to be copied
+            full = size - size % 16
+            pad = 16 - size % 16
+            encryptor = Cipher(aes, modes.CBC(iv)).encryptor()
+            written = encryptor.update_into(memoryview(chunk).cast("B")[:full], token[25:]) if full else 0
+            # the last block can be written past the ciphertext, into the space for the HMAC, which is written afterwards
+            written += encryptor.update_into(bytes(memoryview(chunk).cast("B")[full:]) + bytes((pad,))*pad, token[25+written:])
+            encryptor.finalize()
+            h = signer.copy()
+            h.update(token[:-32])
+            token[-32:] = h.finalize()
+            tokens.append(token)
+            position += token_size
+        if out is None:
+            return [token.tobytes() for token in tokens]
+        return tokens
+
+    def decrypt_many(
+        self, tokens: Sequence[bytes | bytearray | memoryview], out: bytearray | memoryview | None = None
+    ) -> list[bytes] | list[memoryview]:
+        '''Decrypts every item of `tokens` and returns a list of the decrypted data. Raises `InvalidToken` if any token is invalid, in the same way as `decrypt`. Timestamps are not checked.
+If `out` is given, the data is written one after another into it and memoryviews of `out` are returned instead. `out` must be at least `len(token) - 57` bytes long for every token added together.'''
+        if out is not None:
+            view = memoryview(out).cast("B")
+        aes = algorithms.AES(self._encryption_key)
+        verifier = HMAC(self._signing_key, hashes.SHA256())
+        scratch = bytearray(max((len(token) for token in tokens), default=0)) # reused for every token
+        results, position = [], 0
+        for token in tokens:
+            token = memoryview(token).cast("B")
+            if len(token) < 73 or token[0] != 0x80 or (len(token) - 57) % 16:
+                raise InvalidToken
+            h = verifier.copy()
+            h.update(token[:-32])
+            try:
+                h.verify(token[-32:].tobytes())
+            except InvalidSignature:
+                raise InvalidToken
+            decryptor = Cipher(aes, modes.CBC(token[9:25].tobytes())).decryptor()
+            size = decryptor.update_into(token[25:-32], scratch)
+            decryptor.finalize()
+            pad = scratch[size-1]
+            if not 1 <= pad <= 16 or scratch[size-pad:size] != bytes((pad,))*pad:
+                raise InvalidToken
+            size -= pad
+            if out is None:
+                results.append(bytes(scratch[:size]))
+            else:
+                if position + size > len(view):
+                    raise ValueError("out is too small for the decrypted data")
+                view[position:position+size] = scratch[:size]
+                results.append(view[position:position+size])
+                position += size
+        return results
+
+    def verify(self, token: bytes | bytearray | memoryview) -> bool:
+        '''Returns True if `token` was created with this key and hasn't been modified since, by checking its HMAC without decrypting it. Timestamps are not checked.'''
+        token = memoryview(token).cast("B")
+        if len(token) < 73 or token[0] != 0x80 or (len(token) - 57) % 16:
+            return False
+        h = HMAC(self._signing_key, hashes.SHA256())
+        h.update(token[:-32])
+        try:
+            h.verify(token[-32:].tobytes())
+        except InvalidSignature:
+            return False
+        return True
+
+    @staticmethod
+    def token_size(size: int) -> int:
+        '''Returns the size of the token created by encrypting `size` bytes of data.'''
+        return size + 73 - size % 16
@@ -0,0 +1,150 @@
+'''Statistics about the work done by `FernetFile`
+
+Statistics are only collected by files opened with `stats=True`, or while `fernet_files.STATS_ENABLED` is True.
+When they're collected, the file's cipher and its file operations are wrapped in objects that count and time them.
+Files that don't collect statistics aren't wrapped at all, so they do no extra work.
+
+Every file that collects statistics is added to a registry, and its statistics are added to `global_stats()` when it's closed.'''
+
+import threading
+import weakref
+from collections import namedtuple
+from time import perf_counter
+from typing import Callable, Sequence
+
+COUNTERS = ("chunks_decrypted", "chunks_encrypted", "plaintext_bytes_decrypted", "plaintext_bytes_encrypted", "bytes_read", "bytes_written", "header_writes", "prefetched", "prefetched_used", "prefetch_cancelled", "crypto_time", "io_time")
+'''The values counted by `Recorder`. The number of wasted decrypts is worked out from `prefetched`, `prefetched_used` and `prefetch_cancelled`.'''
+
+class Stats(namedtuple("Stats", ("chunks_decrypted", "chunks_encrypted", "plaintext_bytes_decrypted", "plaintext_bytes_encrypted", "bytes_read", "bytes_written", "header_writes", "wasted_decrypts", "crypto_time", "io_time", "cache_hits", "cache_misses"))):
+    '''Returned by `FernetFile.stats()` and `fernet_files.global_stats()`. Sizes are in bytes and times are in seconds.'''
+
+    __slots__ = ()
+
+    @property
+    def cache_hit_ratio(self) -> float | None:
+        '''The fraction of cache lookups that found the chunk, or `None` if the cache hasn't been used.'''
+        lookups = self.cache_hits+self.cache_misses
+        return self.cache_hits/lookups if lookups else None
+
+    def __add__(self, other: "Stats") -> "Stats":
+        '''Adds two `Stats` together field by field.'''
+        return Stats(*(x+y for x, y in zip(self, other)))
+
+EMPTY_STATS = Stats(*(0 for _ in Stats._fields))
+
+class Recorder:
+    '''Holds the counters of one file. Counters can be updated from several threads, because chunks are decrypted and encrypted on thread pools.
+
+- hook - Called as `hook(event, size, seconds)` after every event, on the thread the event happened on. Events are "decrypt", "encrypt", "read", "write" and "header_write".'''
+
+    def __init__(self, hook: Callable[[str, int, float], None] | None) -> None:
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+        self.hook = hook
+
+    def record(self, event: str, size: int, seconds: float, chunks: int = 1) -> None:
+        '''Adds an event to the counters and calls the hook.'''
+        with self.lock:
+            if event == "decrypt" or event == "encrypt":
+                self.counts[f"chunks_{event}ed"] += chunks
+                self.counts[f"plaintext_bytes_{event}ed"] += size
+                self.counts["crypto_time"] += seconds
+            elif event == "read" or event == "write":
+                self.counts["bytes_"+("read" if event == "read" else "written")] += size
+                self.counts["io_time"] += seconds
+            elif event == "header_write":
+                self.counts["header_writes"] += 1
+            else: # "prefetched", "prefetched_used" and "prefetch_cancelled" are only counted
+                self.counts[event] += chunks
+        if self.hook is not None and event not in ("prefetched", "prefetched_used", "prefetch_cancelled"):
+            self.hook(event, size, seconds)
+
+    def timed_read(self, read: Callable[[int, int], bytes]) -> Callable[[int, int], bytes]:
+        '''Returns a version of `FernetFile.__read_at` that records a "read" event.'''
+        def timed(offset: int, size: int) -> bytes:
+            start = perf_counter()
+            data = read(offset, size)
+            self.record("read", len(data), perf_counter()-start)
+            return data
+        return timed
+
+    def timed_write(self, write: Callable[[int, bytes], None]) -> Callable[[int, bytes], None]:
+        '''Returns a version of `FernetFile.__write_at` that records a "write" event.'''
+        def timed(offset: int, data: bytes) -> None:
+            start = perf_counter()
+            write(offset, data)
+            self.record("write", len(data), perf_counter()-start)
+        return timed
+
+class InstrumentedCipher:
+    '''Wraps a cipher from `fernet_files.ciphers`, recording an event every time it encrypts or decrypts. Time spent on several threads at once is added together.'''
+
+    def __init__(self, cipher, recorder: Recorder) -> None:
+        self.cipher, self.recorder = cipher, recorder
+        self.token_size = cipher.token_size
+        self.verify = cipher.verify
+        self.timestamp = cipher.timestamp
+        self.is_hole = cipher.is_hole
+
+    def encrypt(self, chunk: int, data: bytes) -> bytes:
+        '''The same as the cipher's `encrypt`, recording an "encrypt" event.'''
+        start = perf_counter()
+        token = self.cipher.encrypt(chunk, data)
+        self.recorder.record("encrypt", len(data), perf_counter()-start)
+        return token
+
+    def decrypt(self, chunk: int, token: bytes) -> bytes:
+        '''The same as the cipher's `decrypt`, recording a "decrypt" event. Nothing is recorded if the token is invalid.'''
+        start = perf_counter()
+        data = self.cipher.decrypt(chunk, token)
+        self.recorder.record("decrypt", len(data), perf_counter()-start)
+        return data
+
+    def encrypt_hole(self, chunk: int) -> bytes:
+        '''The same as the cipher's `encrypt_hole`. Nothing is recorded, because no data is encrypted.'''
+        return self.cipher.encrypt_hole(chunk)
+
+    def encrypt_many(self, chunks: Sequence[int], data: Sequence[bytes]) -> list[bytes]:
+        '''The same as the cipher's `encrypt_many`, recording a single "encrypt" event for the whole batch.'''
+        start = perf_counter()
+        tokens = self.cipher.encrypt_many(chunks, data)
+        self.recorder.record("encrypt", sum(len(x) for x in data), perf_counter()-start, len(tokens))
+        return tokens
+
+    def decrypt_many(self, chunks: Sequence[int], tokens: Sequence[bytes]) -> list[bytes]:
+        '''The same as the cipher's `decrypt_many`, recording a single "decrypt" event for the whole batch. Nothing is recorded if a token is invalid.'''
+        start = perf_counter()
+        data = self.cipher.decrypt_many(chunks, tokens)
+        self.recorder.record("decrypt", sum(len(x) for x in data), perf_counter()-start, len(data))
+        return data
+
+_registry = weakref.WeakSet() # open files that collect statistics
+_closed_stats = EMPTY_STATS # statistics of closed files
+_registry_lock = threading.Lock()
+
+def register(fernet_file) -> None:
+    '''Adds a file that collects statistics to the registry.'''
+    with _registry_lock:
+        _registry.add(fernet_file)
+
+def unregister(fernet_file, stats: Stats) -> None:
+    '''Removes a file from the registry when it's closed, and adds its final statistics to the statistics of closed files. Does nothing if the file has already been removed.'''
+    global _closed_stats
+    with _registry_lock:
+        if fernet_file in _registry:
+            _registry.discard(fernet_file)
+            _closed_stats += stats
+
+def global_stats() -> Stats:
+    '''Returns the statistics of every file that has collected statistics, open or closed, added together.'''
+    with _registry_lock:
+        files, total = list(_registry), _closed_stats
+    for fernet_file in files:
+        total += fernet_file.stats() or EMPTY_STATS
+    return total
+
+def reset_global_stats() -> None:
+    '''Sets the statistics of closed files back to zero. Open files keep their statistics.'''
+    global _closed_stats
+    with _registry_lock:
+        _closed_stats = EMPTY_STATS
@@ -0,0 +1,226 @@
+'''Thread-safe random access to encrypted files
+
+A `FernetFile` has a position and a single current chunk, so it can't be used by two threads at once.
+`FernetReader` is read-only and has no position: every call to `pread` says where to read from, and the file is read with `os.pread`, which doesn't use the file's position either.
+Any number of threads can call `pread` on the same `FernetReader` at once, and they share a cache of decrypted chunks.'''
+
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO, RawIOBase, BufferedIOBase, StringIO, TextIOBase, UnsupportedOperation
+from fernet_files import DEFAULT_CHUNKSIZE, READ_BATCH_SIZE, CacheInfo, _read_metadata, _chunksize, _get_cipher
+from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.compression import CompressedCipher, get_compression, read_index
+
+class FernetReader:
+    '''Parameters:
+
+- key - The same as `fernet_files.FernetFile`.
+- file - Accepts a filename as a string, or a file-like object opened in binary mode. The file is never written to.
+- - If the file has a file descriptor and `os.pread` is available, reads from different threads don't wait for each other. Otherwise, such as for `BytesIO` objects, reads use `seek` and `read` while holding a lock.
+- chunksize - The same as `fernet_files.FernetFile`. Only needs to be given for version 1 files that don't use the default chunksize.
+- cache_size - The maximum number of bytes of decrypted chunks to keep in memory, shared by every thread. The least recently used chunks are discarded first. Defaults to 0, which disables the cache.
+
+The metadata is read once, when the file is opened, so data written to the file afterwards isn't seen.'''
+
+    def __init__(self, key: bytes | FernetNoBase64, file: str | RawIOBase | BufferedIOBase, chunksize: int | None = None, cache_size: int = 0) -> None:
+        self.closed = False
+
+        fernet = key if isinstance(key, FernetNoBase64) else FernetNoBase64(key) # key validation
+        # file validation
+        if isinstance(file, (StringIO, TextIOBase)):
+            raise TypeError("File provided must be binary, not string")
+        elif isinstance(file, (RawIOBase, BufferedIOBase, BytesIO)):
+            self.__file = file
+        elif isinstance(file, str):
+            self.__file = open(file, "rb")
+        else:
+            raise TypeError("File must be binary file or a filename")
+
+        # chunksize validation
+        if chunksize is not None:
+            if not isinstance(chunksize, int):
+                raise TypeError("Invalid chunksize, must be integer greater than 0 or None")
+            if chunksize <= 0:
+                raise ValueError("Invalid chunksize, must be integer greater than 0 or None")
+
+        # cache_size validation
+        if not isinstance(cache_size, int):
+            raise TypeError("Invalid cache_size, must be integer greater than or equal to 0")
+        if cache_size < 0:
+            raise ValueError("Invalid cache_size, must be integer greater than or equal to 0")
+        self.__cache_size = cache_size
+        self.__cache = OrderedDict() # chunk number -> decrypted data, least recently used first
+        self.__cache_bytes = 0
+        self.__cache_hits, self.__cache_misses, self.__cache_evictions = 0, 0, 0
+        self.__cache_lock = threading.Lock()
+
+        self.__fd = None
+        self.__file_lock = threading.Lock() # only used when the file can't be read with os.pread
+        if hasattr(os, "pread"):
+            try:
+                self.__file.flush() # anything written through the file object must be on disk before reading it directly
+                self.__fd = self.__file.fileno()
+            except (AttributeError, OSError, UnsupportedOperation):
+                pass
+
+        # get metadata
+        header, self.__header_size, last_chunk, last_chunk_padding = _read_metadata(self.__read_at, self.__get_disk_size())
+        if header is None: # an empty file has no data
+            self.__data_chunksize = chunksize or DEFAULT_CHUNKSIZE
+            self.__size = 0
+            return
+        chunksize = _chunksize(header, chunksize)
+        self.__cipher = _get_cipher(fernet, header)
+        self.__index = None # the position and size of each chunk, only compressed files have one
+        if (codec := get_compression(header.flags)) is not None:
+            self.__index = read_index(self.__read_at, self.__get_disk_size(), self.__header_size, self.__cipher)[0]
+            self.__cipher = CompressedCipher(self.__cipher, codec, chunksize)
+        self.__data_chunksize = chunksize # the size of the data in chunks
+        self.__chunksize = self.__cipher.token_size(chunksize) # the size of chunks when written to disk
+        self.__size = (last_chunk+1)*chunksize-last_chunk_padding
+
+    def __get_disk_size(self) -> int:
+        '''Returns the size of the underlying file in bytes.'''
+        if self.__fd is not None:
+            return os.fstat(self.__fd).st_size
+        with self.__file_lock:
+            return self.__file.seek(0, os.SEEK_END)
+
+    def __read_at(self, offset: int, size: int) -> bytes:
+        '''Reads up to `size` bytes from the underlying file at `offset` without using the file's position, so it can be called from any thread.\n`os.pread` can return less than was asked for, so it's called until `size` bytes have been read or the end of the file is reached.'''
+        if self.__fd is None:
+            with self.__file_lock:
+                self.__file.seek(offset)
+                return self.__file.read(size)
+        data = os.pread(self.__fd, size, offset)
+        while len(data) < size and (x := os.pread(self.__fd, size-len(data), offset+len(data))):
+            data += x
+        return data
+
+    def __get_chunks(self, chunks: range) -> list[bytes]:
+        '''Returns a list of the decrypted data of a range of chunks, including any padding, from the cache or by reading and decrypting them. The chunks that aren't cached are decrypted together with the cipher's `decrypt_many`.\nThe lock is only held while the cache is used, so chunks are read and decrypted by several threads at once. Two threads that ask for the same uncached chunk at the same time both decrypt it.'''
+        data = dict.fromkeys(chunks)
+        if self.__cache_size:
+            with self.__cache_lock:
+                for chunk in chunks:
+                    data[chunk] = self.__cache_get(chunk)
+        missing = [chunk for chunk in chunks if data[chunk] is None]
+        if not missing:
+            return list(data.values())
+        if self.__index is None: # the chunks are next to each other, so they're read at once
+            start = missing[0]*self.__chunksize+self.__header_size
+            tokens = memoryview(self.__read_at(start, (missing[-1]+1)*self.__chunksize+self.__header_size-start))
+            tokens = {chunk: bytes(tokens[chunk*self.__chunksize+self.__header_size-start:(chunk+1)*self.__chunksize+self.__header_size-start]) for chunk in missing}
+        else: # a compressed chunk that isn't in the index is a hole
+            tokens = {}
+            for chunk in missing:
+                offset, size = self.__index[chunk] if chunk < len(self.__index) else (0, 0)
+                tokens[chunk] = self.__read_at(offset, size) if size else None
+        encrypted = [chunk for chunk in missing if tokens[chunk] is not None and not self.__cipher.is_hole(chunk, tokens[chunk])]
+        data.update(zip(encrypted, self.__cipher.decrypt_many(encrypted, [tokens[chunk] for chunk in encrypted])))
+        for chunk in missing:
+            if data[chunk] is None: # holes are read as zeros
+                data[chunk] = bytes(self.__data_chunksize)
+        if self.__cache_size:
+            with self.__cache_lock:
+                for chunk in missing:
+                    self.__cache_put(chunk, data[chunk])
+        return list(data.values())
+
+    def __cache_get(self, chunk: int) -> bytes | None:
+        '''Returns the decrypted data of a chunk from the cache and marks it as most recently used, or returns `None` if it isn't cached. Must be called while holding `self.__cache_lock`.'''
+        data = self.__cache.get(chunk)
+        if data is None:
+            self.__cache_misses += 1
+        else:
+            self.__cache_hits += 1
+            self.__cache.move_to_end(chunk)
+        return data
+
+    def __cache_put(self, chunk: int, data: bytes) -> None:
+        '''Stores the decrypted data of a chunk in the cache, discarding the least recently used chunks until the cache fits in `cache_size`. Must be called while holding `self.__cache_lock`.\nData larger than the whole cache is not stored.'''
+        if len(data) > self.__cache_size or chunk in self.__cache: # another thread got there first
+            return
+        self.__cache[chunk] = data
+        self.__cache_bytes += len(data)
+        while self.__cache_bytes > self.__cache_size:
+            self.__cache_bytes -= len(self.__cache.popitem(last=False)[1])
+            self.__cache_evictions += 1
+
+    def cache_info(self) -> CacheInfo:
+        '''Returns a `fernet_files.CacheInfo` named tuple of the cache's hits, misses, evictions, current size in bytes and maximum size in bytes.'''
+        with self.__cache_lock:
+            return CacheInfo(self.__cache_hits, self.__cache_misses, self.__cache_evictions, self.__cache_bytes, self.__cache_size)
+
+    def pread(self, offset: int, size: int = -1) -> bytes:
+        '''Reads and returns up to `size` bytes of data starting at `offset`. Fewer bytes are returned if the end of the file is reached. Safe to call from several threads at once.
+
+Parameters:
+
+- offset - Integer greater than or equal to 0. The position in the data to start reading from.
+- size - Integer. If negative or not specified then read to the end of the file.
+
+Raises `cryptography.fernet.InvalidToken` if a chunk that is read has been modified.'''
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        # data validation
+        if not isinstance(offset, int):
+            raise TypeError("Offset must be an integer")
+        if offset < 0:
+            raise ValueError("Offset must be greater than or equal to 0")
+        if not isinstance(size, int):
+            raise TypeError("Size must be an integer")
+        end = self.__size if size < 0 else min(offset+size, self.__size)
+        if offset >= end:
+            return b""
+        first, last = offset//self.__data_chunksize, (end-1)//self.__data_chunksize
+        if first == last:
+            start = first*self.__data_chunksize
+            return self.__get_chunks(range(first, first+1))[0][offset-start:end-start]
+        views = []
+        batch = max(READ_BATCH_SIZE//self.__chunksize, 2) # chunks read and decrypted at once
+        for batch_start in range(first, last+1, batch):
+            chunks = range(batch_start, min(batch_start+batch, last+1))
+            for chunk, data in zip(chunks, self.__get_chunks(chunks)):
+                start = chunk*self.__data_chunksize
+                views.append(memoryview(data)[max(offset-start, 0):end-start])
+        return b"".join(views)
+
+    @property
+    def size(self) -> int:
+        '''The size of the data in bytes. Read only.'''
+        return self.__size
+
+    @property
+    def chunksize(self) -> int:
+        '''The size of chunks in bytes. Read only.'''
+        return self.__data_chunksize
+
+    def close(self) -> BytesIO | None:
+        '''Closes the file. Calls to `pread` that are already running must finish first.\nReturns `None` unless the file is a `BytesIO` object, in which case it returns the object without closing it.'''
+        self.closed = True
+        try:
+            # if file is BytesIO, return it, otherwise close the file
+            if isinstance(self.__file, BytesIO):
+                return self.__file
+            else:
+                try: self.__file.close()
+                except: pass
+        except AttributeError: # closed before the file was validated
+            pass
+
+    generate_key = FernetNoBase64.generate_key
+    '''Static method used to generate a key. Acts as a pointer to `custom_fernet.FernetNoBase64.generate_key()`.'''
+
+    def __enter__(self) -> "FernetReader":
+        '''Returns self to allow context management.'''
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        '''Calls `self.close` and returns `None`.'''
+        self.close()
+
+    def __del__(self) -> None:
+        '''Calls `self.close` and returns `None`.'''
+        self.close()
@@ -0,0 +1,173 @@
+'''Re-encryption of a file with a new key, chunksize or cipher
+
+Rotating a key by reading a file through one `FernetFile` and writing it through another decrypts and encrypts every chunk on a single thread.
+`rewrap` streams the data from the old file to the new one a few chunks at a time, decrypting and encrypting chunks in parallel on a thread pool while the next chunks are read.
+Every chunk is written at its final position in the new file, and the new header is written first, so an interrupted `rewrap` can carry on from the last chunk it wrote when it's called again with `resume=True`.'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import RawIOBase, BufferedIOBase, StringIO, TextIOBase
+from cryptography.fernet import InvalidToken
+from fernet_files import FORMAT_VERSION, FileHeader, _header_size, _read_header, _read_metadata, _file_read_at, _chunksize, _pack_header, _get_cipher
+from fernet_files.ciphers import CIPHERS
+from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.compression import get_compression
+from fernet_files.streaming import _write_all
+
+def _open(file: str | RawIOBase | BufferedIOBase, mode: str) -> RawIOBase | BufferedIOBase:
+    '''Opens a filename with `mode`, or checks that a file-like object is binary.'''
+    if isinstance(file, (StringIO, TextIOBase)):
+        raise TypeError("File provided must be binary, not string")
+    if isinstance(file, str):
+        return open(file, mode)
+    if isinstance(file, (RawIOBase, BufferedIOBase)):
+        return file
+    raise TypeError("File must be binary file or a filename")
+
+def rewrap(src: str | RawIOBase | BufferedIOBase, dst: str | RawIOBase | BufferedIOBase, old_key: bytes | FernetNoBase64, new_key: bytes | FernetNoBase64, new_chunksize: int | None = None, workers: int | None = None, cipher: str | None = None, old_chunksize: int | None = None, resume: bool = False) -> int:
+    '''Decrypts the file `src` and encrypts its data into the file `dst`, using a different key, chunksize or cipher. Returns the number of bytes of data in the file.
+
+Parameters:
+
+- src - A filename as a string, or a seekable file-like object, encrypted with `old_key`. A filename is opened read-only.
+- dst - A filename as a string, or a seekable file-like object that can be read and written.
+- old_key and new_key - Keys or `fernet_files.custom_fernet.FernetNoBase64` objects, the same as `fernet_files.FernetFile`. They can be the same key.
+- new_chunksize - The chunksize of `dst`. Defaults to `None`, which uses the chunksize of `src`.
+- workers - The number of threads used to decrypt and encrypt chunks. Defaults to `None`, which uses one thread per CPU.
+- cipher - The cipher of `dst`, one of `fernet_files.ciphers.CIPHERS`. Defaults to `None`, which uses the cipher of `src`.
+- old_chunksize - The chunksize of `src`. Only needs to be given for version 1 files that don't use the default chunksize.
+- resume - If True and `dst` holds an interrupted `rewrap` of `src` with the same settings, only the chunks that are missing are written. The last chunk that was written is compared with the data of `src`, and if it's different, `dst` is overwritten. Defaults to False, which always overwrites `dst`.
+
+Raises `cryptography.fernet.InvalidToken` if a chunk of `src` is invalid, and ValueError if `src` is empty, compressed, or its metadata is invalid.'''
+    old_fernet = old_key if isinstance(old_key, FernetNoBase64) else FernetNoBase64(old_key) # key validation
+    new_fernet = new_key if isinstance(new_key, FernetNoBase64) else FernetNoBase64(new_key)
+    for name, value in (("new_chunksize", new_chunksize), ("old_chunksize", old_chunksize)):
+        if value is not None:
+            if not isinstance(value, int):
+                raise TypeError(f"Invalid {name}, must be integer greater than 0 or None")
+            if value <= 0:
+                raise ValueError(f"Invalid {name}, must be integer greater than 0 or None")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    elif not isinstance(workers, int):
+        raise TypeError("Invalid number of workers, must be integer greater than 0 or None")
+    elif workers <= 0:
+        raise ValueError("Invalid number of workers, must be integer greater than 0 or None")
+    if cipher is not None:
+        if not isinstance(cipher, str):
+            raise TypeError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+        if cipher not in CIPHERS:
+            raise ValueError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+    if not isinstance(resume, bool):
+        raise TypeError("resume must be a boolean")
+
+    src_file = _open(src, "rb")
+    dst_file = _open(dst, "rb+" if isinstance(dst, str) and os.path.exists(dst) else "wb+")
+    try:
+        # read the source's metadata
+        header, old_header_size, last_chunk, last_chunk_padding = _read_metadata(_file_read_at(src_file), src_file.seek(0, os.SEEK_END))
+        if header is None:
+            raise ValueError("Invalid src, file is empty")
+        old_chunksize = _chunksize(header, old_chunksize, "old_chunksize")
+        if last_chunk_padding > old_chunksize:
+            raise ValueError("Invalid metadata")
+        size = (last_chunk+1)*old_chunksize-last_chunk_padding
+        if get_compression(header.flags) is not None:
+            raise ValueError("Invalid src, compressed files can't be rewrapped")
+        old_cipher = _get_cipher(old_fernet, header)
+        old_token_size = old_cipher.token_size(old_chunksize)
+
+        # the destination's header is written first, with its final metadata
+        new_chunksize = new_chunksize or old_chunksize
+        new_last_chunk = max(0, -(-size//new_chunksize)-1) # same calculation as FernetFile, a file with no data is a single chunk made entirely of padding
+        new_header = FileHeader(FORMAT_VERSION, cipher or header.cipher, 0, new_chunksize, os.urandom(16), new_last_chunk, (new_last_chunk+1)*new_chunksize-size)
+        new_header_size = _header_size(FORMAT_VERSION)
+        done = 0 # the number of chunks of the destination that have already been written
+        dst_file.seek(0)
+        try:
+            existing = _read_header(dst_file.read)
+        except ValueError:
+            existing = None
+
+        def decrypt(chunk: int, token: bytes) -> bytes:
+            return bytes(old_chunksize) if old_cipher.is_hole(chunk, token) else old_cipher.decrypt(chunk, token)
+
+        def source_data(start: int, end: int) -> bytes:
+            '''Reads and decrypts bytes `start` to `end` of the data of `src`.'''
+            data = []
+            for chunk in range(start//old_chunksize, (end-1)//old_chunksize+1):
+                src_file.seek(old_header_size+chunk*old_token_size)
+                data.append(decrypt(chunk, src_file.read(old_token_size)))
+            offset = start-start//old_chunksize*old_chunksize
+            return b"".join(data)[offset:offset+end-start]
+
+        if resume and existing is not None and existing._replace(file_id=new_header.file_id) == new_header: # an interrupted rewrap with the same settings
+            new_cipher = _get_cipher(new_fernet, existing)
+            new_token_size = new_cipher.token_size(new_chunksize)
+            done = min(max(dst_file.seek(0, os.SEEK_END)-new_header_size, 0)//new_token_size, new_last_chunk+1 if size else 0)
+            # the last chunks may not have been written completely, or at all if the file was extended with zeros
+            while done:
+                dst_file.seek(new_header_size+(done-1)*new_token_size)
+                try:
+                    data = new_cipher.decrypt(done-1, dst_file.read(new_token_size))
+                except InvalidToken:
+                    done -= 1
+                    continue
+                # the last chunk that was written must hold the data of this src, or dst is a rewrap of a different file
+                start = (done-1)*new_chunksize
+                if data[:min(size-start, new_chunksize)] != source_data(start, min(start+new_chunksize, size)):
+                    done = 0
+                break
+            if done:
+                new_header = existing
+        if not done:
+            new_cipher = _get_cipher(new_fernet, new_header)
+            new_token_size = new_cipher.token_size(new_chunksize)
+            dst_file.seek(0)
+            dst_file.truncate()
+            _write_all(dst_file, _pack_header(new_header))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            decrypted = {} # old chunk number -> Future of its data, kept between windows for chunks on the boundary
+            def read_window(first: int, last: int) -> tuple[int, int, int, list]:
+                '''Reads the old chunks holding the data of new chunks `first` to `last` and starts decrypting them.'''
+                start, end = first*new_chunksize, min((last+1)*new_chunksize, size)
+                old_chunks = range(start//old_chunksize, (end-1)//old_chunksize+1)
+                for chunk in [chunk for chunk in decrypted if chunk not in old_chunks]:
+                    del decrypted[chunk]
+                for chunk in old_chunks:
+                    if chunk not in decrypted:
+                        src_file.seek(old_header_size+chunk*old_token_size)
+                        decrypted[chunk] = executor.submit(decrypt, chunk, src_file.read(old_token_size))
+                offset = start-old_chunks.start*old_chunksize # where the data starts in the first old chunk
+                return first, offset, end-start, [decrypted[chunk] for chunk in old_chunks]
+            def write_window(first: int, offset: int, length: int, futures: list) -> None:
+                '''Splits the decrypted data into new chunks, encrypts them in parallel and writes them in order.'''
+                data = memoryview(b"".join(future.result() for future in futures))[offset:offset+length]
+                chunks = range(first, min(first+window, new_last_chunk+1))
+                plaintext = [bytes(data[i*new_chunksize:(i+1)*new_chunksize]).ljust(new_chunksize, b"\0") for i in range(len(chunks))]
+                batch_size = -(-len(chunks)//workers) # round up, one batch per worker
+                batches = range(0, len(chunks), batch_size)
+                tokens = executor.map(new_cipher.encrypt_many, [chunks[i:i+batch_size] for i in batches], [plaintext[i:i+batch_size] for i in batches])
+                dst_file.seek(new_header_size+first*new_token_size)
+                for batch in tokens:
+                    for token in batch:
+                        _write_all(dst_file, token)
+
+            window = workers*4 # new chunks per window, bounding memory usage
+            pending = None # the previous window is encrypted and written while the next one is decrypted
+            for first in range(done, new_last_chunk+1 if size else 0, window):
+                current = read_window(first, min(first+window, new_last_chunk+1)-1)
+                if pending is not None:
+                    write_window(*pending)
+                pending = current
+            if pending is not None:
+                write_window(*pending)
+        dst_file.truncate(new_header_size+(new_last_chunk+1)*new_token_size if size else new_header_size)
+        dst_file.flush()
+        return size
+    finally:
+        if isinstance(src, str):
+            src_file.close()
+        if isinstance(dst, str):
+            dst_file.close()
@@ -0,0 +1,148 @@
+'''Encryption and decryption of streams that can't seek, such as pipes, sockets and `sys.stdin`
+
+`FernetFile` seeks back to the start of the file to update its metadata, so it needs a seekable file.
+`encrypt_stream` and `decrypt_stream` read fixed-size chunks from any readable stream and write each chunk as soon as it has been processed, so memory usage doesn't depend on the size of the stream.
+
+If the size of the data is known before encryption starts, the metadata is written at the start of the output, and the output is the same as a file written by `FernetFile`.
+Otherwise, the last chunk number in the metadata at the start of the output is set to `fernet_files.UNKNOWN_SIZE`, and the real metadata is written in a trailer after the last chunk.
+`FernetFile` and `decrypt_stream` can read both.'''
+
+import os
+from io import RawIOBase, BufferedIOBase
+from fernet_files import FernetFile, META_SIZE, DEFAULT_CHUNKSIZE, UNKNOWN_SIZE, FORMAT_VERSION, FileHeader, _read_header, _chunksize, _pack_header, _get_cipher
+from fernet_files.ciphers import CIPHERS
+from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.compression import get_compression
+
+def _read_full(src: RawIOBase | BufferedIOBase, size: int) -> bytes:
+    '''Reads from `src` until `size` bytes have been read or the end of the stream is reached. Streams such as pipes can return less than was asked for.'''
+    pieces, read = [], 0
+    while read < size and (x := src.read(size-read)):
+        pieces.append(x) # joined once at the end, so small reads from a pipe aren't copied again every time
+        read += len(x)
+    return pieces[0] if len(pieces) == 1 else b"".join(pieces)
+
+def _write_all(dst: RawIOBase | BufferedIOBase, data: bytes) -> None:
+    '''Writes all of `data` to `dst`. Raw streams can write less than they were given.'''
+    view = memoryview(data)
+    while view:
+        view = view[dst.write(view):]
+
+def _get_size(src: RawIOBase | BufferedIOBase) -> int | None:
+    '''Returns the number of bytes between the current position of `src` and its end, or `None` if `src` can't seek.'''
+    try:
+        if not src.seekable():
+            return None
+        position = src.tell()
+        size = src.seek(0, os.SEEK_END)-position
+        src.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return None
+
+def _validate(key: bytes | FernetNoBase64, chunksize: int | str | None) -> FernetNoBase64:
+    '''Validates the key and chunksize in the same way as `FernetFile`, and returns the `FernetNoBase64` object to use.'''
+    fernet = key if isinstance(key, FernetNoBase64) else FernetNoBase64(key) # key validation
+    if chunksize is not None and chunksize != "auto":
+        if not isinstance(chunksize, int):
+            raise TypeError("Invalid chunksize, must be integer greater than 0, \"auto\" or None")
+        if chunksize <= 0:
+            raise ValueError("Invalid chunksize, must be integer greater than 0, \"auto\" or None")
+    return fernet
+
+def encrypt_stream(src: RawIOBase | BufferedIOBase, dst: RawIOBase | BufferedIOBase, key: bytes | FernetNoBase64, chunksize: int | str | None = None, size: int | None = None, cipher: str | None = None) -> int:
+    '''Reads data from `src`, encrypts it one chunk at a time and writes it to `dst`. Returns the number of bytes of data encrypted.\nNeither stream needs to be seekable. Decrypt the output using `decrypt_stream` or open it with `FernetFile`, using the same key.\n\n- chunksize - The same as `FernetFile`. "auto" picks a chunksize for sequential access from the size of the data, if it's known.\n- size - The number of bytes to read from `src`. If it's given, or if `src` is seekable, the metadata is written up front. Otherwise, `src` is read until its end and the metadata is written in a trailer.\n- cipher - The same as `FernetFile`. Defaults to "fernet".\n\nRaises ValueError if `src` ends before `size` bytes have been read.'''
+    fernet = _validate(key, chunksize)
+    if size is None:
+        size = _get_size(src)
+    elif not isinstance(size, int):
+        raise TypeError("Invalid size, must be integer greater than or equal to 0 or None")
+    elif size < 0:
+        raise ValueError("Invalid size, must be integer greater than or equal to 0 or None")
+    if cipher is not None:
+        if not isinstance(cipher, str):
+            raise TypeError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+        if cipher not in CIPHERS:
+            raise ValueError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+
+    if chunksize is None:
+        chunksize = DEFAULT_CHUNKSIZE
+    elif chunksize == "auto":
+        chunksize = FernetFile.auto_chunksize(size, "sequential")
+    header = FileHeader(FORMAT_VERSION, cipher or "fernet", 0, chunksize, os.urandom(16), UNKNOWN_SIZE, 0)
+    if size is not None: # same calculation as FernetFile, a file with no data is a single chunk made entirely of padding
+        last_chunk = max(0, -(-size//chunksize)-1)
+        header = header._replace(last_chunk=last_chunk, last_chunk_padding=(last_chunk+1)*chunksize-size)
+    _write_all(dst, _pack_header(header))
+    chunk_cipher = _get_cipher(fernet, header)
+
+    total, chunk = 0, 0
+    while size is None or total < size:
+        data = _read_full(src, chunksize if size is None else min(chunksize, size-total))
+        if not data:
+            break
+        total += len(data)
+        _write_all(dst, chunk_cipher.encrypt(chunk, data.ljust(chunksize, b"\0")))
+        chunk += 1
+        if len(data) < chunksize:
+            break
+
+    if size is None:
+        last_chunk = max(0, chunk-1)
+        _write_all(dst, _pack_header(FileHeader(1, "fernet", 0, None, None, last_chunk, (last_chunk+1)*chunksize-total))) # only the metadata
+    elif total < size:
+        raise ValueError(f"Stream ended after {total} bytes, expected {size} bytes")
+    return total
+
+def decrypt_stream(src: RawIOBase | BufferedIOBase, dst: RawIOBase | BufferedIOBase, key: bytes | FernetNoBase64, chunksize: int | None = None) -> int:
+    '''Reads data written by `encrypt_stream` or `FernetFile` from `src`, decrypts it one chunk at a time and writes it to `dst`. Returns the number of bytes of data decrypted.\nNeither stream needs to be seekable. The chunksize is read from the header, so it only needs to be given for version 1 streams that don't use the default chunksize. Chunks are written to `dst` as soon as they are decrypted, so if an error is raised, `dst` will already contain the chunks before it.\n\nRaises `cryptography.fernet.InvalidToken` if a chunk has been modified or the key or chunksize are wrong, and ValueError if the stream is truncated or its metadata is invalid.'''
+    fernet = _validate(key, chunksize)
+    header = _read_header(lambda size: _read_full(src, size))
+    if header is None:
+        raise ValueError("Stream ended before its metadata")
+    chunksize = _chunksize(header, chunksize)
+    if get_compression(header.flags) is not None:
+        raise ValueError("Compressed files can't be read as a stream, use FernetFile or FernetReader")
+    chunk_cipher = _get_cipher(fernet, header)
+    disk_chunksize = chunk_cipher.token_size(chunksize) # the size of chunks when written to disk
+    last_chunk, last_chunk_padding = header.last_chunk, header.last_chunk_padding
+    total = 0
+
+    if last_chunk != UNKNOWN_SIZE:
+        if last_chunk_padding > chunksize:
+            raise ValueError("Invalid metadata")
+        for chunk in range(last_chunk+1):
+            token = _read_full(src, disk_chunksize)
+            if not token and chunk == 0 and last_chunk_padding == chunksize:
+                break # a file with no data doesn't need any chunks
+            if len(token) < disk_chunksize:
+                raise ValueError("Stream ended before the last chunk")
+            data = bytes(chunksize) if chunk_cipher.is_hole(chunk, token) else chunk_cipher.decrypt(chunk, token) # files written by FernetFile can have holes
+            if chunk == last_chunk:
+                data = data[:chunksize-last_chunk_padding]
+            _write_all(dst, data)
+            total += len(data)
+        return total
+
+    # The metadata is in a trailer, so the last chunk can only be recognised when the stream ends.
+    # One chunk is held back until it's known that there is something after it besides the trailer.
+    pending, chunk = _read_full(src, disk_chunksize+META_SIZE*2), 0
+    while len(pending) == disk_chunksize+META_SIZE*2 and (x := _read_full(src, disk_chunksize)):
+        data = chunk_cipher.decrypt(chunk, pending[:disk_chunksize])
+        _write_all(dst, data)
+        total += len(data)
+        pending = pending[disk_chunksize:]+x
+        chunk += 1
+    if len(pending) not in (META_SIZE*2, disk_chunksize+META_SIZE*2):
+        raise ValueError("Stream ended before the last chunk")
+    last_chunk = int.from_bytes(pending[-META_SIZE*2:-META_SIZE], "little")
+    last_chunk_padding = int.from_bytes(pending[-META_SIZE:], "little")
+    if len(pending) == META_SIZE*2: # no final chunk, only valid if there was no data
+        if chunk or last_chunk or last_chunk_padding != chunksize:
+            raise ValueError("Invalid metadata")
+        return total
+    if last_chunk != chunk or last_chunk_padding >= chunksize:
+        raise ValueError("Invalid metadata")
+    data = chunk_cipher.decrypt(chunk, pending[:disk_chunksize])[:chunksize-last_chunk_padding]
+    _write_all(dst, data)
+    return total+len(data)
@@ -0,0 +1,99 @@
+'''Incremental copies of encrypted files
+
+A chunk gets a new random IV or nonce every time it's written, so a chunk that hasn't been written since a file was last copied has exactly the same token as the copy.
+`sync` brings a copy of an encrypted file up to date by writing only the tokens that differ, then the header, without decrypting anything.
+An incremental backup of a large file that has barely changed only writes the chunks that changed.
+
+With the key and the time of the previous `sync`, each chunk's time is read from its token after checking the HMAC, and chunks written before that time aren't read from the copy at all.'''
+
+import os
+from io import RawIOBase, BufferedIOBase
+from fernet_files import META_SIZE, DEFAULT_CHUNKSIZE, UNKNOWN_SIZE, _read_header, _read_metadata, _file_read_at
+from fernet_files.ciphers import FernetCipher, AEADCipher
+from fernet_files.compression import get_compression
+from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.rewrap import _open
+from fernet_files.streaming import _write_all
+
+def sync(src: str | RawIOBase | BufferedIOBase, dst: str | RawIOBase | BufferedIOBase, key: bytes | FernetNoBase64 | None = None, since: int | float | None = None, chunksize: int | None = None) -> list[int]:
+    '''Makes `dst` an exact copy of the encrypted file `src`, writing only the chunks that are different, and returns a list of the numbers of the chunks that were written.
+
+Parameters:
+
+- src - A filename as a string, or a seekable file-like object. A filename is opened read-only.
+- dst - A filename as a string, or a seekable file-like object that can be read and written. If it isn't a copy of the same file, with the same file ID, every chunk is written.
+- key - The same as `fernet_files.FernetFile`. Only needed with `since`.
+- since - The time of the previous `sync` to `dst`, in seconds since the epoch. Chunks of `src` written before this time are assumed to be the same in `dst`, so they aren't compared. Chunks record the time to the second, so chunks written in the same second as `since` are still compared. Only works for files that use the "fernet" cipher. Defaults to `None`, which compares every chunk.
+- chunksize - The chunksize of `src`. Only needs to be given for version 1 files that don't use the default chunksize.
+
+The chunks are written first and the header last, so if `sync` is interrupted, running it again finishes the copy. With `since`, `dst` must not have been modified since the previous `sync`.\nRaises ValueError if `src` is compressed, or `since` is given for a file that doesn't use the "fernet" cipher, and `cryptography.fernet.InvalidToken` if a chunk of `src` written after `since` is invalid.'''
+    if since is not None:
+        if not isinstance(since, (int, float)):
+            raise TypeError("Invalid since, must be a number of seconds since the epoch or None")
+        if key is None:
+            raise ValueError("The key is needed to read the time chunks were written")
+    if chunksize is not None:
+        if not isinstance(chunksize, int):
+            raise TypeError("Invalid chunksize, must be integer greater than 0 or None")
+        if chunksize <= 0:
+            raise ValueError("Invalid chunksize, must be integer greater than 0 or None")
+
+    src_file = _open(src, "rb")
+    dst_file = _open(dst, "rb+" if isinstance(dst, str) and os.path.exists(dst) else "wb+")
+    try:
+        src_size = src_file.seek(0, os.SEEK_END)
+        header, header_size, _, _ = _read_metadata(_file_read_at(src_file), src_size)
+        if header is None: # an empty file
+            dst_file.seek(0)
+            dst_file.truncate()
+            return []
+        if get_compression(header.flags) is not None:
+            raise ValueError("Invalid src, compressed files can't be synced")
+        chunksize = header.chunksize or chunksize or DEFAULT_CHUNKSIZE
+        token_size = (FernetCipher if header.cipher == "fernet" else AEADCipher).token_size(chunksize)
+        if since is not None:
+            if header.cipher != "fernet":
+                raise ValueError(f"Only files encrypted with fernet record when chunks were written, src is encrypted with {header.cipher}")
+            cipher = FernetCipher(key if isinstance(key, FernetNoBase64) else FernetNoBase64(key))
+
+        # chunks can only be compared with a copy of the same file
+        dst_file.seek(0)
+        try:
+            existing = _read_header(dst_file.read)
+        except ValueError:
+            existing = None
+        same = existing is not None and existing._replace(last_chunk=0, last_chunk_padding=0) == header._replace(last_chunk=0, last_chunk_padding=0)
+        dst_chunks = max(dst_file.seek(0, os.SEEK_END)-header_size, 0)//token_size if same else 0
+        trailer_size = META_SIZE*2 if header.last_chunk == UNKNOWN_SIZE else 0 # written by encrypt_stream
+        end = src_size-trailer_size # where the chunks end
+
+        copied = []
+        for chunk in range(-(-max(end-header_size, 0)//token_size)): # round up
+            offset = header_size+chunk*token_size
+            src_file.seek(offset)
+            token = src_file.read(min(token_size, end-offset))
+            if chunk < dst_chunks:
+                if since is not None and cipher.timestamp(chunk, token) < int(since): # holes record when they were made too
+                    continue
+                dst_file.seek(offset)
+                if dst_file.read(len(token)) == token:
+                    continue
+            dst_file.seek(offset)
+            _write_all(dst_file, token)
+            copied.append(chunk)
+
+        # the header and trailer are written last, once every chunk they describe is in place
+        src_file.seek(end)
+        dst_file.seek(end)
+        _write_all(dst_file, src_file.read(trailer_size))
+        dst_file.truncate(src_size)
+        src_file.seek(0)
+        dst_file.seek(0)
+        _write_all(dst_file, src_file.read(header_size))
+        dst_file.flush()
+        return copied
+    finally:
+        if isinstance(src, str):
+            src_file.close()
+        if isinstance(dst, str):
+            dst_file.close()
@@ -0,0 +1,266 @@
+'''Encryption and decryption of whole directory trees on a process pool
+
+Encrypting a directory by opening a `FernetFile` for each file runs on a single core, and most of the time goes on Python code between the calls into the cryptography library.
+`encrypt_tree` and `decrypt_tree` spread the files across a pool of processes instead. Files are started largest first, so a big file found late doesn't leave one process working on its own at the end.
+
+Every chunk of an uncompressed file is at a fixed position, so a file bigger than `part_size` is split into parts, ranges of chunks that different processes encrypt or decrypt at the same time.
+The output file is created at its final size first, and each part writes its chunks straight to their positions. The header of an encrypted file is written last, once every chunk it describes has been written.
+
+Where the OS supports it, the disk space of each output file is allocated up front with `os.posix_fallocate`, so files written by several processes at once aren't fragmented.
+Every input file is read once, so the kernel is told to read ahead and to drop what has been read from the page cache, leaving the cache for data that will be used again.'''
+
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import Callable
+from cryptography.fernet import InvalidToken
+from fernet_files import FernetFile, DEFAULT_CHUNKSIZE, FORMAT_VERSION, FileHeader, _header_size, _read_metadata, _file_read_at, _pack_header, _get_cipher, _regular_fileno, _fadvise, _preallocate
+from fernet_files.ciphers import CIPHERS
+from fernet_files.compression import get_compression
+from fernet_files.custom_fernet import FernetNoBase64
+from fernet_files.streaming import _validate, _write_all
+
+DEFAULT_PART_SIZE = 67_108_864
+'''Files bigger than this many bytes are split into parts of about this size by `encrypt_tree` and `decrypt_tree`.'''
+
+_BATCH_SIZE = 4_194_304 # the data read and written at once by a part, in bytes
+
+class FileResult(namedtuple("FileResult", ("path", "size", "seconds"))):
+    '''Returned for every file by `encrypt_tree` and `decrypt_tree`. `path` is relative to the directory, `size` is the number of bytes of data, and `seconds` is the time processes spent on the file, added together over its parts.'''
+
+    __slots__ = ()
+
+    @property
+    def throughput(self) -> float:
+        '''The speed the file was processed at, in bytes of data per second.'''
+        return self.size/self.seconds if self.seconds else 0.0
+
+class TreeResult(namedtuple("TreeResult", ("files", "size", "seconds"))):
+    '''Returned by `encrypt_tree` and `decrypt_tree`. `files` is a list of `FileResult` in the order the files finished, `size` is the number of bytes of data in every file added together and `seconds` is the time the whole tree took.'''
+
+    __slots__ = ()
+
+    @property
+    def throughput(self) -> float:
+        '''The speed the whole tree was processed at, in bytes of data per second.'''
+        return self.size/self.seconds if self.seconds else 0.0
+
+def _walk(src_dir: str, dst_dir: str) -> list[str]:
+    '''Returns the paths of the regular files in `src_dir`, relative to it, and creates every directory of the tree in `dst_dir`.'''
+    paths = []
+    for directory, _, files in os.walk(src_dir):
+        relative = os.path.relpath(directory, src_dir)
+        os.makedirs(os.path.join(dst_dir, relative), exist_ok=True)
+        paths += [os.path.normpath(os.path.join(relative, name)) for name in files if os.path.isfile(os.path.join(directory, name))]
+    return paths
+
+def _parts(chunks: int, chunksize: int, part_size: int) -> list[range]:
+    '''Splits the chunks of a file into ranges of about `part_size` bytes of data.'''
+    step = max(part_size//chunksize, 1)
+    return [range(first, min(first+step, chunks)) for first in range(0, chunks, step)]
+
+def _create(dst: str, size: int) -> None:
+    '''Creates the file `dst` with `size` bytes, allocating its disk space if possible. Space that isn't allocated is left sparse.'''
+    with open(dst, "wb") as dst_file:
+        if not _preallocate(_regular_fileno(dst_file), 0, size):
+            dst_file.truncate(size)
+
+def _read_once(src_file, offset: int, size: int) -> bytes:
+    '''Reads `size` bytes from `src_file` at its current position, which is `offset`, then tells the kernel they won't be needed again.'''
+    data = src_file.read(size)
+    _fadvise(_regular_fileno(src_file), offset, len(data), "POSIX_FADV_DONTNEED")
+    return data
+
+def _encrypt_part(src: str, dst: str, fernet: FernetNoBase64, header: FileHeader, size: int, chunks: range, whole: bool) -> tuple[int, float]:
+    '''Encrypts a range of chunks of the file `src`, which holds `size` bytes, into `dst`. If `whole` is True, the range is the whole file, so `dst` is created and its header is written at the end. Returns the number of bytes of data encrypted and the time taken. Run on the process pool.'''
+    start = time.perf_counter()
+    cipher = _get_cipher(fernet, header)
+    chunksize, header_size = header.chunksize, _header_size(header.version)
+    batch, done = max(_BATCH_SIZE//chunksize, 1), 0
+    if whole:
+        _create(dst, header_size+len(chunks)*cipher.token_size(chunksize))
+    with open(src, "rb") as src_file, open(dst, "rb+") as dst_file:
+        _fadvise(_regular_fileno(src_file), chunks.start*chunksize, len(chunks)*chunksize, "POSIX_FADV_SEQUENTIAL")
+        src_file.seek(chunks.start*chunksize)
+        dst_file.seek(header_size+chunks.start*cipher.token_size(chunksize))
+        for first in range(chunks.start, chunks.stop, batch):
+            batch_chunks = range(first, min(first+batch, chunks.stop))
+            data = memoryview(_read_once(src_file, first*chunksize, min(len(batch_chunks)*chunksize, size-first*chunksize)))
+            done += len(data)
+            plaintext = [bytes(data[i*chunksize:(i+1)*chunksize]).ljust(chunksize, b"\0") for i in range(len(batch_chunks))]
+            for token in cipher.encrypt_many(batch_chunks, plaintext):
+                _write_all(dst_file, token)
+        if whole:
+            dst_file.seek(0)
+            _write_all(dst_file, _pack_header(header))
+    return done, time.perf_counter()-start
+
+def _decrypt_part(src: str, dst: str, fernet: FernetNoBase64, header: FileHeader, chunksize: int, size: int, chunks: range) -> tuple[int, float]:
+    '''Decrypts a range of chunks of the uncompressed file `src`, which holds `size` bytes of data, into `dst`, which has already been created at its final size. Holes aren't written, so they stay as zeros. Raises ValueError if `src` is shorter than its header says. Returns the number of bytes of data in the range and the time taken. Run on the process pool.'''
+    start = time.perf_counter()
+    cipher = _get_cipher(fernet, header)
+    header_size, token_size = _header_size(header.version), cipher.token_size(chunksize)
+    batch = max(_BATCH_SIZE//chunksize, 1)
+    with open(src, "rb") as src_file, open(dst, "rb+") as dst_file:
+        _fadvise(_regular_fileno(src_file), header_size+chunks.start*token_size, len(chunks)*token_size, "POSIX_FADV_SEQUENTIAL")
+        src_file.seek(header_size+chunks.start*token_size)
+        for first in range(chunks.start, chunks.stop, batch):
+            span = min(first+batch, chunks.stop)*token_size-first*token_size
+            tokens = memoryview(_read_once(src_file, header_size+first*token_size, span))
+            if len(tokens) < span: # otherwise the missing chunks would be left as zeros
+                raise ValueError(f"{src} ended before chunk {first+len(tokens)//token_size}")
+            for i in range(0, len(tokens), token_size):
+                chunk, token = first+i//token_size, bytes(tokens[i:i+token_size])
+                if not cipher.is_hole(chunk, token):
+                    dst_file.seek(chunk*chunksize)
+                    _write_all(dst_file, cipher.decrypt(chunk, token)[:size-chunk*chunksize])
+    return min(chunks.stop*chunksize, size)-chunks.start*chunksize, time.perf_counter()-start
+
+def _decrypt_file(src: str, dst: str, fernet: FernetNoBase64, chunksize: int | None) -> tuple[int, float]:
+    '''Decrypts the whole file `src` into `dst` with `FernetFile`, which reads every kind of file, including compressed files. Returns the number of bytes of data decrypted and the time taken. Run on the process pool.'''
+    start, done = time.perf_counter(), 0
+    with FernetFile(fernet, open(src, "rb"), chunksize, access="noreuse") as fernet_file, open(dst, "wb") as dst_file:
+        size = fernet_file.seek(0, os.SEEK_END)
+        _preallocate(_regular_fileno(dst_file), 0, size)
+        fernet_file.seek(0)
+        while data := fernet_file.read(max(_BATCH_SIZE//fernet_file.chunksize, 1)*fernet_file.chunksize):
+            _write_all(dst_file, data)
+            done += len(data)
+    if done != size: # read returns no data when a chunk is invalid
+        raise InvalidToken
+    return done, time.perf_counter()-start
+
+def _data_size(path: str, chunksize: int | None) -> tuple[FileHeader | None, int, int]:
+    '''Returns the header of an encrypted file, its chunksize and the size of its data. The size of a compressed file isn't stored in its header, so it's 0.'''
+    with open(path, "rb") as f:
+        header, _, last_chunk, last_chunk_padding = _read_metadata(_file_read_at(f), f.seek(0, os.SEEK_END))
+        if header is None:
+            return None, chunksize or DEFAULT_CHUNKSIZE, 0
+        chunksize = header.chunksize or chunksize or DEFAULT_CHUNKSIZE
+        if get_compression(header.flags) is not None:
+            return header, chunksize, 0
+        if last_chunk_padding > chunksize:
+            raise ValueError(f"Invalid metadata in {path}")
+    return header, chunksize, (last_chunk+1)*chunksize-last_chunk_padding
+
+def _write_header(dst: str, header: FileHeader) -> None:
+    '''Writes the header of an encrypted file that was split into parts, once every part has finished.'''
+    with open(dst, "rb+") as dst_file:
+        _write_all(dst_file, _pack_header(header))
+
+def _validate_tree(workers: int | None, part_size: int) -> int:
+    '''Validates the arguments shared by `encrypt_tree` and `decrypt_tree`, and returns the number of processes to use.'''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    elif not isinstance(workers, int):
+        raise TypeError("Invalid number of workers, must be integer greater than 0 or None")
+    elif workers <= 0:
+        raise ValueError("Invalid number of workers, must be integer greater than 0 or None")
+    if not isinstance(part_size, int):
+        raise TypeError("Invalid part_size, must be integer greater than 0")
+    if part_size <= 0:
+        raise ValueError("Invalid part_size, must be integer greater than 0")
+    return workers
+
+def _run(tasks: list[tuple[str, int, Callable, tuple]], finish: dict[str, Callable[[], None]], workers: int, callback: Callable[[FileResult], None] | None, start: float) -> TreeResult:
+    '''Runs `(path, size, function, args)` tasks on a process pool, largest first, and adds up the data processed and the time taken by the parts of each file. Once every part of a file has finished, `finish[path]()` is called in this process if there is one.\nIf a task raises an exception, the tasks that haven't started are cancelled and the exception is raised.'''
+    remaining = {} # the number of unfinished parts of each file
+    for path, *_ in tasks:
+        remaining[path] = remaining.get(path, 0)+1
+    sizes, seconds, results = dict.fromkeys(remaining, 0), dict.fromkeys(remaining, 0.0), []
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(function, *args): path for path, _, function, args in sorted(tasks, key=lambda task: task[1], reverse=True)}
+        for future in as_completed(futures):
+            path = futures[future]
+            size, time_taken = future.result()
+            sizes[path] += size
+            seconds[path] += time_taken
+            remaining[path] -= 1
+            if not remaining[path]:
+                if path in finish:
+                    finish[path]()
+                results.append(FileResult(path, sizes[path], seconds[path]))
+                if callback is not None:
+                    callback(results[-1])
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return TreeResult(results, sum(sizes.values()), time.perf_counter()-start)
+
+def encrypt_tree(src_dir: str, dst_dir: str, key: bytes | FernetNoBase64, workers: int | None = None, chunksize: int | str | None = None, cipher: str | None = None, part_size: int = DEFAULT_PART_SIZE, callback: Callable[[FileResult], None] | None = None) -> TreeResult:
+    '''Encrypts every file in the directory `src_dir` and its subdirectories into a file with the same path in `dst_dir`, on a pool of processes. Returns a `TreeResult`.
+
+Parameters:
+
+- src_dir - The directory to encrypt.
+- dst_dir - The directory to write the encrypted files to. It's created if it doesn't exist, and files that already exist are overwritten.
+- key - The same as `FernetFile`.
+- workers - The number of processes. Defaults to `None`, which uses one process per CPU.
+- chunksize - The same as `FernetFile`. "auto" picks a chunksize for sequential access from the size of each file.
+- cipher - The same as `FernetFile`. Defaults to "fernet".
+- part_size - Files bigger than this many bytes are split into parts of about this size that are encrypted at the same time.
+- callback - Called as `callback(result)` with a `FileResult` in this process as each file finishes.
+
+The files can be opened with `FernetFile` or decrypted with `decrypt_tree`, using the same key. Raises the exception of the first file that fails, after cancelling the files that haven't started.'''
+    start = time.perf_counter()
+    fernet = _validate(key, chunksize)
+    if cipher is None:
+        cipher = "fernet"
+    elif not isinstance(cipher, str):
+        raise TypeError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+    elif cipher not in CIPHERS:
+        raise ValueError("Invalid cipher, must be one of "+", ".join(CIPHERS)+" or None")
+    workers = _validate_tree(workers, part_size)
+
+    tasks, finish = [], {}
+    for path in _walk(src_dir, dst_dir):
+        src, dst = os.path.join(src_dir, path), os.path.join(dst_dir, path)
+        size = os.path.getsize(src)
+        file_chunksize = FernetFile.auto_chunksize(size, "sequential") if chunksize == "auto" else chunksize or DEFAULT_CHUNKSIZE
+        last_chunk = max(0, -(-size//file_chunksize)-1) # same calculation as FernetFile, a file with no data is a single chunk made entirely of padding
+        header = FileHeader(FORMAT_VERSION, cipher, 0, file_chunksize, os.urandom(16), last_chunk, (last_chunk+1)*file_chunksize-size)
+        chunks = last_chunk+1 if size else 0
+        if size <= part_size:
+            tasks.append((path, size, _encrypt_part, (src, dst, fernet, header, size, range(chunks), True)))
+            continue
+        # the file is created at its final size with an empty header, and its header is written once every part has finished
+        _create(dst, _header_size(FORMAT_VERSION)+chunks*_get_cipher(fernet, header).token_size(file_chunksize))
+        tasks += [(path, len(part)*file_chunksize, _encrypt_part, (src, dst, fernet, header, size, part, False)) for part in _parts(chunks, file_chunksize, part_size)]
+        finish[path] = partial(_write_header, dst, header)
+    return _run(tasks, finish, workers, callback, start)
+
+def decrypt_tree(src_dir: str, dst_dir: str, key: bytes | FernetNoBase64, workers: int | None = None, chunksize: int | None = None, part_size: int = DEFAULT_PART_SIZE, callback: Callable[[FileResult], None] | None = None) -> TreeResult:
+    '''Decrypts every file in the directory `src_dir` and its subdirectories into a file with the same path in `dst_dir`, on a pool of processes. Returns a `TreeResult`.
+
+Parameters:
+
+- src_dir - The directory to decrypt.
+- dst_dir - The directory to write the decrypted files to. It's created if it doesn't exist, and files that already exist are overwritten.
+- key - The same as `FernetFile`.
+- workers - The number of processes. Defaults to `None`, which uses one process per CPU.
+- chunksize - The same as `FernetFile`. Only needs to be given for version 1 files that don't use the default chunksize.
+- part_size - Files with more than this many bytes of data are split into parts of about this size that are decrypted at the same time. Compressed files are never split.
+- callback - Called as `callback(result)` with a `FileResult` in this process as each file finishes.
+
+Raises the exception of the first file that fails, such as `cryptography.fernet.InvalidToken` if a chunk is invalid, after cancelling the files that haven't started.'''
+    start = time.perf_counter()
+    fernet = key if isinstance(key, FernetNoBase64) else FernetNoBase64(key) # key validation
+    if chunksize is not None:
+        if not isinstance(chunksize, int):
+            raise TypeError("Invalid chunksize, must be integer greater than 0 or None")
+        if chunksize <= 0:
+            raise ValueError("Invalid chunksize, must be integer greater than 0 or None")
+    workers = _validate_tree(workers, part_size)
+
+    tasks = []
+    for path in _walk(src_dir, dst_dir):
+        src, dst = os.path.join(src_dir, path), os.path.join(dst_dir, path)
+        header, file_chunksize, size = _data_size(src, chunksize)
+        if size <= part_size: # includes compressed files, whose size is only known once they're opened, so they're ordered by their size on disk
+            tasks.append((path, size or os.path.getsize(src), _decrypt_file, (src, dst, fernet, chunksize)))
+            continue
+        _create(dst, size) # holes aren't written, so they're left as zeros
+        tasks += [(path, len(part)*file_chunksize, _decrypt_part, (src, dst, fernet, header, file_chunksize, size, part)) for part in _parts(-(-size//file_chunksize), file_chunksize, part_size)]
+    return _run(tasks, {}, workers, callback, start)
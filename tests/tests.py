@@ -1,10 +1,22 @@
 import unittest
+import asyncio
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import fernet_files
 from fernet_files.custom_fernet import FernetNoBase64
-from io import BytesIO, UnsupportedOperation
+from cryptography.fernet import InvalidToken
+from io import BytesIO, RawIOBase, UnsupportedOperation
 from random import randint
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from io import TextIOWrapper
+from unittest.mock import patch
+from fernet_files.cli import main, _block, _MAX_BLOCK
 try:
     from tqdm import tqdm # optional progress bar
     TQDM_AVAILABLE = True
@@ -59,6 +71,1124 @@ class TestFernetFiles(unittest.TestCase):
         for chunksize in (0, -1, -2):
             self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), chunksize=chunksize)
 
+    def test_invalid_workers(self):
+        for workers in (1.5, "1", b"1"):
+            self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), workers=workers)
+        for workers in (0, -1, -2):
+            self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), workers=workers)
+
+    def test_workers(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, workers=4) as fernet_file:
+                    fernet_file.write(input_data)
+                    fernet_file.seek(0)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    test_other_read(self, fernet_file, input_data)
+                    input_data = test_random_writes(self, fernet_file, chunksize, input_data)
+                f.seek(0)
+                with fernet_files.FernetFile(key, f, chunksize) as fernet_file: # readable without workers
+                    self.assertEqual(fernet_file.read(), input_data)
+        execute_test("test_workers", test)
+        test_dropped_on_pool_thread(self, workers=2, read_ahead=2) # read_ahead uses the workers
+
+    def test_invalid_read_ahead(self):
+        for read_ahead in (1.5, "1", None):
+            self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), read_ahead=read_ahead)
+        for read_ahead in (-1, -2):
+            self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), read_ahead=read_ahead)
+
+    def test_read_ahead(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, read_ahead=4) as fernet_file:
+                    fernet_file.write(input_data)
+                    fernet_file.seek(0)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    test_other_read(self, fernet_file, input_data)
+                    fernet_file.seek(0)
+                    data = bytearray() # sequential reads smaller than a chunk
+                    while x := fernet_file.read(chunksize//3+1):
+                        data += x
+                    self.assertEqual(data, input_data)
+                    input_data = test_random_writes(self, fernet_file, chunksize, input_data) # writes invalidate decrypted chunks
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), input_data)
+        execute_test("test_read_ahead", test)
+        test_dropped_on_pool_thread(self, read_ahead=2)
+        # chunks decrypted in advance that won't be read are cancelled if they haven't started
+        class BlockingFernet(FernetNoBase64):
+            def decrypt(self, token, ttl=None):
+                if threading.current_thread() is not threading.main_thread():
+                    background.append(token)
+                    release.wait(10)
+                return super().decrypt(token, ttl)
+        key, release, background = FernetNoBase64.generate_key(), threading.Event(), []
+        with BytesIO() as f:
+            with fernet_files.FernetFile(key, f, 16) as fernet_file:
+                fernet_file.write(bytes(range(16))*20)
+            f.seek(0)
+            with fernet_files.FernetFile(BlockingFernet(key), f, read_ahead=4, stats=True) as fernet_file:
+                fernet_file.read(1) # starts decrypting chunks 1 to 4, the first of them blocks the pool
+                fernet_file.seek(16*10)
+                self.assertEqual(fernet_file.read(1), b"\0")
+                release.set()
+                stats = fernet_file.stats()
+            self.assertEqual(len(background), 1)
+            self.assertEqual(stats.wasted_decrypts, 1)
+
+    def test_invalid_cache_size(self):
+        for cache_size in (1.5, "1", None):
+            self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), cache_size=cache_size)
+        for cache_size in (-1, -2):
+            self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), cache_size=cache_size)
+
+    def test_cache(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, cache_size=chunksize*4) as fernet_file:
+                    fernet_file.write(input_data)
+                    fernet_file.seek(0)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    hits = fernet_file.cache_info().hits
+                    for x in (0, len(input_data)//2, max(len(input_data)-1, 0), 0, len(input_data)//2): # hop between regions
+                        fernet_file.seek(x)
+                        self.assertEqual(fernet_file.read(1), input_data[x:x+1])
+                    if len(input_data) > chunksize: # more than one chunk
+                        self.assertGreater(fernet_file.cache_info().hits, hits)
+                    input_data = test_random_writes(self, fernet_file, chunksize, input_data)
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), input_data)
+                    info = fernet_file.cache_info()
+                    self.assertIsInstance(info, fernet_files.CacheInfo)
+                    self.assertLessEqual(info.currsize, info.maxsize)
+                    self.assertEqual(info.maxsize, chunksize*4)
+                    fernet_file.seek(0)
+                    fernet_file.read(1) # the first chunk is cached
+                    fernet_file.truncate(0) # cached chunks must not bring back the old data
+                    fernet_file.seek(len(input_data))
+                    fernet_file.write(b"x")
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), bytes(len(input_data))+b"x")
+        execute_test("test_cache", test)
+
+    def test_invalid_write_buffer(self):
+        for write_buffer in (1.5, "1", None):
+            self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), write_buffer=write_buffer)
+        for write_buffer in (-1, -2):
+            self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), write_buffer=write_buffer)
+
+    def test_write_buffer(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, write_buffer=chunksize*8) as fernet_file:
+                    fernet_file.write(input_data)
+                    fernet_file.seek(0)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    input_data = test_random_writes(self, fernet_file, chunksize, input_data)
+                    for x in (0, len(input_data)): # alternate between the start and the end
+                        fernet_file.seek(x)
+                        fernet_file.write(b"123")
+                        input_data = input_data[:x] + b"123" + input_data[x+3:]
+                    fernet_file.flush()
+                    f.seek(0)
+                    with fernet_files.FernetFile(key, f, chunksize) as other: # flushed data is on disk
+                        self.assertEqual(other.read(), input_data)
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), input_data)
+                    fernet_file.write(b"456")
+                    input_data += b"456"
+                f.seek(0)
+                with fernet_files.FernetFile(key, f, chunksize) as fernet_file: # close flushes
+                    self.assertEqual(fernet_file.read(), input_data)
+        execute_test("test_write_buffer", test)
+
+    def test_write_buffer_gap(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            for kwargs in ({}, {"read_ahead": 2, "workers": 2}):
+                for truncate in (False, True):
+                    with BytesIO() as f:
+                        with fernet_files.FernetFile(key, f, chunksize, write_buffer=len(input_data)+chunksize*8, **kwargs) as fernet_file:
+                            fernet_file.write(input_data)
+                            data = input_data
+                            if truncate:
+                                data = data[:len(data)//2]
+                                fernet_file.truncate(len(data))
+                            fernet_file.seek(len(data)+chunksize*3+1) # the chunks skipped over are still only in the write buffer
+                            fernet_file.write(b"end")
+                            data += bytes(chunksize*3+1)+b"end"
+                            fernet_file.seek(0)
+                            self.assertEqual(fernet_file.read(), data)
+                            test_random_reads(self, fernet_file, chunksize, data)
+                        f.seek(0)
+                        with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                            self.assertEqual(fernet_file.read(), data)
+        execute_test("test_write_buffer_gap", test)
+
+    def test_reopen_without_writing(self):
+        key = fernet_files.FernetFile.generate_key()
+        input_data = os.urandom(1000)
+        with BytesIO() as f:
+            with fernet_files.FernetFile(key, f, 16) as fernet_file:
+                fernet_file.write(input_data)
+            f.seek(0)
+            fernet_files.FernetFile(key, f, 16).close() # open and close read-write without writing
+            f.seek(0)
+            with fernet_files.FernetFile(key, f, 16) as fernet_file:
+                self.assertEqual(fernet_file.read(), input_data)
+
+    def test_readinto(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                    fernet_file.write(bytearray(input_data))
+                    fernet_file.seek(0)
+                    buffer = bytearray(len(input_data)+10)
+                    self.assertEqual(fernet_file.readinto(buffer), len(input_data))
+                    self.assertEqual(buffer[:len(input_data)], input_data)
+                    self.assertEqual(fernet_file.readinto(buffer), 0) # end of file
+                    for _ in range(100):
+                        x = randint(0, len(input_data))
+                        y = randint(x, x+chunksize*3)
+                        buffer = bytearray(y-x)
+                        fernet_file.seek(x)
+                        self.assertEqual(fernet_file.readinto(memoryview(buffer)), len(input_data[x:y]))
+                        self.assertEqual(buffer[:len(input_data[x:y])], input_data[x:y])
+                        fernet_file.seek(x)
+                        size = fernet_file.readinto1(buffer) # never past the end of the chunk
+                        self.assertEqual(size, min(y-x, chunksize-x%chunksize, max(len(input_data)-x, 0)))
+                        self.assertEqual(buffer[:size], input_data[x:x+size])
+                    self.assertRaises(TypeError, fernet_file.readinto, 1)
+        execute_test("test_readinto", test)
+
+    def test_write_bytes_like(self):
+        for chunksize in (1, 16, 100):
+            key = fernet_files.FernetFile.generate_key()
+            input_data = os.urandom(chunksize*10)
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                    self.assertEqual(fernet_file.write(bytearray(input_data[:chunksize])), chunksize)
+                    self.assertEqual(fernet_file.seek(0, os.SEEK_CUR), chunksize) # position is after a write ending on a chunk boundary
+                    self.assertEqual(fernet_file.write(memoryview(input_data)[chunksize:chunksize*5]), chunksize*4)
+                    self.assertEqual(fernet_file.write(memoryview(bytearray(input_data[chunksize*5:])).cast("B", (chunksize*5,))), chunksize*5)
+                    self.assertRaises(TypeError, fernet_file.write, "string")
+                    self.assertRaises(TypeError, fernet_file.write, 1)
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), input_data)
+
+    def test_lazy_chunks(self):
+        decrypted = []
+        class CountingFernet(FernetNoBase64):
+            def decrypt(self, token, ttl=None):
+                decrypted.append(token)
+                return super().decrypt(token, ttl)
+        chunksize = 16
+        input_data = os.urandom(chunksize*10)
+        with BytesIO() as f:
+            with fernet_files.FernetFile(CountingFernet(FernetNoBase64.generate_key()), f, chunksize) as fernet_file:
+                fernet_file.write(input_data)
+                for x in (5, 50, 100, 0): # seeking never decrypts
+                    self.assertEqual(fernet_file.seek(x), x)
+                fernet_file.seek(-3, os.SEEK_END)
+                fernet_file.seek(-20, os.SEEK_CUR)
+                self.assertEqual(decrypted, [])
+                fernet_file.seek(chunksize)
+                new_data = os.urandom(chunksize*5)
+                fernet_file.write(new_data) # whole chunks are overwritten without decrypting them
+                self.assertEqual(decrypted, [])
+                input_data = input_data[:chunksize] + new_data + input_data[chunksize*6:]
+                fernet_file.seek(chunksize*2+3)
+                self.assertEqual(fernet_file.read(5), input_data[chunksize*2+3:chunksize*2+8])
+                self.assertEqual(len(decrypted), 1) # only the chunk that was read
+                fernet_file.seek(0)
+                self.assertEqual(fernet_file.read(), input_data)
+
+    def test_sparse(self):
+        class CountingFernet(FernetNoBase64):
+            def encrypt(self, data):
+                encrypted.append(data)
+                return super().encrypt(data)
+            def decrypt(self, token, ttl=None):
+                decrypted.append(token)
+                return super().decrypt(token, ttl)
+            def decrypt_many(self, tokens, out=None):
+                decrypted.extend(tokens)
+                return super().decrypt_many(tokens, out)
+        chunksize = 16
+        for use_mmap in (False, True):
+            encrypted, decrypted = [], []
+            with open("test", "wb+") as f:
+                with fernet_files.FernetFile(CountingFernet(FernetNoBase64.generate_key()), f, chunksize, use_mmap=use_mmap) as fernet_file:
+                    fernet_file.write(b"abc")
+                    fernet_file.seek(chunksize*1000)
+                    fernet_file.write(b"xyz") # the chunks in between are holes
+                    self.assertEqual(len(encrypted), 1)
+                    fernet_file.seek(0)
+                    self.assertEqual(fernet_file.read(), b"abc"+bytes(chunksize*1000-3)+b"xyz")
+                    self.assertEqual(len(decrypted), 2) # holes are read without decrypting
+        def test(chunksize, input_data):
+            for cache_size in (0, chunksize*4): # cached chunks are truncated too
+                data = input_data
+                with BytesIO() as f:
+                    with fernet_files.FernetFile(fernet_files.FernetFile.generate_key(), f, chunksize, cache_size=cache_size) as fernet_file:
+                        fernet_file.write(data)
+                        for size in (len(data)//2, len(data)+chunksize+5, max(len(data)-1, 0), 0, 1):
+                            data = data[:size].ljust(size, b"\0")
+                            self.assertEqual(fernet_file.truncate(size), size)
+                            fernet_file.seek(0)
+                            self.assertEqual(fernet_file.read(), data)
+                            self.assertEqual(fernet_file.seek(0, os.SEEK_END), size)
+                        fernet_file.seek(3)
+                        self.assertEqual(fernet_file.truncate(), 3) # defaults to the current position
+                        self.assertRaises(ValueError, fernet_file.truncate, -1)
+                        written = fernet_file.close()
+                    # the underlying file is truncated too
+                    header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+                    self.assertEqual(len(written.getvalue()), header_size+-(-3//chunksize)*(chunksize+73-chunksize%16))
+        execute_test("test_sparse", test)
+        header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+        for cipher in fernet_files.CIPHERS: # only holes are read as zeros, not chunks that have been zeroed, moved or cut off
+            key = fernet_files.FernetFile.generate_key()
+            data = os.urandom(300)
+            with open("test", "wb+") as f, fernet_files.FernetFile(key, f, 100, cipher=cipher) as fernet_file:
+                fernet_file.write(data)
+                fernet_file.seek(1000)
+                fernet_file.write(b"x") # chunks 3 to 9 are holes
+                fernet_file.truncate(1500) # chunks 11 to 14 are holes
+            token_size = (fernet_files.ciphers.FernetCipher if cipher == "fernet" else fernet_files.ciphers.AEADCipher).token_size(100)
+            with open("test", "rb+") as f:
+                original = f.read()
+                f.seek(header_size+token_size)
+                f.write(bytes(token_size)) # chunk 1 is zeroed
+                if cipher != "fernet": # AEAD hole tokens belong to their chunk
+                    f.seek(header_size+token_size*3)
+                    hole = f.read(token_size)
+                    f.seek(header_size+token_size*5)
+                    f.write(hole)
+            self.assertEqual(fernet_files.verify("test", key), [1] if cipher == "fernet" else [1, 5])
+            with fernet_files.FernetReader(key, "test") as reader:
+                self.assertEqual(reader.pread(0, 100), data[:100])
+                self.assertRaises(InvalidToken, reader.pread, 100, 100)
+                self.assertEqual(reader.pread(300, 200), bytes(200))
+                self.assertEqual(reader.pread(1000, 500), b"x"+bytes(499))
+            with fernet_files.FernetFile(key, "test") as fernet_file:
+                self.assertEqual(fernet_file.read(), data[:100]+data[200:]+bytes(700 if cipher == "fernet" else 600)+b"x"+bytes(499)) # empty like any other modified chunk, not zeros
+                fernet_file.seek(300)
+                self.assertEqual(fernet_file.read(200), bytes(200))
+                self.assertRaises(InvalidToken, fernet_file.truncate, 150)
+            with open("test", "rb") as f:
+                self.assertRaises(InvalidToken, fernet_files.decrypt_stream, f, BytesIO(), key)
+            self.assertRaises(InvalidToken, fernet_files.rewrap, "test", "test2", key, key)
+            with open("test", "wb") as f: # the last chunks are cut off
+                f.write(original[:header_size+token_size*12])
+            self.assertRaises(ValueError, fernet_files.verify, "test", key)
+            with fernet_files.FernetReader(key, "test") as reader:
+                self.assertEqual(reader.pread(1000, 200), b"x"+bytes(199))
+                self.assertRaises(InvalidToken, reader.pread, 1200, 100)
+            with open("test", "rb") as f:
+                self.assertRaises(ValueError, fernet_files.decrypt_stream, f, BytesIO(), key)
+
+    def test_append(self):
+        class CountingFernet(FernetNoBase64):
+            def encrypt(self, data):
+                encrypted.append(data)
+                return super().encrypt(data)
+            def decrypt(self, token, ttl=None):
+                decrypted.append(token)
+                return super().decrypt(token, ttl)
+        key = FernetNoBase64.generate_key()
+        chunksize = 100
+        input_data = os.urandom(chunksize*3+50)
+        with BytesIO() as f:
+            with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                fernet_file.write(input_data)
+            encrypted, decrypted = [], []
+            with fernet_files.FernetFile(CountingFernet(key), f, append=True) as fernet_file:
+                self.assertEqual(fernet_file.seek(0, os.SEEK_CUR), len(input_data))
+                for _ in range(60):
+                    record = os.urandom(10)
+                    fernet_file.seek(0) # writes still go to the end
+                    fernet_file.write(record)
+                    input_data += record
+                self.assertEqual(len(decrypted), 1) # only the last chunk, once
+                self.assertEqual(len(encrypted), 6) # only chunks that were filled
+                fernet_file.seek(0)
+                self.assertEqual(fernet_file.read(), input_data)
+            with fernet_files.FernetFile(key, f) as fernet_file:
+                self.assertEqual(fernet_file.read(), input_data)
+        self.assertRaises(TypeError, fernet_files.FernetFile, key, BytesIO(), append=1)
+
+    def test_reader(self):
+        class Pipe(RawIOBase): # a stream that can't seek
+            def __init__(self, data):
+                self.data = BytesIO(data)
+            def readable(self):
+                return True
+            def readinto(self, buffer):
+                return self.data.readinto(buffer)
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with open("test", "wb+") as f:
+                with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                    fernet_file.write(input_data)
+            with open("test", "rb") as f:
+                data = f.read()
+            ranges = [(randint(0, len(input_data)+1), randint(-1, chunksize*3)) for _ in range(100)]
+            for file in ("test", BytesIO(data)): # os.pread, and seek and read under a lock
+                with fernet_files.FernetReader(key, file, cache_size=chunksize*4) as reader:
+                    self.assertEqual(reader.size, len(input_data))
+                    self.assertEqual(reader.chunksize, chunksize)
+                    self.assertEqual(reader.pread(0), input_data)
+                    with ThreadPoolExecutor(max_workers=8) as executor:
+                        results = list(executor.map(lambda x: reader.pread(*x), ranges))
+                    for (offset, size), data in zip(ranges, results):
+                        self.assertEqual(data, input_data[offset:] if size < 0 else input_data[offset:offset+size])
+                    self.assertLessEqual(reader.cache_info().currsize, chunksize*4)
+        execute_test("test_reader", test)
+        key = fernet_files.FernetFile.generate_key()
+        input_data = os.urandom(1000)
+        with BytesIO() as f: # metadata in a trailer
+            fernet_files.encrypt_stream(Pipe(input_data), f, key, 100)
+            with fernet_files.FernetReader(key, f) as reader:
+                self.assertEqual(reader.pread(950, 100), input_data[950:])
+            f.seek(-300, os.SEEK_END) # modified chunk
+            f.write(bytes(10))
+            with fernet_files.FernetReader(key, f) as reader:
+                self.assertEqual(reader.pread(0, 10), input_data[:10])
+                self.assertRaises(InvalidToken, reader.pread, 850, 10)
+        with fernet_files.FernetReader(key, BytesIO()) as reader:
+            self.assertEqual(reader.pread(0), b"")
+            self.assertRaises(TypeError, reader.pread, 1.5)
+            self.assertRaises(ValueError, reader.pread, -1)
+        self.assertRaises(ValueError, reader.pread, 0)
+        self.assertRaises(TypeError, fernet_files.FernetReader, key, BytesIO(), cache_size=None)
+        self.assertRaises(ValueError, fernet_files.FernetReader, key, BytesIO(), chunksize=0)
+
+    def test_verify(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            for cipher in ("fernet", "aes-gcm"):
+                with open("test", "wb+") as f:
+                    with fernet_files.FernetFile(key, f, chunksize, cipher=cipher) as fernet_file:
+                        fernet_file.write(input_data)
+                        self.assertEqual(fernet_file.verify(2), [])
+                self.assertEqual(fernet_files.verify("test", key, workers=2), [])
+                checked = []
+                self.assertEqual(fernet_files.verify("test", key, workers=2, callback=lambda chunk, size: checked.append((chunk, size))), [])
+                token_size = chunksize+(73-chunksize%16 if cipher == "fernet" else 28)
+                self.assertEqual(checked, [(chunk, token_size) for chunk in range(-(-len(input_data)//chunksize))]) # in order, with the size on disk
+                if len(input_data) > chunksize*2:
+                    with open("test", "rb+") as f: # modify chunks 0 and 2
+                        header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+                        for chunk in (0, 2):
+                            f.seek(header_size+chunk*(chunksize+(73-chunksize%16 if cipher == "fernet" else 28))+5)
+                            x = f.read(1)
+                            f.seek(-1, os.SEEK_CUR)
+                            f.write(bytes((x[0]^1,)))
+                    self.assertEqual(fernet_files.verify("test", key), [0, 2])
+                    with open("test", "rb+") as f: # zero chunk 1, which isn't a hole
+                        token_size = chunksize+(73-chunksize%16 if cipher == "fernet" else 28)
+                        f.seek(header_size+token_size)
+                        f.write(bytes(token_size))
+                    self.assertEqual(fernet_files.verify("test", key), [0, 1, 2])
+                    with open("test", "rb+") as f: # truncated
+                        f.truncate(os.path.getsize("test")-1)
+                    self.assertRaises(ValueError, fernet_files.verify, "test", key)
+        execute_test("test_verify", test)
+        key = fernet_files.FernetFile.generate_key()
+        with BytesIO() as f:
+            with fernet_files.FernetFile(key, f, 100) as fernet_file:
+                fernet_file.seek(1000) # holes are valid
+                fernet_file.write(b"1")
+            self.assertEqual(fernet_files.verify(f, key), [])
+        self.assertRaises(ValueError, fernet_files.FernetFile(key, BytesIO()).verify, 0)
+        self.assertRaises(TypeError, fernet_files.FernetFile(key, BytesIO()).verify, 1.5)
+        self.assertRaises(TypeError, fernet_files.FernetFile(key, BytesIO()).verify, 1, 1)
+        # version 1 files whose data ended on a chunk boundary have an extra last chunk that is all padding
+        fernet = FernetNoBase64(key)
+        chunks = [b"a"*fernet_files.DEFAULT_CHUNKSIZE, bytes(fernet_files.DEFAULT_CHUNKSIZE)]
+        version_1 = (1).to_bytes(fernet_files.META_SIZE, "little")+fernet_files.DEFAULT_CHUNKSIZE.to_bytes(fernet_files.META_SIZE, "little")+b"".join(map(fernet.encrypt, chunks))
+        self.assertEqual(fernet_files.verify(BytesIO(version_1), key), [])
+        with fernet_files.FernetFile(key, BytesIO(version_1)) as fernet_file:
+            self.assertEqual(fernet_file.read(), chunks[0])
+
+    def test_rewrap(self):
+        def test(chunksize, input_data):
+            old_key, new_key = fernet_files.FernetFile.generate_key(), fernet_files.FernetFile.generate_key()
+            with open("test", "wb+") as f:
+                with fernet_files.FernetFile(old_key, f, chunksize) as fernet_file:
+                    fernet_file.write(input_data)
+            for new_chunksize, cipher in ((None, None), (chunksize*3+5, "aes-gcm"), (max(chunksize//2, 1), "fernet")):
+                self.assertEqual(fernet_files.rewrap("test", "test2", old_key, new_key, new_chunksize, workers=3, cipher=cipher), len(input_data))
+                with fernet_files.FernetFile(new_key, "test2") as fernet_file:
+                    self.assertEqual(fernet_file.chunksize, new_chunksize or chunksize)
+                    self.assertEqual(fernet_file.read(), input_data)
+                self.assertEqual(fernet_files.verify("test2", new_key), [])
+            with open("test2", "rb") as f:
+                encrypted = f.read()
+            if len(input_data) > chunksize: # interrupted part way through a chunk
+                with open("test2", "rb+") as f:
+                    f.truncate(len(encrypted)//2)
+                fernet_files.rewrap("test", "test2", old_key, new_key, max(chunksize//2, 1), workers=3, cipher="fernet", resume=True)
+                with open("test2", "rb") as f:
+                    resumed = f.read()
+                header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+                token_size = max(chunksize//2, 1)+73-max(chunksize//2, 1)%16
+                written = header_size+(len(encrypted)//2-header_size)//token_size*token_size
+                self.assertEqual(resumed[:written], encrypted[:written]) # chunks that were written aren't written again
+                self.assertEqual(len(resumed), len(encrypted))
+                with fernet_files.FernetFile(new_key, "test2") as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+            # a different file of the same size is never mistaken for an interrupted rewrap of the first
+            for resume, data in ((False, bytes(255-byte for byte in input_data)), (True, input_data)):
+                with open("test", "wb+") as f:
+                    with fernet_files.FernetFile(old_key, f, chunksize) as fernet_file:
+                        fernet_file.write(data)
+                fernet_files.rewrap("test", "test2", old_key, new_key, max(chunksize//2, 1), workers=3, cipher="fernet", resume=resume)
+                with fernet_files.FernetFile(new_key, "test2") as fernet_file:
+                    self.assertEqual(fernet_file.read(), data)
+        execute_test("test_rewrap", test)
+        key = fernet_files.FernetFile.generate_key()
+        self.assertRaises(ValueError, fernet_files.rewrap, BytesIO(), BytesIO(), key, key)
+        self.assertRaises(ValueError, fernet_files.rewrap, BytesIO(), BytesIO(), key, key, workers=0)
+        self.assertRaises(TypeError, fernet_files.rewrap, BytesIO(), BytesIO(), key, key, new_chunksize="1")
+        self.assertRaises(TypeError, fernet_files.rewrap, BytesIO(), BytesIO(), key, key, resume=1)
+
+    def test_cli(self):
+        def run(*args, stdin=b""):
+            stdout = TextIOWrapper(BytesIO())
+            with patch("sys.stdin", TextIOWrapper(BytesIO(stdin))), redirect_stdout(stdout), redirect_stderr(TextIOWrapper(BytesIO())):
+                code = main([args[0], "--key-file", "key", *args[1:]])
+            stdout.flush()
+            return code, stdout.buffer.getvalue()
+        with open("key", "wb") as f:
+            f.write(fernet_files.FernetFile.generate_key())
+        input_data = os.urandom(300_000)
+        with open("plain", "wb") as f:
+            f.write(input_data)
+        self.assertEqual(run("encrypt", "plain", "test", "--chunksize", "1000", "--workers", "4"), (0, b""))
+        self.assertEqual(run("decrypt", "test", "test2"), (0, b""))
+        with open("test2", "rb") as f:
+            self.assertEqual(f.read(), input_data)
+        self.assertEqual(run("decrypt", "test"), (0, input_data)) # file to stdout
+        self.assertEqual(run("cat", "test", "--range", "1500:2500"), (0, input_data[1500:2500]))
+        self.assertEqual(run("cat", "test", "--range", "299000:"), (0, input_data[299000:]))
+        code, encrypted = run("encrypt", "--cipher", "aes-gcm", stdin=input_data) # stdin to stdout
+        self.assertEqual(code, 0)
+        self.assertEqual(run("decrypt", stdin=encrypted), (0, input_data))
+        code, info = run("info", "test")
+        self.assertEqual(code, 0)
+        self.assertIn(b"chunksize: 1000\n", info)
+        self.assertIn(b"size: 300000\n", info)
+        self.assertEqual(run("verify", "test"), (0, b"test: OK\n"))
+        with open("test", "rb+") as f: # modify chunk 1
+            f.seek(len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16+1100)
+            f.write(b"0")
+        self.assertEqual(run("verify", "test"), (1, b"test: 1 invalid chunks: 1\n"))
+        self.assertEqual(run("verify", "missing", "test"), (1, b"missing: No such file or directory\ntest: 1 invalid chunks: 1\n")) # every file is checked
+        self.assertEqual(run("decrypt", "test", "test2")[0], 1)
+        self.assertFalse(os.path.exists("test2")) # no partly decrypted output is left behind
+        with self.assertRaises(SystemExit), redirect_stderr(TextIOWrapper(BytesIO())):
+            main(["cat", "test", "--range", "5:1"])
+        # the data read at once is limited, however large the chunksize and however many workers
+        self.assertEqual(run("encrypt", "plain", "test", "--chunksize", "8000000", "--workers", "1000"), (0, b""))
+        self.assertEqual(run("decrypt", "test", "--workers", "1000"), (0, input_data))
+        self.assertEqual(run("cat", "test", "--range", "1500:2500"), (0, input_data[1500:2500]))
+        for chunksize, chunks in ((8_000_000, 4000), (1000, 10**9), (_MAX_BLOCK*2, 4), (_MAX_BLOCK, 1)):
+            block = _block(chunksize, chunks)
+            self.assertEqual(block % chunksize, 0)
+            self.assertLessEqual(block, max(_MAX_BLOCK, chunksize))
+        self.assertEqual(_block(1000, 4), 4000)
+
+    def test_stats(self):
+        for stats, stats_hook in ((1, None), ("True", None), (None, 1)):
+            self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), stats=stats, stats_hook=stats_hook)
+        with fernet_files.FernetFile(fernet_files.FernetFile.generate_key(), BytesIO()) as fernet_file:
+            self.assertIsNone(fernet_file.stats())
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            events = []
+            fernet_files.reset_global_stats()
+            with BytesIO() as f:
+                fernet_file = fernet_files.FernetFile(key, f, chunksize, cache_size=chunksize*4, stats_hook=lambda event, size, seconds: events.append(event))
+                fernet_file.write(input_data)
+                fernet_file.flush()
+                stats = fernet_file.stats()
+                chunks = -(-len(input_data)//chunksize)
+                self.assertEqual(stats.chunks_encrypted, chunks)
+                self.assertEqual(stats.plaintext_bytes_encrypted, chunks*chunksize)
+                self.assertGreaterEqual(stats.bytes_written, chunks*fernet_file._FernetFile__chunksize)
+                self.assertEqual(stats.header_writes > 0, bool(input_data))
+                f.seek(0)
+                fernet_file.close()
+                closed = fernet_file.stats()
+                self.assertEqual(fernet_files.global_stats(), closed)
+                with fernet_files.FernetFile(key, f, stats=True) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+                    stats = fernet_file.stats()
+                    self.assertEqual(stats.chunks_decrypted, chunks)
+                    self.assertEqual(stats.plaintext_bytes_decrypted, stats.chunks_decrypted*chunksize)
+                    self.assertEqual(stats.chunks_encrypted, 0)
+                    self.assertIsNone(stats.cache_hit_ratio)
+                    self.assertEqual(fernet_files.global_stats(), closed+stats)
+            if input_data:
+                self.assertTrue({"encrypt", "write", "header_write"} <= set(events))
+            self.assertNotIn("decrypt", events)
+        execute_test("test_stats", test)
+        key = fernet_files.FernetFile.generate_key()
+        with fernet_files.FernetFile(key, BytesIO(), 10, read_ahead=4, cache_size=100, stats=True) as fernet_file:
+            fernet_file.write(bytes(range(100)))
+            fernet_file.seek(0)
+            fernet_file.read(15) # cached, so the chunks decrypted by read-ahead aren't used
+            self.assertEqual(fernet_file.stats().cache_hit_ratio, 1)
+        self.assertGreater(fernet_file.stats().wasted_decrypts, 0)
+        fernet_files.STATS_ENABLED = True
+        try:
+            with fernet_files.FernetFile(key, BytesIO()) as fernet_file:
+                self.assertIsNotNone(fernet_file.stats())
+            with fernet_files.FernetFile(key, BytesIO(), stats=False) as fernet_file:
+                self.assertIsNone(fernet_file.stats())
+        finally:
+            fernet_files.STATS_ENABLED = False
+
+    def test_invalid_compression(self):
+        self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), compression=1)
+        self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), compression="gzip")
+
+    def test_compression(self):
+        codecs = iter(fernet_files.compression.COMPRESSIONS*20)
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            compression = next(codecs)
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, workers=2, compression=compression) as fernet_file:
+                    fernet_file.write(input_data)
+                    fernet_file.seek(0)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    input_data = test_random_writes(self, fernet_file, chunksize, input_data)
+                    self.assertEqual(fernet_file.verify(), [])
+                f.seek(0)
+                self.assertRaises(ValueError, fernet_files.FernetFile, key, f, compression="zlib" if compression != "zlib" else "lzma")
+                f.seek(0)
+                with fernet_files.FernetFile(key, f, read_ahead=2) as fernet_file: # the codec is read from the header
+                    self.assertEqual(fernet_file.read(), input_data)
+                    fernet_file.truncate(len(input_data)//2)
+                    fernet_file.seek(len(input_data)+10) # grows with holes
+                    fernet_file.write(b"end")
+                input_data = input_data[:len(input_data)//2]+bytes(len(input_data)-len(input_data)//2+10)+b"end"
+                f.seek(0)
+                with fernet_files.FernetReader(key, f) as reader:
+                    self.assertEqual(reader.pread(0), input_data)
+                f.seek(0)
+                with fernet_files.FernetFile(key, f) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+                    self.assertEqual(fernet_file.verify(), [])
+                f.seek(0)
+                self.assertRaises(ValueError, fernet_files.decrypt_stream, f, BytesIO(), key)
+        execute_test("test_compression", test)
+        key = fernet_files.FernetFile.generate_key()
+        input_data = b"compressible text\n"*10000
+        with fernet_files.FernetFile(key, BytesIO(), 4096, cipher="aes-gcm", compression="zlib") as fernet_file:
+            fernet_file.write(input_data)
+            f = fernet_file.close()
+        self.assertLess(len(f.getvalue()), len(input_data)//10)
+        for compression in fernet_files.compression.COMPRESSIONS: # nothing written before truncating to 0 comes back
+            with fernet_files.FernetFile(key, BytesIO(), 4, compression=compression) as fernet_file:
+                fernet_file.write(b"secret!!")
+                fernet_file.truncate(0)
+                fernet_file.truncate(8)
+                fernet_file.seek(0)
+                self.assertEqual(fernet_file.read(), bytes(8))
+                fernet_file.truncate(0)
+                fernet_file.write(b"x") # at the position after reading
+                fernet_file.seek(0)
+                self.assertEqual(fernet_file.read(), bytes(8)+b"x")
+                self.assertEqual(fernet_file.verify(), [])
+        data = bytearray(f.getvalue())
+        data[-20] ^= 1 # in the index
+        with self.assertRaises(InvalidToken):
+            fernet_files.FernetFile(key, BytesIO(data))
+
+    def test_compression_unclean_exit(self):
+        key = fernet_files.FernetFile.generate_key()
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(fernet_files.__file__)))
+        for flush in (False, True): # chunks appended after the index never overwrite it, so the file can be opened after the program is killed
+            input_data = os.urandom(10000)
+            with open("test", "wb+") as f, fernet_files.FernetFile(key, f, 4096, compression="zlib") as fernet_file:
+                fernet_file.write(input_data)
+            appended = os.urandom(9000)
+            subprocess.run([sys.executable, "-c", f"""import os, fernet_files
+fernet_file = fernet_files.FernetFile(bytes.fromhex("{key.hex()}"), "test", append=True)
+fernet_file.write(bytes.fromhex("{appended.hex()}"))
+if {flush}:
+    fernet_file.flush()
+os._exit(0)"""], env=env, check=True)
+            with fernet_files.FernetFile(key, "test") as fernet_file:
+                data = fernet_file.read()
+                self.assertEqual(data[:10000], input_data) # chunks written since the last flush may be lost
+                if flush:
+                    self.assertEqual(data, input_data+appended)
+                self.assertEqual(fernet_file.verify(), [])
+        # a new file killed before its first flush, which has chunks after the header but no index of its own
+        os.remove("test")
+        subprocess.run([sys.executable, "-c", f"""import os, fernet_files
+fernet_file = fernet_files.FernetFile(bytes.fromhex("{key.hex()}"), open("test", "wb+"), 4096, compression="zlib")
+fernet_file.write(os.urandom(20000))
+os._exit(0)"""], env=env, check=True)
+        for truncate in (False, True):
+            if truncate: # back to the header
+                os.truncate("test", fernet_files._header_size(fernet_files.FORMAT_VERSION))
+            with fernet_files.FernetFile(key, "test") as fernet_file:
+                data = fernet_file.read()
+                self.assertEqual(data, bytes(len(data))) # chunks that weren't in an index are lost, and read as holes
+                self.assertEqual(fernet_file.verify(), [])
+                fernet_file.write(b"end")
+            with fernet_files.FernetFile(key, "test") as fernet_file:
+                self.assertEqual(fernet_file.read(), data+b"end")
+        input_data = b"compressible text\n"*1000
+        with open("test", "wb+") as f, fernet_files.FernetFile(key, f, 100, cipher="aes-gcm", compression="zlib") as fernet_file:
+            fernet_file.write(input_data*2)
+        size = os.path.getsize("test")
+        with open("test", "wb+") as f, fernet_files.FernetFile(key, f, 100, cipher="aes-gcm", compression="zlib") as fernet_file:
+            fernet_file.write(input_data)
+        with fernet_files.FernetFile(key, "test", append=True) as fernet_file:
+            fernet_file.write(input_data[:9000])
+            fernet_file.flush() # the old index and the one written here are both left behind
+            fernet_file.write(input_data[9000:])
+        self.assertLess(os.path.getsize("test"), size+100) # the space of the old indexes is reused by chunks from the end, apart from less than a chunk
+        with fernet_files.FernetFile(key, "test") as fernet_file:
+            self.assertEqual(fernet_file.read(), input_data*2)
+            self.assertEqual(fernet_file.verify(), [])
+
+    def test_archive(self):
+        self.assertRaises(ValueError, fernet_files.FernetArchive, fernet_files.FernetFile.generate_key(), BytesIO(), "x")
+        key = fernet_files.FernetFile.generate_key()
+        def test(chunksize, input_data):
+            members = {f"dir{i % 3}/member{i}": input_data[i*len(input_data)//7:(i+1)*len(input_data)//7] for i in range(7)}
+            with fernet_files.FernetArchive(key, BytesIO(), "w", chunksize=chunksize) as archive:
+                for name, data in members.items():
+                    self.assertEqual(archive.add(name, data).size, len(data))
+                self.assertRaises(ValueError, archive.add, "dir0/member0", b"")
+                archive.add("stream", BytesIO(input_data))
+                f = archive.close()
+            with fernet_files.FernetArchive(key, f, "a") as archive:
+                self.assertEqual(archive.read("stream"), input_data)
+                archive.add("appended", b"line 1\nline 2\n")
+                f = archive.close()
+            with fernet_files.FernetArchive(key, f) as archive:
+                self.assertEqual([info.name for info in archive.members()], [*members, "stream", "appended"])
+                for name, data in members.items():
+                    self.assertEqual(archive.read(name), data)
+                with archive.open("appended") as member:
+                    self.assertEqual(list(member), [b"line 1\n", b"line 2\n"])
+                with archive.open("stream") as member:
+                    x = randint(0, len(input_data))
+                    member.seek(x)
+                    self.assertEqual(member.read(100), input_data[x:x+100])
+                    self.assertEqual(member.seek(10, os.SEEK_END), len(input_data)) # can't go past the end of the member
+                self.assertRaises(KeyError, archive.open, "missing")
+                self.assertRaises(ValueError, archive.add, "new", b"")
+                with tempfile.TemporaryDirectory() as directory:
+                    archive.extractall(directory)
+                    for name, data in members.items():
+                        with open(os.path.join(directory, name), "rb") as extracted:
+                            self.assertEqual(extracted.read(), data)
+                f = archive.close()
+            f.seek(0)
+            with fernet_files.FernetFile(key, f) as fernet_file: # the names are encrypted too
+                self.assertNotIn(b"member", f.getvalue())
+                self.assertIn(b"dir0/member0", fernet_file.read())
+        execute_test("test_archive", test)
+        with fernet_files.FernetArchive(key, BytesIO(), "w") as archive:
+            archive.add("../outside", b"data")
+            with tempfile.TemporaryDirectory() as directory:
+                self.assertRaises(ValueError, archive.extract, "../outside", directory)
+        f = BytesIO()
+        with fernet_files.FernetFile(key, f) as fernet_file:
+            fernet_file.write(b"not an archive")
+            f = fernet_file.close()
+        self.assertRaises(ValueError, fernet_files.FernetArchive, key, f)
+
+    def test_sync(self):
+        key = fernet_files.FernetFile.generate_key()
+        @contextmanager
+        def clock(seconds): # tokens are encrypted by cryptography's Fernet.encrypt and by encrypt_many
+            with patch("time.time", return_value=seconds), patch("fernet_files.custom_fernet.time", return_value=seconds):
+                yield
+        def test(chunksize, input_data):
+            for cipher in ("fernet", "aes-gcm"):
+                src = BytesIO()
+                with clock(1000):
+                    with fernet_files.FernetFile(key, src, chunksize, cipher=cipher) as fernet_file:
+                        fernet_file.write(input_data)
+                        src = fernet_file.close()
+                dst = BytesIO()
+                chunks = -(-len(input_data)//chunksize)
+                self.assertEqual(fernet_files.sync(src, dst), list(range(chunks)))
+                self.assertEqual(dst.getvalue(), src.getvalue())
+                x = randint(0, max(len(input_data)-1, 0)) # writing past the end would rewrite the last chunk too
+                with clock(2000):
+                    with fernet_files.FernetFile(key, src) as fernet_file:
+                        fernet_file.seek(x)
+                        fernet_file.write(b"x")
+                        src = fernet_file.close()
+                if cipher == "fernet":
+                    self.assertEqual(fernet_files.changed_since(src, key, 1500), [x//chunksize])
+                    self.assertEqual(fernet_files.changed_since(src, key, 0), list(range(max(chunks, x//chunksize+1))))
+                    self.assertEqual(fernet_files.sync(src, dst, key, since=1500), [x//chunksize])
+                else:
+                    self.assertRaises(ValueError, fernet_files.changed_since, src, key, 1500)
+                    self.assertRaises(ValueError, fernet_files.sync, src, dst, key, since=1500)
+                    self.assertEqual(fernet_files.sync(src, dst), [x//chunksize])
+                self.assertEqual(dst.getvalue(), src.getvalue())
+                self.assertEqual(fernet_files.sync(src, dst), [])
+        execute_test("test_sync", test)
+        self.assertEqual(fernet_files.sync(BytesIO(), BytesIO(b"old")), [])
+        self.assertRaises(ValueError, fernet_files.sync, BytesIO(), BytesIO(), since=0)
+        self.assertRaises(TypeError, fernet_files.sync, BytesIO(), BytesIO(), key, since="0")
+
+    def test_tree(self):
+        key = fernet_files.FernetFile.generate_key()
+        files = {"empty": b"", "small": os.urandom(1000), os.path.join("dir", "large"): os.urandom(300_000), os.path.join("dir", "sub", "medium"): os.urandom(65536*3)}
+        with tempfile.TemporaryDirectory() as directory:
+            src, encrypted, decrypted = (os.path.join(directory, name) for name in ("src", "encrypted", "decrypted"))
+            for path, data in files.items():
+                os.makedirs(os.path.dirname(os.path.join(src, path)), exist_ok=True)
+                with open(os.path.join(src, path), "wb") as f:
+                    f.write(data)
+            for chunksize, cipher in ((None, None), (1000, "aes-gcm"), ("auto", "fernet")):
+                finished = []
+                result = fernet_files.encrypt_tree(src, encrypted, key, workers=2, chunksize=chunksize, cipher=cipher, part_size=50_000, callback=finished.append)
+                self.assertEqual(sorted(result.files), sorted(finished))
+                self.assertEqual({x.path: x.size for x in result.files}, {path: len(data) for path, data in files.items()})
+                self.assertEqual(result.size, sum(len(data) for data in files.values()))
+                self.assertGreater(result.throughput, 0)
+                for path, data in files.items():
+                    with fernet_files.FernetFile(key, os.path.join(encrypted, path)) as fernet_file:
+                        self.assertEqual(fernet_file.read(), data)
+                result = fernet_files.decrypt_tree(encrypted, decrypted, key, workers=2, part_size=50_000)
+                self.assertEqual(result.size, sum(len(data) for data in files.values()))
+                for path, data in files.items():
+                    with open(os.path.join(decrypted, path), "rb") as f:
+                        self.assertEqual(f.read(), data)
+            with fernet_files.FernetFile(key, os.path.join(encrypted, "compressed"), chunksize=1000, compression="zlib") as fernet_file:
+                fernet_file.write(bytes(100_000))
+            self.assertEqual(fernet_files.decrypt_tree(encrypted, decrypted, key, workers=2, part_size=50_000).size, sum(len(data) for data in files.values())+100_000)
+            for path in (os.path.join("dir", "large"), "small"): # a file that is split into parts, and one that is decrypted whole
+                with open(os.path.join(encrypted, path), "rb+") as f:
+                    f.seek(-1, os.SEEK_END)
+                    byte = f.read(1)
+                    f.seek(-1, os.SEEK_END)
+                    f.write(bytes((byte[0] ^ 1,))) # the last byte of the HMAC or tag of the last chunk
+                    f.flush()
+                    self.assertRaises(InvalidToken, fernet_files.decrypt_tree, encrypted, decrypted, key, workers=2, part_size=50_000)
+                    f.seek(-1, os.SEEK_END)
+                    f.write(byte)
+            with open(os.path.join(encrypted, "dir", "large"), "rb+") as f: # parts past the end of a truncated file aren't left as zeros
+                f.truncate(os.path.getsize(os.path.join(encrypted, "dir", "large"))//2)
+            self.assertRaises(ValueError, fernet_files.decrypt_tree, encrypted, decrypted, key, workers=2, part_size=50_000)
+        self.assertRaises(ValueError, fernet_files.encrypt_tree, ".", ".", key, workers=0)
+        self.assertRaises(TypeError, fernet_files.decrypt_tree, ".", ".", key, part_size="1")
+
+    def test_io_hints(self):
+        key = fernet_files.FernetFile.generate_key()
+        self.assertEqual(fernet_files.FernetFile.auto_chunksize(10**9, "noreuse"), fernet_files.FernetFile.auto_chunksize(10**9, "sequential"))
+        def test(chunksize, input_data):
+            for access in fernet_files.ACCESS_PATTERNS:
+                with open("test", "wb+") as f, fernet_files.FernetFile(key, f, chunksize, expected_size=len(input_data)+chunksize, access=access) as fernet_file:
+                    if hasattr(os, "posix_fallocate"): # the space for every chunk is allocated up front
+                        self.assertGreaterEqual(os.path.getsize("test"), len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16+(len(input_data)//chunksize+1)*(chunksize+73-chunksize%16))
+                    fernet_file.write(input_data)
+                    self.assertEqual(fernet_file.verify(), []) # the space that isn't used is released
+                    self.assertEqual(fernet_file.preallocate(0), False)
+                with fernet_files.FernetFile(key, "test", access=access) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+                    x = randint(0, len(input_data))
+                    fernet_file.seek(x)
+                    fernet_file.write(b"x")
+                self.assertEqual(fernet_files.verify("test", key), [])
+        execute_test("test_io_hints", test)
+        with fernet_files.FernetFile(key, BytesIO(), expected_size=1000) as fernet_file: # hints are ignored if the file isn't on disk
+            self.assertEqual(fernet_file.preallocate(1000), False)
+            self.assertRaises(TypeError, fernet_file.preallocate, "1")
+            self.assertRaises(ValueError, fernet_file.preallocate, -1)
+        with open("test", "wb+") as f, fernet_files.FernetFile(key, f, access="noreuse") as fernet_file:
+            fernet_file.write(b"data")
+        with open("test", "rb") as f, fernet_files.FernetFile(key, f, access="noreuse") as fernet_file:
+            self.assertEqual(fernet_file.read(), b"data")
+            self.assertRaises(UnsupportedOperation, fernet_file.preallocate, 1000)
+
+    def test_mmap(self):
+        def test(chunksize, input_data):
+            for cipher in fernet_files.CIPHERS: # tokens are read from the map as memoryviews, which every cipher must accept
+                data = input_data
+                key = fernet_files.FernetFile.generate_key()
+                with open("test", "wb+") as f:
+                    with fernet_files.FernetFile(key, f, chunksize, use_mmap=True, cipher=cipher) as fernet_file:
+                        fernet_file.write(data)
+                        fernet_file.seek(0)
+                        test_random_reads(self, fernet_file, chunksize, data)
+                        test_other_read(self, fernet_file, data)
+                        data = test_random_writes(self, fernet_file, chunksize, data)
+                with open("test", "rb") as f: # file is truncated to the end of the data
+                    f.seek(0, os.SEEK_END)
+                    header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+                    token_size = chunksize + 73 - (chunksize % 16) if cipher == "fernet" else chunksize+28
+                    self.assertEqual(f.tell(), header_size + -(-len(data)//chunksize)*token_size)
+                with open("test", "rb") as f: # readable without mmap
+                    with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                        self.assertEqual(fernet_file.read(), data)
+                with fernet_files.FernetFile(key, "test", chunksize, use_mmap=True) as fernet_file: # existing file by name
+                    test_other_read(self, fernet_file, data)
+                with open("test", "rb") as f: # read-only map
+                    with fernet_files.FernetFile(key, f, chunksize, use_mmap=True) as fernet_file:
+                        test_random_reads(self, fernet_file, chunksize, data)
+        execute_test("test_mmap", test)
+
+    def test_invalid_mmap(self):
+        self.assertRaises(ValueError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), use_mmap=True)
+        self.assertRaises(TypeError, fernet_files.FernetFile, fernet_files.FernetFile.generate_key(), BytesIO(), use_mmap=1)
+        for cipher in fernet_files.CIPHERS: # a token read from the map is still alive in the traceback when the map is grown and closed
+            key = fernet_files.FernetFile.generate_key()
+            with open("test", "wb+") as f, fernet_files.FernetFile(key, f, 4096, cipher=cipher) as fernet_file:
+                fernet_file.write(bytes(5000))
+            with open("test", "r+b") as f:
+                f.seek(-10, os.SEEK_END)
+                f.write(b"corrupted!")
+            error = None
+            with fernet_files.FernetFile(key, "test", 4096, use_mmap=True) as fernet_file:
+                try:
+                    fernet_file.truncate(4500)
+                except InvalidToken as e:
+                    error = e
+                self.assertIsNotNone(error.__traceback__)
+                fernet_file.seek(0)
+                fernet_file.write(bytes(fernet_files.MMAP_GROWTH+1))
+            del error
+            with fernet_files.FernetFile(key, "test", 4096) as fernet_file:
+                self.assertEqual(fernet_file.read(), bytes(fernet_files.MMAP_GROWTH+1))
+
+    def test_async(self):
+        async def test_async_file(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            with BytesIO() as f:
+                async with fernet_files.AsyncFernetFile(key, f, chunksize, workers=2) as fernet_file:
+                    self.assertEqual(await fernet_file.write(input_data), len(input_data))
+                    self.assertEqual(await fernet_file.seek(0), 0)
+                    self.assertEqual(await fernet_file.read(), input_data)
+                    await fernet_file.seek(0)
+                    pieces = [data async for data in fernet_file]
+                    self.assertTrue(all(len(data) <= chunksize for data in pieces))
+                    self.assertEqual(b"".join(pieces), input_data)
+                    x = len(input_data)//2
+                    await fernet_file.seek(x)
+                    buffer = bytearray(chunksize)
+                    size = await fernet_file.readinto(buffer)
+                    self.assertEqual(buffer[:size], input_data[x:x+chunksize])
+                    await fernet_file.seek(0)
+                    results = await asyncio.gather(*(fernet_file.read(1) for _ in range(len(input_data[:10])))) # run in order
+                    self.assertEqual(b"".join(results), input_data[:10])
+                self.assertTrue(fernet_file.closed)
+                f.seek(0)
+                with fernet_files.FernetFile(key, f, chunksize) as other:
+                    self.assertEqual(other.read(), input_data)
+                reads = set()
+                class RecordingIO(BytesIO): # records the threads the file is read on
+                    def read(self, *args):
+                        reads.add(threading.get_ident())
+                        return super().read(*args)
+                fernet_file = fernet_files.AsyncFernetFile(key, RecordingIO(f.getvalue()), chunksize)
+                self.assertEqual(reads, set()) # nothing is read until the file is opened
+                self.assertFalse(fernet_file.closed)
+                self.assertRaises(ValueError, lambda: fernet_file.writeable)
+                self.assertEqual(await fernet_file.read(), input_data) # opened by the first operation
+                await fernet_file.close()
+                reads.clear()
+                fernet_file = await fernet_files.AsyncFernetFile.open(key, RecordingIO(f.getvalue()), chunksize)
+                self.assertTrue(reads)
+                self.assertNotIn(threading.get_ident(), reads) # the header is read on the executor, not the event loop
+                self.assertTrue(fernet_file.writeable)
+                self.assertEqual(await fernet_file.read(), input_data)
+                await fernet_file.close()
+                self.assertTrue(fernet_file.closed)
+        execute_test("test_async", lambda chunksize, input_data: asyncio.run(test_async_file(chunksize, input_data)))
+
+    def test_stream(self):
+        class Pipe(RawIOBase): # a stream that can't seek and returns less data than asked for
+            def __init__(self, data=b""):
+                self.data = BytesIO(data)
+            def readable(self):
+                return True
+            def writable(self):
+                return True
+            def readinto(self, buffer):
+                data = self.data.read(min(len(buffer), 1000))
+                buffer[:len(data)] = data
+                return len(data)
+            def write(self, b):
+                return self.data.write(b[:1000])
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            for size in (None, len(input_data)): # metadata in a trailer, then metadata up front
+                encrypted = Pipe()
+                self.assertEqual(fernet_files.encrypt_stream(Pipe(input_data), encrypted, key, chunksize, size), len(input_data))
+                ciphertext = encrypted.data.getvalue()
+                self.assertNotEqual(input_data, ciphertext)
+                decrypted = Pipe()
+                self.assertEqual(fernet_files.decrypt_stream(Pipe(ciphertext), decrypted, key, chunksize), len(input_data))
+                self.assertEqual(decrypted.data.getvalue(), input_data)
+                with fernet_files.FernetFile(key, BytesIO(ciphertext), chunksize) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+                with self.assertRaises(ValueError):
+                    fernet_files.decrypt_stream(Pipe(ciphertext[:-1]), Pipe(), key, chunksize)
+            # seekable streams have their size measured, so the output is the same as FernetFile
+            encrypted = BytesIO()
+            fernet_files.encrypt_stream(BytesIO(input_data), encrypted, key, chunksize)
+            with fernet_files.FernetFile(key, BytesIO(), chunksize) as fernet_file:
+                fernet_file.write(input_data)
+                written = fernet_file.close()
+            self.assertEqual(len(encrypted.getvalue()), len(written.getvalue()))
+            decrypted = BytesIO()
+            fernet_files.decrypt_stream(BytesIO(written.getvalue()), decrypted, key, chunksize)
+            self.assertEqual(decrypted.getvalue(), input_data)
+            with self.assertRaises(ValueError):
+                fernet_files.encrypt_stream(Pipe(input_data), Pipe(), key, chunksize, len(input_data)+1)
+        execute_test("test_stream", test)
+
+    def test_header(self):
+        key = fernet_files.FernetFile.generate_key()
+        for chunksize in (100, "auto"):
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, chunksize, expected_size=1000, access="random") as fernet_file:
+                    fernet_file.write(b"a"*1000)
+                    chunksize = fernet_file.chunksize
+                with fernet_files.FernetFile(key, f) as fernet_file: # chunksize is read from the header
+                    self.assertEqual(fernet_file.chunksize, chunksize)
+                    self.assertEqual(fernet_file.read(), b"a"*1000)
+        self.assertEqual(fernet_files.FernetFile.auto_chunksize(1000, "random"), 1008)
+        self.assertEqual(fernet_files.FernetFile.auto_chunksize(10**9, "random"), 65536)
+        self.assertEqual(fernet_files.FernetFile.auto_chunksize(10**9, "sequential"), 4_194_304)
+        self.assertEqual(fernet_files.FernetFile.auto_chunksize(), fernet_files.DEFAULT_CHUNKSIZE)
+        self.assertRaises(TypeError, fernet_files.FernetFile, key, BytesIO(), expected_size="1")
+        self.assertRaises(ValueError, fernet_files.FernetFile, key, BytesIO(), expected_size=-1)
+        self.assertRaises(ValueError, fernet_files.FernetFile, key, BytesIO(), access="backwards")
+        # version 1 files don't record their chunksize, so the default is used
+        fernet = FernetNoBase64(key)
+        data = os.urandom(fernet_files.DEFAULT_CHUNKSIZE+10)
+        chunks = [data[:fernet_files.DEFAULT_CHUNKSIZE], data[fernet_files.DEFAULT_CHUNKSIZE:].ljust(fernet_files.DEFAULT_CHUNKSIZE, b"\0")]
+        version_1 = (1).to_bytes(fernet_files.META_SIZE, "little")+(fernet_files.DEFAULT_CHUNKSIZE-10).to_bytes(fernet_files.META_SIZE, "little")+b"".join(map(fernet.encrypt, chunks))
+        with fernet_files.FernetFile(key, BytesIO(version_1)) as fernet_file:
+            self.assertEqual(fernet_file.read(), data)
+            fernet_file.write(b"b")
+            written = fernet_file.close()
+        self.assertEqual(written.getvalue()[:fernet_files.META_SIZE*2], (1).to_bytes(fernet_files.META_SIZE, "little")+(fernet_files.DEFAULT_CHUNKSIZE-11).to_bytes(fernet_files.META_SIZE, "little"))
+
+    def test_invalid_cipher(self):
+        key = fernet_files.FernetFile.generate_key()
+        self.assertRaises(TypeError, fernet_files.FernetFile, key, BytesIO(), cipher=1)
+        self.assertRaises(ValueError, fernet_files.FernetFile, key, BytesIO(), cipher="aes-cbc")
+        with BytesIO() as f:
+            fernet_files.FernetFile(key, f, 100, cipher="aes-gcm").write(b"abc")
+            self.assertRaises(ValueError, fernet_files.FernetFile, key, f, 100, cipher="chacha20-poly1305")
+            self.assertRaises(ValueError, fernet_files.FernetFile, key, f, 101)
+            f.seek(0)
+            f.write(fernet_files.MAGIC+bytes((3,)))
+            self.assertRaises(ValueError, fernet_files.FernetFile, key, f, 100)
+
+    def test_cipher(self):
+        def test(chunksize, input_data):
+            key = fernet_files.FernetFile.generate_key()
+            for cipher in fernet_files.ciphers.CIPHERS:
+                with BytesIO() as f:
+                    fernet_file = fernet_files.FernetFile(key, f, chunksize, cipher=cipher)
+                    fernet_file.write(input_data)
+                    test_random_reads(self, fernet_file, chunksize, input_data)
+                    data = test_random_writes(self, fernet_file, chunksize, input_data)
+                    fernet_file.close()
+                    with fernet_files.FernetFile(key, f, chunksize) as fernet_file: # the cipher is read from the header
+                        self.assertEqual(fernet_file.read(), data)
+                    header_size = len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16
+                    if cipher != "fernet":
+                        token_size = chunksize+28
+                        self.assertEqual(len(f.getvalue()), header_size+(len(data)+chunksize-1)//chunksize*token_size)
+                        if len(data) > chunksize: # swapping chunks is detected
+                            ciphertext = f.getvalue()
+                            f.seek(header_size)
+                            f.write(ciphertext[header_size+token_size:header_size+token_size*2]+ciphertext[header_size:header_size+token_size])
+                            with fernet_files.FernetFile(key, f, chunksize) as fernet_file:
+                                self.assertNotEqual(fernet_file.read(chunksize), data[:chunksize])
+                # streams can use every cipher
+                encrypted, decrypted = BytesIO(), BytesIO()
+                fernet_files.encrypt_stream(BytesIO(input_data), encrypted, key, chunksize, cipher=cipher)
+                encrypted.seek(0)
+                fernet_files.decrypt_stream(encrypted, decrypted, key, chunksize)
+                self.assertEqual(decrypted.getvalue(), input_data)
+        execute_test("test_cipher", test)
+
+    def test_batch(self):
+        fernet = FernetNoBase64(FernetNoBase64.generate_key())
+        for size in (0, 1, 15, 16, 17, 1000):
+            chunks = [os.urandom(size) for _ in range(5)]
+            tokens = fernet.encrypt_many(chunks)
+            self.assertEqual([len(token) for token in tokens], [FernetNoBase64.token_size(size)]*5)
+            self.assertEqual([fernet.decrypt(token) for token in tokens], chunks)
+            self.assertEqual(fernet.decrypt_many([fernet.encrypt(chunk) for chunk in chunks]), chunks)
+            # preallocated buffers
+            out = bytearray(sum(len(token) for token in tokens))
+            self.assertEqual(fernet.decrypt_many(fernet.encrypt_many(chunks, out)), chunks)
+            out = bytearray(size*5)
+            self.assertEqual([bytes(data) for data in fernet.decrypt_many(tokens, out)], chunks)
+            with self.assertRaises(ValueError):
+                fernet.encrypt_many(chunks, bytearray(len(out)))
+            tampered = bytearray(tokens[2])
+            tampered[30] ^= 1
+            with self.assertRaises(InvalidToken):
+                fernet.decrypt_many(tokens[:2]+[bytes(tampered)])
+        self.assertEqual(fernet.encrypt_many([]), [])
+        # reads that span several chunks decrypt them in batches
+        class CountingFernet(FernetNoBase64):
+            def decrypt(self, token, ttl=None):
+                calls.append(None)
+                return super().decrypt(token, ttl)
+            def decrypt_many(self, tokens, out=None):
+                calls.append(len(tokens))
+                return super().decrypt_many(tokens, out)
+        key = FernetNoBase64.generate_key()
+        for cipher, workers in ((None, None), (None, 2), ("aes-gcm", 2)):
+            input_data = os.urandom(16*10)+bytes(16*5)+b"end" # with holes
+            with BytesIO() as f:
+                with fernet_files.FernetFile(key, f, 16, cipher=cipher) as fernet_file:
+                    fernet_file.write(input_data[:16*10])
+                    fernet_file.seek(16*15)
+                    fernet_file.write(b"end")
+                f.seek(0)
+                calls = []
+                with fernet_files.FernetFile(CountingFernet(key), f, 16, workers=workers) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data)
+                    fernet_file.seek(20)
+                    self.assertEqual(fernet_file.read(40), input_data[20:60])
+                    if cipher is None: # AEAD ciphers don't use FernetNoBase64 to decrypt
+                        self.assertNotIn(None, calls)
+                        self.assertEqual(sum(calls), 11+3)
+                f.seek(0)
+                calls = []
+                with fernet_files.FernetReader(CountingFernet(key), f) as reader:
+                    self.assertEqual(reader.pread(5, 16*12), input_data[5:5+16*12])
+                if cipher is None:
+                    self.assertEqual(calls, [10])
+                # a chunk that isn't valid is read in the same way as without batches
+                data = bytearray(f.getvalue())
+                token_size = (fernet_files.ciphers.AEADCipher if cipher else fernet_files.ciphers.FernetCipher).token_size(16)
+                data[len(fernet_files.MAGIC)+8+fernet_files.META_SIZE*3+16+token_size*3+20] ^= 1
+                with fernet_files.FernetFile(key, BytesIO(data), 16) as fernet_file:
+                    self.assertEqual(fernet_file.read(), input_data[:16*3]+input_data[16*4:])
+
     def test_key(self):
         # test generate key
         self.assertEqual(fernet_files.FernetFile.generate_key, FernetNoBase64.generate_key)
@@ -278,6 +1408,30 @@ def test_other_read(unit_test: TestFernetFiles, fernet_file: fernet_files.Fernet
     unit_test.assertRaises(TypeError, fernet_file.read, 1.5) # Float
     unit_test.assertRaises(TypeError, fernet_file.read, "1") # String
 
+def test_dropped_on_pool_thread(unit_test: TestFernetFiles, **kwargs) -> None:
+    '''Drops the last reference to a `FernetFile` while one of its threads is decrypting a chunk in advance, so it's closed by `__del__` on that thread.'''
+    class BlockingFernet(FernetNoBase64):
+        def decrypt(self, token, ttl=None):
+            if threading.current_thread() is not threading.main_thread():
+                release.wait(10)
+            return super().decrypt(token, ttl)
+    key, release, unraisable = FernetNoBase64.generate_key(), threading.Event(), []
+    with open("test", "wb+") as f:
+        with fernet_files.FernetFile(key, f, 16) as fernet_file:
+            fernet_file.write(os.urandom(64))
+    f = open("test", "rb+")
+    fernet_file = fernet_files.FernetFile(BlockingFernet(key), f, 16, **kwargs)
+    fernet_file.read(1) # starts decrypting the next chunks on the pool
+    with patch("sys.unraisablehook", unraisable.append):
+        del fernet_file # the pool now holds the last reference
+        release.set()
+        for _ in range(1000):
+            if f.closed:
+                break
+            time.sleep(0.01)
+    unit_test.assertTrue(f.closed) # the underlying file isn't leaked
+    unit_test.assertEqual(unraisable, [])
+
 def test_random_writes_noread(fernet_file: fernet_files.FernetFile, chunksize: int, input_data: bytes) -> bytes:
     input_data = BytesIO(input_data)
     for get_size in (lambda: randint(0, chunksize-1), lambda: chunksize, lambda: randint(chunksize+1, chunksize*3)): # below, equal, above chunksize